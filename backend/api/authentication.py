@@ -0,0 +1,134 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.translation import gettext_lazy as _
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.exceptions import AuthenticationFailed
+
+
+class LocalTTLCache:
+    ''' LRU в памяти процесса: не больше max_entries записей, каждая живет ttl секунд. Потокобезопасный '''
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.ttl <= 0 or self.max_entries <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+local_tokens = LocalTTLCache(settings.TOKEN_CACHE_LOCAL_ENTRIES, settings.TOKEN_CACHE_LOCAL_SECONDS)
+
+# Поля пользователя в кэше токенов - то, что нужно проверкам доступа. Хэш пароля в кэш не попадает,
+# остальные поля отложены (deferred) и загружаются из БД при первом обращении
+TOKEN_CACHE_USER_FIELDS = ('id', 'username', 'is_active', 'is_staff', 'is_superuser')
+
+
+def token_cache_key(key: str) -> str:
+    # Сам токен в ключ кэша не попадает
+    return 'authtoken:' + hashlib.sha256(key.encode()).hexdigest()
+
+
+def user_token_cache_key(user_id) -> str:
+    return f'authtoken:user:{user_id}'
+
+
+def invalidate_token(key: str):
+    ''' Удаление токена из кэшей после коммита, иначе параллельный запрос успеет закэшировать его снова '''
+    cache_key = token_cache_key(key)
+
+    def delete():
+        cache.delete(cache_key)
+        local_tokens.delete(cache_key)
+
+    transaction.on_commit(delete)
+
+
+def invalidate_user_tokens(user_id):
+    ''' Удаление из кэшей токена пользователя (вместе с закэшированными данными пользователя) '''
+    def delete():
+        cache_key = cache.get(user_token_cache_key(user_id))
+        if cache_key is not None:
+            cache.delete_many([cache_key, user_token_cache_key(user_id)])
+            local_tokens.delete(cache_key)
+
+    transaction.on_commit(delete)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    ''' TokenAuthentication без запроса к БД на каждый запрос: токен вместе с основными полями пользователя
+    (TOKEN_CACHE_USER_FIELDS) кэшируется в памяти процесса на TOKEN_CACHE_LOCAL_SECONDS и в общем кэше
+    на TOKEN_CACHE_SECONDS.
+    Сигналы (api.signals) удаляют токен из общего кэша при выходе, удалении токена и изменении пользователя
+    (смена пароля, деактивация). Другие процессы могут принимать отозванный токен еще не дольше
+    TOKEN_CACHE_LOCAL_SECONDS - пока не истечет их локальная запись
+    '''
+
+    def authenticate_credentials(self, key):
+        if settings.TOKEN_CACHE_SECONDS <= 0:
+            return super().authenticate_credentials(key)
+
+        cache_key = token_cache_key(key)
+        data = local_tokens.get(cache_key)
+        if data is None:
+            data = cache.get(cache_key)
+            if data is None:
+                user, token = super().authenticate_credentials(key)
+                data = self.cache_entry(token)
+                cache.set_many({cache_key: data, user_token_cache_key(user.pk): cache_key},
+                               settings.TOKEN_CACHE_SECONDS)
+            local_tokens.set(cache_key, data)
+
+        token = self.restore_token(data)
+        if not token.user.is_active:
+            raise AuthenticationFailed(_('User inactive or deleted.'))
+        return token.user, token
+
+    def cache_entry(self, token) -> dict:
+        return {'db': token._state.db, 'key': token.key, 'created': token.created,
+                'user': {field: getattr(token.user, field) for field in TOKEN_CACHE_USER_FIELDS}}
+
+    def restore_token(self, data: dict):
+        # Каждый запрос получает свои объекты: изменения request.user не должны попасть в кэш.
+        # Сохранение такого пользователя записывает только загруженные поля
+        # from_db ждет значения в порядке полей модели
+        model = get_user_model()
+        fields = [field.attname for field in model._meta.concrete_fields if field.attname in data['user']]
+        user = model.from_db(data['db'], fields, [data['user'][field] for field in fields])
+        token = self.get_model()(key=data['key'], user=user, created=data['created'])
+        token._state.adding, token._state.db = False, data['db']
+        return token
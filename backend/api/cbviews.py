@@ -1,27 +1,156 @@
+import os
 from http import HTTPMethod
 
+from adrf import mixins as async_mixins
+from adrf.viewsets import GenericViewSet as AsyncGenericViewSet
 from django.contrib.auth import get_user_model
+from django.db import connections, transaction
+from django.db.models import Prefetch
 from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.functional import cached_property
 from rest_framework import status
+from rest_framework.exceptions import APIException, ValidationError
 from rest_framework.decorators import action
+from rest_framework.permissions import IsAdminUser
 from rest_framework.generics import DestroyAPIView, ListCreateAPIView, RetrieveUpdateDestroyAPIView, UpdateAPIView
 from rest_framework.response import Response
 from rest_framework.request import Request
 from rest_framework.views import APIView
 from rest_framework.viewsets import ModelViewSet
 
+from .pagination import (
+    AsyncBlogKeysetPagination, AsyncBlogSearchPagination, BlogKeysetPagination, BlogSearchPagination, CommentKeysetPagination)
 from .permissions import IsAuthenticatedOrReadOnlyPlusOwnerControl
 from .serializers import BlogSerializer, BlogSimpleSerializer, CommentSerializer, BloggerSerializer, BloggerProfileSerializer
+from main.constants import COMMENTS_KEYSET_ORDERING, COMMENTS_PER_PAGE
 from main.models import Blog, Blogger, Comment
+from main import stampede
+from main.page_cache import page_etag
+from main.search import search_blogs
 
 User = get_user_model()
 
 
-class BlogCRUD(ModelViewSet):
+class NotModified(APIException):
+    status_code = status.HTTP_304_NOT_MODIFIED
+
+
+class ConditionalGetMixin:
+    ''' ETag ответов чтения по поколениям данных (main.page_cache): запрос с совпадающим If-None-Match
+    получает 304 без запросов к данным и сериализации. Проверка идет после аутентификации и троттлинга.
+    Ответы API не персональные, пользователь в ETag не входит
+    '''
+    etag = None
+
+    def get_page_cache_namespaces(self) -> list[str]:
+        return []
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        namespaces = self.get_page_cache_namespaces()
+        if request.method in ('GET', 'HEAD') and namespaces:
+            self.etag = page_etag(request, namespaces)
+            if get_conditional_response(request, etag=self.etag) is not None:
+                raise NotModified()
+
+    def handle_exception(self, exc):
+        if isinstance(exc, NotModified):
+            return Response(status=status.HTTP_304_NOT_MODIFIED)
+        return super().handle_exception(exc)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if self.etag and response.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+            response['ETag'] = self.etag
+            patch_cache_control(response, no_cache=True)
+        return response
+
+
+class SparseFieldsetMixin:
+    ''' Параметры чтения (list, retrieve) ?fields=id,title - только перечисленные поля и ?expand=author -
+    связанные объекты целиком (api.serializers.SparseFieldsetSerializer). Неизвестное поле - 400.
+    Запрос к БД читает только колонки полей ответа (only()), связи, которых нет в ответе, не подгружаются
+    (get_sparse_queryset). ETag зависит от полного адреса запроса, так что разные наборы полей не смешиваются
+    '''
+    sparse_actions = ('list', 'retrieve')
+    # Колонки, которые нужны независимо от полей ответа (ключ сортировки для курсора пагинации)
+    sparse_required_columns = ()
+
+    def get_query_param_list(self, name: str) -> list[str]:
+        return [value.strip() for value in self.request.query_params.get(name, '').split(',') if value.strip()]
+
+    @cached_property
+    def sparse_fieldset(self) -> tuple[list[str], list[str]]:
+        serializer_class = self.get_serializer_class()
+        fields = self.get_query_param_list('fields') or serializer_class.Meta.fields
+        expand = self.get_query_param_list('expand')
+        errors = {}
+        if unknown := set(fields) - set(serializer_class.Meta.fields):
+            errors['fields'] = [f'Unknown fields: {", ".join(sorted(unknown))}']
+        if unknown := set(expand) - set(serializer_class.expandable_fields):
+            errors['expand'] = [f'Unknown fields: {", ".join(sorted(unknown))}']
+        if errors:
+            raise ValidationError(errors)
+        # Порядок полей ответа - как в сериализаторе, развернутые объекты входят в ответ всегда
+        expand = list(dict.fromkeys(expand))
+        return [name for name in serializer_class.Meta.fields if name in fields or name in expand], expand
+
+    def get_serializer(self, *args, **kwargs):
+        if self.action in self.sparse_actions:
+            kwargs['fields'], kwargs['expand'] = self.sparse_fieldset
+        return super().get_serializer(*args, **kwargs)
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action in self.sparse_actions:
+            queryset = self.get_sparse_queryset(queryset, *self.sparse_fieldset)
+        return queryset
+
+    def get_sparse_queryset(self, queryset, fields: list[str], expand: list[str]):
+        if expand:
+            queryset = queryset.select_related(*expand)
+        columns = self.get_serializer_class().get_columns(fields, expand)
+        return queryset.only(*columns, *self.sparse_required_columns)
+
+
+class BlogCRUD(ConditionalGetMixin, SparseFieldsetMixin, ModelViewSet):
     ''' CRUD операции с записями блога '''
-    queryset = Blog.objects.all()
+    # Первая страница комментариев всех записей страницы - одним запросом (оконная функция по to_blog).
+    # to_blog_id в начале сортировки совпадает с порядком индекса comment_blog_created_idx: без него весь результат
+    # пересортировывается по (created, id). Именно колонка: to_blog добавил бы сортировку Blog по умолчанию и JOIN
+    queryset = Blog.objects.prefetch_related(Prefetch(
+        'comments',
+        queryset=Comment.objects.order_by('to_blog_id', *COMMENTS_KEYSET_ORDERING)[:COMMENTS_PER_PAGE],
+        to_attr='first_comments'))
     serializer_class = BlogSerializer
     permission_classes = [IsAuthenticatedOrReadOnlyPlusOwnerControl, ]
+    pagination_class = BlogKeysetPagination
+    sparse_required_columns = ('created', )
+
+    def get_page_cache_namespaces(self):
+        if self.action == 'list':
+            return ['blogs']
+        if self.action in ('retrieve', 'comments'):
+            return [f'blog:{self.kwargs["pk"]}']
+        return []
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action == 'list' and self.request.query_params.get('q'):
+            queryset = search_blogs(queryset, self.request.query_params['q'])
+        return queryset
+
+    def get_sparse_queryset(self, queryset, fields, expand):
+        # Без поля comments первая страница комментариев не запрашивается
+        if 'comments' not in fields:
+            queryset = queryset.prefetch_related(None)
+        return super().get_sparse_queryset(queryset, fields, expand)
+
+    def list(self, request, *args, **kwargs):
+        if request.query_params.get('q'):
+            self.pagination_class = BlogSearchPagination
+        return super().list(request, *args, **kwargs)
 
     def perform_create(self, serializer):
         serializer.save(author=self.request.user)
@@ -33,11 +162,39 @@ class BlogCRUD(ModelViewSet):
 
         serializer = CommentSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        serializer.save(to_blog=blog, author=request.user)
+        # Комментарий, счетчики и письмо автору записи (сигналы) - одной транзакцией
+        with transaction.atomic():
+            serializer.save(to_blog=blog, author=request.user)
 
+        # Счетчик увеличен в БД (F()), у прочитанной до комментария записи он прежний
+        blog.refresh_from_db(fields=['comments_count'])
         blog_serializer = BlogSerializer(blog)
         return Response(blog_serializer.data, status=status.HTTP_201_CREATED)
 
+    @action(methods=[HTTPMethod.GET, ], detail=True, pagination_class=CommentKeysetPagination)
+    def comments(self, request, pk):
+        ''' Комментарии к записи постранично, по курсору '''
+        blog = get_object_or_404(Blog, id=pk)
+
+        page = self.paginate_queryset(Comment.objects.filter(to_blog=blog))
+        serializer = CommentSerializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+
+class AsyncBlogCRUD(async_mixins.ListModelMixin, async_mixins.RetrieveModelMixin, AsyncGenericViewSet, BlogCRUD):
+    ''' BlogCRUD для профиля ASGI (adrf): list и retrieve асинхронные, остальные действия выполняются в потоке.
+    Аутентификация, троттлинг и проверка ETag (initial) - тоже в потоке
+    '''
+    pagination_class = AsyncBlogKeysetPagination
+
+    async def list(self, request, *args, **kwargs):
+        if request.query_params.get('q'):
+            self.pagination_class = AsyncBlogSearchPagination
+        return await self.alist(request, *args, **kwargs)
+
+    async def retrieve(self, request, *args, **kwargs):
+        return await self.aretrieve(request, *args, **kwargs)
+
 
 class CommentDelete(DestroyAPIView):
     ''' Представление для удаления комментария '''
@@ -46,13 +203,30 @@ class CommentDelete(DestroyAPIView):
     lookup_url_kwarg = 'comment_id'
 
 
-class BloggersListRetrieve(ModelViewSet):
+class BloggersListRetrieve(ConditionalGetMixin, SparseFieldsetMixin, ModelViewSet):
     ''' Представление для получения отдельного блоггера либо списка блоггеров '''
     http_method_names = ['get', 'patch']
-    queryset = User.objects.all()
+    # Записи блогеров подгружаются одним запросом на страницу, а не запросом на каждого блогера
+    queryset = User.objects.select_related('blogger').prefetch_related(
+        Prefetch('blogs', queryset=Blog.objects.only('id', 'title', 'created', 'comments_count', 'author'))
+    ).order_by('id')
     serializer_class = BloggerSerializer
     lookup_field = 'id'
-    pagination_class = None
+
+    def get_page_cache_namespaces(self):
+        # В списке у каждого блогера есть его записи с числом комментариев
+        if self.action == 'list':
+            return ['bloggers', 'blogs']
+        if self.action == 'retrieve':
+            return [f'blogger:{self.kwargs["id"]}']
+        return []
+
+    def get_sparse_queryset(self, queryset, fields, expand):
+        if 'blogger' not in fields:
+            queryset = queryset.select_related(None)
+        if 'blogs' not in fields:
+            queryset = queryset.prefetch_related(None)
+        return super().get_sparse_queryset(queryset, fields, expand)
 
     def partial_update(self, request, *args, **kwargs):
         # Вынужденное решение. Чтобы не выносить profile в отдельный класс. Нужно, чтобы вьюсет разрешал patch-запросы
@@ -150,3 +324,32 @@ class BlogDetailAPIView(APIView):
         blog = self.blog_entry_retrieve(id)
         blog.delete()
         return Response({'status': 'object deleted'}, status=status.HTTP_204_NO_CONTENT)
+
+
+class DatabaseStats(APIView):
+    ''' Состояние соединений с БД процесса, обработавшего запрос - для подбора размера пула.
+    Для пула - статистика psycopg_pool (размер, свободные соединения, ожидание выдачи), иначе настройки постоянных соединений
+    '''
+    permission_classes = [IsAdminUser, ]
+
+    def get(self, request):
+        stats = {}
+        for connection in connections.all():
+            if connection.pool is not None:
+                stats[connection.alias] = {'mode': 'pool', **connection.pool.get_stats()}
+            else:
+                stats[connection.alias] = {
+                    'mode': 'persistent' if connection.settings_dict['CONN_MAX_AGE'] else 'per request',
+                    'conn_max_age': connection.settings_dict['CONN_MAX_AGE'],
+                    'health_checks': connection.settings_dict['CONN_HEALTH_CHECKS'],
+                    'connected': connection.connection is not None,
+                }
+        return Response(stats)
+
+
+class CacheStats(APIView):
+    ''' Счетчики кэша с защитой от одновременного пересчета (main.stampede) процесса, обработавшего запрос '''
+    permission_classes = [IsAdminUser, ]
+
+    def get(self, request):
+        return Response({'pid': os.getpid(), 'stampede': stampede.stats()})
@@ -0,0 +1,116 @@
+from asgiref.sync import sync_to_async
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from main.constants import BLOGS_KEYSET_ORDERING, COMMENTS_KEYSET_ORDERING, COMMENTS_PER_PAGE, SEARCH_KEYSET_ORDERING
+from main.pagination import InvalidCursor, KeysetPaginator, approximate_count
+
+
+class ApproximateCountPagination(LimitOffsetPagination):
+    ''' LimitOffset, для больших таблиц count - оценка без COUNT(*) (см. approximate_count), точное число - с count=exact '''
+    count_query_param = 'count'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.exact_count = request.query_params.get(self.count_query_param) == 'exact'
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_count(self, queryset):
+        if self.exact_count:
+            return super().get_count(queryset)
+        return approximate_count(queryset)[0]
+
+
+class BlogKeysetPagination(ApproximateCountPagination):
+    ''' LimitOffset по умолчанию, keyset-пагинация при наличии параметра cursor (пустой - первая страница).
+    В режиме курсора общее число записей считается только с параметром count
+    '''
+    cursor_query_param = 'cursor'
+    ordering = BLOGS_KEYSET_ORDERING
+
+    def use_keyset(self, request):
+        return self.cursor_query_param in request.query_params
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset_mode = self.use_keyset(request)
+        if not self.keyset_mode:
+            return super().paginate_queryset(queryset, request, view)
+
+        paginator = self.get_keyset_paginator(queryset, request)
+        try:
+            self.page = paginator.get_page(**self.get_keyset_page_kwargs(request))
+        except InvalidCursor:
+            raise NotFound('Invalid cursor')
+        return self.page.object_list
+
+    def get_keyset_paginator(self, queryset, request) -> KeysetPaginator:
+        self.request = request
+        return KeysetPaginator(queryset, self.get_limit(request), self.ordering)
+
+    def get_keyset_page_kwargs(self, request) -> dict:
+        return {'cursor': request.query_params.get(self.cursor_query_param),
+                'with_count': self.count_query_param in request.query_params,
+                'exact_count': request.query_params.get(self.count_query_param) == 'exact'}
+
+    def get_paginated_response(self, data):
+        if not self.keyset_mode:
+            return super().get_paginated_response(data)
+
+        response = {}
+        if self.page.count is not None:
+            response['count'] = self.page.count
+        response['next'] = self.get_cursor_link(self.page.next_cursor)
+        response['previous'] = self.get_cursor_link(self.page.prev_cursor)
+        response['results'] = data
+        return Response(response)
+
+    def get_cursor_link(self, cursor):
+        if cursor is None:
+            return None
+        url = remove_query_param(self.request.build_absolute_uri(), self.offset_query_param)
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+
+class CommentKeysetPagination(BlogKeysetPagination):
+    ''' Комментарии к записи - всегда keyset-пагинация в порядке (created, id), limit не больше страницы '''
+    default_limit = COMMENTS_PER_PAGE
+    max_limit = COMMENTS_PER_PAGE
+    ordering = COMMENTS_KEYSET_ORDERING
+
+    def use_keyset(self, request):
+        return True
+
+
+class BlogSearchPagination(BlogKeysetPagination):
+    ''' Результаты поиска - всегда keyset-пагинация по убыванию релевантности '''
+    ordering = SEARCH_KEYSET_ORDERING
+
+    def use_keyset(self, request):
+        return True
+
+
+class AsyncKeysetPaginationMixin:
+    ''' Асинхронная пагинация для представлений adrf (профиль ASGI): страница по курсору выбирается асинхронным API ORM.
+    LimitOffset DRF выполняется целиком в потоке
+    '''
+
+    async def paginate_queryset(self, queryset, request, view=None):
+        if not self.use_keyset(request):
+            return await sync_to_async(super().paginate_queryset)(queryset, request, view)
+
+        self.keyset_mode = True
+        paginator = self.get_keyset_paginator(queryset, request)
+        try:
+            self.page = await paginator.aget_page(**self.get_keyset_page_kwargs(request))
+        except InvalidCursor:
+            raise NotFound('Invalid cursor')
+        return self.page.object_list
+
+
+class AsyncBlogKeysetPagination(AsyncKeysetPaginationMixin, BlogKeysetPagination):
+    pass
+
+
+class AsyncBlogSearchPagination(AsyncKeysetPaginationMixin, BlogSearchPagination):
+    pass
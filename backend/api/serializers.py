@@ -1,10 +1,52 @@
 from django.contrib.auth import get_user_model
+from django.core.validators import validate_image_file_extension
+from django.urls import reverse
+from django.utils.functional import cached_property
 from rest_framework import serializers
 
-from main.models import Blog, Blogger, Comment
+from main.constants import COMMENTS_KEYSET_ORDERING, COMMENTS_PER_PAGE
+from main.images import image_status, srcsets
+from main.models import Blog, Blogger, BloggerStats, Comment
 
 User = get_user_model()
 
+
+class SparseFieldsetSerializer(serializers.ModelSerializer):
+    ''' ModelSerializer с выбором полей ответа (параметры fields и expand, см. api.cbviews.SparseFieldsetMixin):
+    fields - только перечисленные поля из Meta.fields, expand - связанные объекты целиком (expandable_fields):
+    вместо id или дополнительно к остальным полям
+    '''
+    # Колонки модели, которые читает поле, если они не совпадают с его именем. Пустой список - связь,
+    # ее подгружает представление
+    field_columns: dict[str, list[str]] = {}
+    # Поле expand -> сериализатор связанного объекта и колонки, которые он читает
+    expandable_fields: dict[str, tuple[type[serializers.Serializer], list[str]]] = {}
+
+    def __init__(self, *args, fields=None, expand=(), **kwargs):
+        self.requested_fields = fields
+        self.expand = expand
+        super().__init__(*args, **kwargs)
+
+    def get_fields(self):
+        fields = super().get_fields()
+        for name in self.expand:
+            fields[name] = self.expandable_fields[name][0](read_only=True)
+        if self.requested_fields is not None:
+            fields = {name: field for name, field in fields.items()
+                      if name in self.requested_fields or name in self.expand}
+        return fields
+
+    @classmethod
+    def get_columns(cls, fields: list[str], expand: list[str]) -> list[str]:
+        ''' Колонки для only(): только то, что прочитают поля ответа '''
+        columns = []
+        for name in fields:
+            columns += cls.field_columns.get(name, [name])
+        for name in expand:
+            columns += cls.expandable_fields[name][1]
+        return list(dict.fromkeys(columns))
+
+
 class CommentSerializer(serializers.ModelSerializer):
     author = serializers.PrimaryKeyRelatedField(read_only=True)
 
@@ -13,38 +55,118 @@ class CommentSerializer(serializers.ModelSerializer):
         fields = ['id', 'text', 'created', 'author']
 
 
-class BlogSerializer(serializers.ModelSerializer):
+class SrcsetField(serializers.Field):
+    ''' srcset производных изображения по форматам (main.images) из поля *_variants модели '''
+
+    def __init__(self, image_field, **kwargs):
+        self.image_field = image_field
+        kwargs['source'] = '*'
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, obj):
+        file = getattr(obj, self.image_field)
+        request = self.context.get('request')
+        # Абсолютные адреса, как у самого поля изображения
+        url = file.storage.url if request is None else lambda name: request.build_absolute_uri(file.storage.url(name))
+        return srcsets(getattr(obj, f'{self.image_field}_variants'), file.name, url)
+
+
+class ImageStatusField(serializers.Field):
+    ''' Состояние фоновой обработки изображения: processing, ready или failed '''
+
+    def __init__(self, image_field, **kwargs):
+        self.image_field = image_field
+        kwargs['source'] = '*'
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, obj):
+        return image_status(getattr(obj, f'{self.image_field}_variants'), getattr(obj, self.image_field).name)
+
+
+def uploaded_image_field(**kwargs):
+    # Файл не декодируется в запросе, его проверяет фоновый обработчик (main.jobs)
+    return serializers.FileField(required=False, validators=[validate_image_file_extension], **kwargs)
+
+
+class AuthorSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = User
+        fields = ['id', 'username']
+
+
+class BlogSerializer(SparseFieldsetSerializer):
     author = serializers.PrimaryKeyRelatedField(read_only=True)
-    comments = CommentSerializer(many=True, read_only=True)
+    comments = serializers.SerializerMethodField()
+    image = uploaded_image_field()
+    image_status = ImageStatusField('image')
+    image_srcset = SrcsetField('image')
 
     class Meta:
         model = Blog
-        fields = ['id', 'title', 'content', 'created', 'author', 'image', 'comments']
+        fields = ['id', 'title', 'content', 'created', 'author', 'image', 'image_status', 'image_srcset',
+                  'comments_count', 'comments']
+
+    field_columns = {
+        'image_status': ['image', 'image_variants'],
+        'image_srcset': ['image', 'image_variants'],
+        'comments': [],
+    }
+    expandable_fields = {'author': (AuthorSerializer, ['author__username'])}
+
+    def get_comments(self, obj: Blog):
+        # Встраиваем только первую страницу, остальные - через /blogs/{id}/comments/
+        comments = getattr(obj, 'first_comments', None)
+        if comments is None:
+            comments = obj.comments.order_by(*COMMENTS_KEYSET_ORDERING)[:COMMENTS_PER_PAGE]
+        return CommentSerializer(comments, many=True).data
 
 
 class BlogShortSerializer(serializers.ModelSerializer):
     url = serializers.SerializerMethodField()
-    comments_nr = serializers.SerializerMethodField()
+    comments_nr = serializers.IntegerField(source='comments_count', read_only=True)
 
     class Meta:
         model = Blog
         fields = ['id', 'title', 'created', 'url', 'comments_nr']
 
-    def get_url(self, obj: Blog):
-        return obj.get_absolute_url()
+    # id-метка, которая больше нигде в адресе не встретится: на ее место подставляется id записи
+    url_sentinel = 9876543210123
 
-    def get_comments_nr(self, obj: Blog):
-        return obj.comments.count()
+    @cached_property
+    def url_parts(self) -> tuple[str, str] | None:
+        # reverse() на каждую запись обходится дорого: адрес собирается из частей до и после id.
+        # Если метка почему-то встретилась в адресе не один раз - reverse() для каждой записи
+        parts = reverse('blog_details', kwargs={'blog_id': self.url_sentinel}).split(str(self.url_sentinel))
+        return tuple(parts) if len(parts) == 2 else None
+
+    def get_url(self, obj: Blog):
+        if self.url_parts is None:
+            return reverse('blog_details', kwargs={'blog_id': obj.pk})
+        prefix, suffix = self.url_parts
+        return f'{prefix}{obj.pk}{suffix}'
 
 
 class BloggerProfileSerializer(serializers.ModelSerializer):
+    avatar = uploaded_image_field()
+    avatar_status = ImageStatusField('avatar')
+    avatar_srcset = SrcsetField('avatar')
 
     class Meta:
         model = Blogger
-        fields = ['bio', 'avatar']
+        fields = ['bio', 'avatar', 'avatar_status', 'avatar_srcset']
 
 
-class BloggerSerializer(serializers.ModelSerializer):
+class BloggerStatsSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = BloggerStats
+        fields = ['blogs_count', 'comments_received', 'last_post']
+
+
+class BloggerSerializer(SparseFieldsetSerializer):
     blogs = BlogShortSerializer(read_only=True, many=True)
     blogger = BloggerProfileSerializer(many=False, read_only=True)
 
@@ -52,6 +174,14 @@ class BloggerSerializer(serializers.ModelSerializer):
         model = User
         fields = ['id', 'username', 'blogger', 'blogs']
 
+    field_columns = {
+        'blogger': ['blogger__bio', 'blogger__avatar', 'blogger__avatar_variants'],
+        'blogs': [],
+    }
+    expandable_fields = {
+        'stats': (BloggerStatsSerializer, ['stats__blogs_count', 'stats__comments_received', 'stats__last_post']),
+    }
+
 
 class BlogSimpleSerializer(serializers.Serializer):
     ''' Эксперимент с обычным сериалайзером '''
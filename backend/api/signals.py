@@ -0,0 +1,25 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from .authentication import invalidate_token, invalidate_user_tokens
+
+User = get_user_model()
+
+# Кэш токенов (CachedTokenAuthentication). Выход через djoser удаляет токен,
+# смена пароля и деактивация сохраняют пользователя
+
+
+@receiver(post_delete, sender=Token)
+def invalidate_deleted_token(sender, instance: Token, **kwargs):
+    invalidate_token(instance.key)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_changed_user_tokens(sender, instance: User, **kwargs):
+    # Вход обновляет только last_login - это не повод сбрасывать кэш
+    if kwargs.get('update_fields') == frozenset({'last_login'}):
+        return
+    invalidate_user_tokens(instance.pk)
@@ -1,10 +1,21 @@
 from http import HTTPStatus
+from io import StringIO
 from django.contrib.auth import get_user, get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from rest_framework.authtoken.models import Token
 from rest_framework.test import APITestCase
 
+from main.constants import COMMENTS_PER_PAGE
 from main.models import Blog, Blogger, Comment
+from main.storage import is_blob
+from main.tests import async_views
+from .authentication import local_tokens, token_cache_key
+from .cbviews import AsyncBlogCRUD
+from .serializers import BlogSerializer
 
 User = get_user_model()
 
@@ -22,16 +33,22 @@ ID_TO_TEST = 111
 EDITED_TITLE_SUFFIX = ' edited'
 EDITED_CONTENT_SUFFIX = ' edited'
 COMMENT_TEXT = 'This is a comment'
+COMMENTS_AMOUNT = 25
 BIO = 'blabla'
 BIO_TO_TEST = 'test bio'
 TEST_AVATAR = 'test_avatar.png'
 TEST_IMAGE = 'test_image.png'
 NUMBER_OF_TEST_USERS = 2
+QUERY_TEST_USERS = 1000
+QUERY_TEST_BLOGS_PER_USER = 50
 
 
 class TestAPIBlogs(APITestCase):
     
     def setUp(self):
+        # Троттлинг хранит историю запросов в кэше, иначе тесты упираются в лимит друг друга
+        cache.clear()
+        local_tokens.clear()
         self.user1 = User.objects.create_user(username=USERNAME1, password=PASSWORD)
         self.user2 = User.objects.create_user(username=USERNAME2, password=PASSWORD)
         Blogger.objects.create(user=self.user1, bio=BIO)
@@ -89,6 +106,56 @@ class TestAPIBlogs(APITestCase):
         self.assertEqual(response.data['count'], BULK_AMOUNT)
         self.assertIn('results', response.data.keys())
 
+    def test_blogs_list_cursor(self):
+        ''' Список записей в режиме курсора. Проверяем, что 
+        - Ответ 200, count только по запросу
+        - Проход по ссылкам next возвращает все записи без повторов
+        - Ссылка previous возвращает предыдущую страницу
+        - Битый курсор - 404
+        '''
+        response = self.client.get(reverse('blog-list'), {'cursor': ''})
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertNotIn('count', response.data.keys())
+        self.assertIsNone(response.data['previous'])
+        self.assertEqual(len(response.data['results']), 10)
+
+        response = self.client.get(reverse('blog-list'), {'cursor': '', 'count': '', 'limit': 30})
+        self.assertEqual(response.data['count'], BULK_AMOUNT)
+
+        seen, pages = [], [response.data]
+        while pages[-1]['next']:
+            pages.append(self.client.get(pages[-1]['next']).data)
+        for page in pages:
+            seen.extend(blog['id'] for blog in page['results'])
+        self.assertEqual(seen, list(Blog.objects.order_by('-created', 'id').values_list('id', flat=True)))
+
+        response = self.client.get(pages[2]['previous'])
+        self.assertEqual(response.data['results'], pages[1]['results'])
+
+        response = self.client.get(reverse('blog-list'), {'cursor': 'blabla'})
+        self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND)
+
+    def test_blogs_search(self):
+        ''' Полнотекстовый поиск. Проверяем, что
+        - Совпадение в заголовке выше совпадения в тексте
+        - Результаты отдаются keyset-страницами, ссылки next сохраняют запрос
+        '''
+        content_match = Blog.objects.create(title=TITLE, content='Zebras crossing the river', author=self.user2)
+        title_match = Blog.objects.create(title='Zebra', content=CONTENT, author=self.user2)
+
+        response = self.client.get(reverse('blog-list'), {'q': 'zebra'})
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual([blog['id'] for blog in response.data['results']], [title_match.id, content_match.id])
+        self.assertIsNone(response.data['next'])
+
+        response = self.client.get(reverse('blog-list'), {'q': 'content', 'limit': 30})
+        seen = [blog['id'] for blog in response.data['results']]
+        while response.data['next']:
+            self.assertIn('q=content', response.data['next'])
+            response = self.client.get(response.data['next'])
+            seen.extend(blog['id'] for blog in response.data['results'])
+        self.assertEqual(len(set(seen)), BULK_AMOUNT + 1)
+
     def test_blog_details(self):
         ''' Отдельная запись. Проверяем, что 
         - Аноним и авторизованный пользователь имеют доступ к данным
@@ -122,6 +189,48 @@ class TestAPIBlogs(APITestCase):
         self.assertEqual(blog.content, response.data['content'])
         self.assertEqual(blog.author.id, response.data['author'])
 
+    def test_blogs_sparse_fields(self):
+        ''' Параметры fields и expand записей. Проверяем, что 
+        - Без параметров ответ прежний
+        - В ответе только запрошенные поля, а запрос к БД не читает текст записи и не подгружает комментарии
+        - expand=author разворачивает автора тем же запросом
+        - Курсор следующей страницы работает без полей сортировки в ответе
+        - Неизвестное поле - 400
+        '''
+        blog = Blog.objects.filter(author=self.user1).first()
+        Comment.objects.create(to_blog=blog, author=self.user2, text=COMMENT_TEXT)
+
+        response = self.client.get(reverse('blog-list'))
+        self.assertEqual(list(response.data['results'][0].keys()), BlogSerializer.Meta.fields)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('blog-list'), {'fields': 'id,title', 'limit': BULK_AMOUNT})
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(len(response.data['results']), BULK_AMOUNT)
+        self.assertEqual(list(response.data['results'][0].keys()), ['id', 'title'])
+        self.assertFalse([query for query in queries if '"content"' in query['sql'] or 'main_comment' in query['sql']])
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('blog-list'), {'fields': 'title', 'expand': 'author', 'limit': BULK_AMOUNT})
+        self.assertEqual(response.data['results'][0], {
+            'title': response.data['results'][0]['title'], 'author': {'id': self.user1.id, 'username': USERNAME1}})
+        self.assertFalse([query for query in queries if '"password"' in query['sql']])
+        self.assertEqual(len([query for query in queries if 'auth_user' in query['sql']]), 1)
+
+        response = self.client.get(reverse('blog-list'), {'fields': 'title', 'cursor': '', 'limit': 30})
+        response = self.client.get(response.data['next'])
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(len(response.data['results']), 30)
+
+        response = self.client.get(reverse('blog-detail', kwargs={'pk': blog.id}), {'fields': 'title,comments'})
+        self.assertEqual(response.data['title'], blog.title)
+        self.assertEqual([comment['text'] for comment in response.data['comments']], [COMMENT_TEXT])
+        self.assertNotIn('content', response.data.keys())
+
+        response = self.client.get(reverse('blog-list'), {'fields': 'title,password', 'expand': 'comments'})
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+        self.assertEqual(set(response.data.keys()), {'fields', 'expand'})
+
     def test_blog_create(self):
         ''' Создание записи. Проверяем, что 
         - Аноним получает 403
@@ -279,6 +388,42 @@ class TestAPIBlogs(APITestCase):
         self.assertIn('author', response.data.keys())
         self.assertIn('comments', response.data.keys())
         self.assertEqual(response.data['comments'][0]['text'], COMMENT_TEXT)
+        self.assertEqual(response.data['comments_count'], 1)
+        blog.refresh_from_db()
+        self.assertEqual(blog.comments_count, 1)
+
+    def test_blog_comments_pages(self):
+        ''' Комментарии к записи. Проверяем, что 
+        - Запись содержит общее число комментариев и только первую страницу
+        - Отдельный эндпоинт отдает комментарии по курсору без повторов, limit не больше страницы
+        - Несуществующая запись - 404
+        '''
+        blog = Blog.objects.create(title=TITLE, content=CONTENT, author=self.user1)
+        for i in range(COMMENTS_AMOUNT):
+            Comment.objects.create(to_blog=blog, text=COMMENT_TEXT + str(i), author=self.user2)
+
+        response = self.client.get(reverse('blog-detail', kwargs={'pk': blog.id}))
+        self.assertEqual(response.data['comments_count'], COMMENTS_AMOUNT)
+        self.assertEqual(len(response.data['comments']), 20)
+
+        response = self.client.get(reverse('blog-list'), {'limit': 1})
+        self.assertEqual(len(response.data['results'][0]['comments']), 20)
+
+        response = self.client.get(reverse('blog-comments', kwargs={'pk': blog.id}))
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(len(response.data['results']), 20)
+        texts = [comment['text'] for comment in response.data['results']]
+        response = self.client.get(response.data['next'])
+        texts += [comment['text'] for comment in response.data['results']]
+        self.assertIsNone(response.data['next'])
+        self.assertEqual(texts, [COMMENT_TEXT + str(i) for i in range(COMMENTS_AMOUNT)])
+
+        response = self.client.get(reverse('blog-comments', kwargs={'pk': blog.id}), {'limit': 100000})
+        self.assertEqual(len(response.data['results']), COMMENTS_PER_PAGE)
+        self.assertIsNotNone(response.data['next'])
+
+        response = self.client.get(reverse('blog-comments', kwargs={'pk': ID_TO_TEST * 1000}))
+        self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND)
 
     def test_comment_delete(self):
         ''' Удаление комментария. Проверяем, что 
@@ -314,6 +459,8 @@ class TestAPIBlogs(APITestCase):
         response = self.client.delete(reverse('api-comment-delete', kwargs={'id': blog.id, 'comment_id': comment.id}), {}, format='json')
         self.assertEqual(response.status_code, HTTPStatus.NO_CONTENT)
         self.assertFalse(Comment.objects.filter(text=COMMENT_TEXT).exists())
+        blog.refresh_from_db()
+        self.assertEqual(blog.comments_count, 0)
 
     def test_bloggers_list(self):
         ''' Список блоггеров. Проверяем, что 
@@ -324,7 +471,8 @@ class TestAPIBlogs(APITestCase):
         # Аноним
         response = self.client.get(reverse('api-bloggers-list'))
         self.assertEqual(response.status_code, HTTPStatus.OK)
-        self.assertEqual(len(response.data), NUMBER_OF_TEST_USERS)
+        self.assertEqual(response.data['count'], NUMBER_OF_TEST_USERS)
+        self.assertEqual(len(response.data['results']), NUMBER_OF_TEST_USERS)
 
         # Авторизованный пользователь 
         response = self.client.post(reverse('login'), {'username': USERNAME1, 'password': PASSWORD}, format='json')
@@ -332,7 +480,56 @@ class TestAPIBlogs(APITestCase):
 
         response = self.client.get(reverse('api-bloggers-list'))
         self.assertEqual(response.status_code, HTTPStatus.OK)
-        self.assertEqual(len(response.data), NUMBER_OF_TEST_USERS)
+        self.assertEqual(response.data['count'], NUMBER_OF_TEST_USERS)
+        self.assertEqual(len(response.data['results']), NUMBER_OF_TEST_USERS)
+
+    def test_bloggers_list_queries(self):
+        ''' Число запросов списка блоггеров. Проверяем, что 
+        - На 1000 пользователей по 50 записей страница списка выполняется за 3 запроса (count, пользователи, записи).
+          Первый запрос дополнительно читает оценку размера таблицы, дальше она берется из кэша
+        - Отдельный блоггер - за 2 запроса
+        - Ссылки на записи и число комментариев верны
+        '''
+        users = User.objects.bulk_create(User(username=f'query_user_{i}') for i in range(QUERY_TEST_USERS))
+        Blog.objects.bulk_create(
+            (Blog(title=TITLE, content=CONTENT, author=user, comments_count=1)
+             for user in users for _ in range(QUERY_TEST_BLOGS_PER_USER)),
+            batch_size=BULK_BATCH * 100)
+
+        with self.assertNumQueries(4):
+            self.client.get(reverse('api-bloggers-list'), {'limit': 100})
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('api-bloggers-list'), {'limit': 100, 'offset': 10})
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(response.data['count'], QUERY_TEST_USERS + NUMBER_OF_TEST_USERS)
+        blog = response.data['results'][0]['blogs'][0]
+        self.assertEqual(len(response.data['results'][0]['blogs']), QUERY_TEST_BLOGS_PER_USER)
+        self.assertEqual(blog['url'], reverse('blog_details', kwargs={'blog_id': blog['id']}))
+        self.assertEqual(blog['comments_nr'], 1)
+
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('api-bloggers-detail', kwargs={'id': users[0].id}))
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+
+    def test_bloggers_sparse_fields(self):
+        ''' Параметры fields и expand блогеров. Проверяем, что 
+        - Без записей и профиля список выполняется без их запросов и соединений
+        - expand=stats добавляет статистику блогера
+        '''
+        # Записи setUp созданы bulk_create в обход сигналов
+        call_command('rebuild_blogger_stats', stdout=StringIO())
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('api-bloggers-list'), {'fields': 'id,username'})
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(list(response.data['results'][0].keys()), ['id', 'username'])
+        self.assertFalse([query for query in queries
+                          if 'main_blog' in query['sql'] or 'main_blogger' in query['sql'] or '"password"' in query['sql']])
+
+        response = self.client.get(reverse('api-bloggers-detail', kwargs={'id': self.user1.id}),
+                                   {'fields': 'username,blogger', 'expand': 'stats'})
+        self.assertEqual(response.data['blogger']['bio'], BIO)
+        self.assertEqual(response.data['stats']['blogs_count'], BULK_AMOUNT)
+        self.assertNotIn('blogs', response.data.keys())
 
     def test_bloggers_details(self):
         ''' Отдельная запись блоггера. Проверяем, что 
@@ -400,9 +597,138 @@ class TestAPIBlogs(APITestCase):
             self.assertEqual(USERNAME1, response.data['username'])
             self.assertEqual(BIO_TO_TEST, response.data['blogger']['bio'])
             user.refresh_from_db()
-            self.assertEqual(user.blogger.avatar, 'avatars/' + TEST_AVATAR)
+            self.assertTrue(is_blob(user.blogger.avatar.name))
 
             blogger = user.blogger
-            blogger.avatar.delete()
+            with self.captureOnCommitCallbacks(execute=True):
+                blogger.avatar.delete()
 
 
+
+    def test_conditional_get(self):
+        ''' ETag ответов чтения. Проверяем, что 
+        - Повторный запрос с If-None-Match получает 304 без запросов к БД (токен уже в кэше)
+        - После нового комментария меняются ETag записи, списка записей и автора записи
+        '''
+        blog = Blog.objects.filter(author=self.user1).first()
+        response = self.client.post(reverse('login'), {'username': USERNAME2, 'password': PASSWORD}, format='json')
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + response.data['auth_token'])
+
+        urls = {
+            'blogs': reverse('blog-list'),
+            'blog': reverse('blog-detail', kwargs={'pk': blog.id}),
+            'comments': reverse('blog-comments', kwargs={'pk': blog.id}),
+            'bloggers': reverse('api-bloggers-list'),
+            'blogger': reverse('api-bloggers-detail', kwargs={'id': self.user1.id}),
+        }
+        etags = {}
+        for name, url in urls.items():
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, HTTPStatus.OK)
+            etags[name] = response['ETag']
+            with self.assertNumQueries(0):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etags[name])
+            self.assertEqual(response.status_code, HTTPStatus.NOT_MODIFIED, name)
+            self.assertEqual(response.content, b'')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('blog-comment', kwargs={'pk': blog.id}), {'text': COMMENT_TEXT}, format='json')
+        for name, url in urls.items():
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etags[name])
+            self.assertEqual(response.status_code, HTTPStatus.OK, name)
+            self.assertNotEqual(response['ETag'], etags[name])
+
+    def test_cached_token_auth(self):
+        ''' Кэш токенов. Проверяем, что 
+        - Повторная аутентификация токеном не обращается к БД (из памяти процесса и из общего кэша)
+        - Хэш пароля в общий кэш не попадает
+        - Смена пароля и деактивация сбрасывают кэш, неактивный пользователь получает 401
+        - После выхода токен больше не принимается
+        '''
+        url = reverse('api-bloggers-detail', kwargs={'id': self.user1.id})
+        response = self.client.post(reverse('login'), {'username': USERNAME1, 'password': PASSWORD}, format='json')
+        token = response.data['auth_token']
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token)
+        etag = self.client.get(url)['ETag']
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, HTTPStatus.NOT_MODIFIED)
+        self.user1.refresh_from_db()
+        self.assertNotIn(self.user1.password, repr(cache.get(token_cache_key(token))))
+        local_tokens.clear()
+        with self.assertNumQueries(0):
+            self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('user-set-password'),
+                                        {'current_password': PASSWORD, 'new_password': PASSWORD + '2'}, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.NO_CONTENT)
+        self.assertIsNone(cache.get(token_cache_key(token)))
+
+        self.client.get(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user1.refresh_from_db()
+            self.user1.is_active = False
+            self.user1.save()
+        self.assertEqual(self.client.get(url).status_code, HTTPStatus.UNAUTHORIZED)
+
+        User.objects.filter(pk=self.user1.pk).update(is_active=True)
+        self.client.get(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('logout'), {}, format='json')
+        self.assertEqual(response.status_code, HTTPStatus.NO_CONTENT)
+        self.assertEqual(self.client.get(url).status_code, HTTPStatus.UNAUTHORIZED)
+
+    def test_db_stats(self):
+        ''' Статистика соединений с БД. Проверяем, что 
+        - Обычный пользователь получает 403
+        - Администратор получает режим соединений для каждой базы
+        '''
+        self.client.force_authenticate(self.user1)
+        response = self.client.get(reverse('api-db-stats'))
+        self.assertEqual(response.status_code, HTTPStatus.FORBIDDEN)
+
+        admin = User.objects.create_superuser(username=USERNAME3, password=PASSWORD)
+        self.client.force_authenticate(admin)
+        response = self.client.get(reverse('api-db-stats'))
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertIn(response.data['default']['mode'], ['pool', 'persistent', 'per request'])
+
+    def test_cache_stats(self):
+        ''' Счетчики кэша доступны только администратору '''
+        self.client.force_authenticate(self.user1)
+        self.assertEqual(self.client.get(reverse('api-cache-stats')).status_code, HTTPStatus.FORBIDDEN)
+
+        admin = User.objects.create_superuser(username=USERNAME3, password=PASSWORD)
+        self.client.force_authenticate(admin)
+        response = self.client.get(reverse('api-cache-stats'))
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(set(response.data['stampede']), {'hit', 'miss', 'stale', 'early'})
+
+    def test_throttling(self):
+        ''' Троттлинг. Проверяем, что 
+        - Аноним получает 429 с Retry-After после 10 запросов в минуту
+        - В кэше хранятся счетчики окна, а не список времен запросов
+        '''
+        for _ in range(10):
+            self.assertEqual(self.client.get(reverse('api-bloggers-list')).status_code, HTTPStatus.OK)
+        response = self.client.get(reverse('api-bloggers-list'))
+        self.assertEqual(response.status_code, HTTPStatus.TOO_MANY_REQUESTS)
+        self.assertIn('Retry-After', response)
+        self.assertIsNone(cache.get('throttle_anon_127.0.0.1'))
+
+
+class TestAPIBlogsAsync(TestAPIBlogs):
+    ''' Проверки TestAPIBlogs в профиле ASGI: записи обслуживает AsyncBlogCRUD (adrf) '''
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.enterClassContext(async_views())
+
+    def test_async_viewset(self):
+        for url in (reverse('blog-list'), reverse('blog-detail', kwargs={'pk': Blog.objects.first().id})):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, HTTPStatus.OK)
+            self.assertIs(response.resolver_match.func.cls, AsyncBlogCRUD)
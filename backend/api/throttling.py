@@ -0,0 +1,32 @@
+from rest_framework import throttling
+
+from main.rate_limit import client_ip, hit
+
+
+class SharedStoreThrottleMixin:
+    ''' Троттлинг DRF на счетчиках скользящего окна (main.rate_limit) вместо списка времен запросов в кэше:
+    постоянная память и атомарное обновление, лимит общий для всех воркеров при общем кэше
+    '''
+
+    def get_ident(self, request):
+        return client_ip(request)
+
+    def allow_request(self, request, view):
+        if self.rate is None:
+            return True
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+        self.result = hit(self.key, self.num_requests, self.duration)
+        return self.result.allowed
+
+    def wait(self):
+        return self.result.wait
+
+
+class AnonRateThrottle(SharedStoreThrottleMixin, throttling.AnonRateThrottle):
+    pass
+
+
+class UserRateThrottle(SharedStoreThrottleMixin, throttling.UserRateThrottle):
+    pass
@@ -1,12 +1,14 @@
+from django.conf import settings
 from django.urls import include, path, re_path
 from rest_framework.routers import SimpleRouter
 
-from .cbviews import BlogCRUD, CommentDelete, BloggersListRetrieve
+from .cbviews import AsyncBlogCRUD, BlogCRUD, CommentDelete, BloggersListRetrieve, CacheStats, DatabaseStats
 
 
 router = SimpleRouter(use_regex_path=False)
 
-router.register('blogs', BlogCRUD)
+# Профиль ASGI: список и чтение записей - асинхронные
+router.register('blogs', AsyncBlogCRUD if settings.ASYNC_VIEWS else BlogCRUD, basename='blog')
 
 router.register('bloggers', BloggersListRetrieve, basename='api-bloggers')
 
@@ -14,6 +16,8 @@ urlpatterns = [
     re_path(r'^v1/auth/', include('djoser.urls')),
     re_path(r'^v1/auth/', include('djoser.urls.authtoken')),
     path('v1/blogs/<int:id>/comment/<int:comment_id>/', CommentDelete.as_view(), name='api-comment-delete'),
+    path('v1/db-stats/', DatabaseStats.as_view(), name='api-db-stats'),
+    path('v1/cache-stats/', CacheStats.as_view(), name='api-cache-stats'),
     # path('v1/bloggers/<int:id>/', BloggersListRetrieve.as_view({'get': 'retrieve'})),
     # path('v1/bloggers/', BloggersListRetrieve.as_view({'get': 'list'})),
     path('v1/', include(router.urls)),
@@ -1,21 +1,22 @@
-import os # noqa
-
+from django.conf import settings
 from django.contrib.auth import logout
 from django.contrib.auth.forms import AuthenticationForm, UserCreationForm
 from django.contrib.auth.views import LoginView, LogoutView
-from django.core.mail import send_mail # noqa
 from django.shortcuts import redirect
 from django.urls import reverse_lazy
 from django.views.generic.edit import CreateView, FormView
 from dotenv import load_dotenv
 
 from .forms import ContactForm
-from main.models import Blogger
+from main.models import Blogger, OutboxEmail
+from main.outbox import enqueue_email
+from main.rate_limit import RateLimitMixin
 
 load_dotenv()
 
-class SignupView(CreateView):
+class SignupView(RateLimitMixin, CreateView):
     form_class = UserCreationForm
+    rate_limit_scope = 'signup'
     template_name = 'form.html'
     extra_context = {'title': 'Signup page'}
     success_url = reverse_lazy('mylogin')
@@ -40,23 +41,17 @@ class LogoutUser(LogoutView):
         return redirect('index')
 
 
-class ContactsFormView(FormView):
+class ContactsFormView(RateLimitMixin, FormView):
     template_name = 'form.html'
     form_class = ContactForm
+    rate_limit_scope = 'contact'
     success_url = reverse_lazy('index')
     extra_context = {'title': 'Contact form'}
 
     def form_valid(self, form):
-        message = form.cleaned_data['message']
-
-        # Отправка писем отключена, надоело получать
-
-        # send_mail(
-        #     subject='Message from contact form',
-        #     message=message,
-        #     from_email=os.getenv('FROM_EMAIL'),
-        #     recipient_list=[os.getenv('FROM_EMAIL'), ],
-        #     fail_silently=True,
-        # )
-
+        # Письмо отправит обработчик очереди (команда send_emails), запрос SMTP не ждет.
+        # Почта не настроена - сообщение отправлять некуда
+        if settings.CONTACT_EMAIL:
+            enqueue_email(OutboxEmail.Kind.CONTACT, settings.CONTACT_EMAIL,
+                          subject='Message from contact form', body=form.cleaned_data['message'])
         return super().form_valid(form)
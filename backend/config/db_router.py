@@ -0,0 +1,132 @@
+import hashlib
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# Разрешено ли текущему запросу (или блоку replica_reads) читать с реплик и была ли в нем запись
+_replica_reads = ContextVar('replica_reads', default=False)
+_wrote = ContextVar('wrote', default=False)
+
+
+@contextmanager
+def replica_reads():
+    ''' Чтения внутри блока идут на реплики, например, для отчетов в management-командах '''
+    replica_token = _replica_reads.set(True)
+    wrote_token = _wrote.set(False)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(replica_token)
+        _wrote.reset(wrote_token)
+
+
+class ReplicaRouter:
+    ''' Запись - всегда в primary (default), чтение - на случайную реплику из DATABASE_REPLICAS,
+    если это разрешено middleware или replica_reads(). Чтение остается на primary:
+    - после первой записи в текущем запросе
+    - внутри транзакции (иначе она не увидит собственных изменений)
+    '''
+
+    def db_for_read(self, model, **hints):
+        if not settings.DATABASE_REPLICAS or not _replica_reads.get() or _wrote.get():
+            return DEFAULT_DB_ALIAS
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return random.choice(settings.DATABASE_REPLICAS)
+
+    def db_for_write(self, model, **hints):
+        _wrote.set(True)
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Реплики содержат те же данные, что и primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Схема на реплики приходит репликацией
+        return db == DEFAULT_DB_ALIAS
+
+
+class ReplicaRoutingMiddleware:
+    ''' Безопасные запросы читают с реплик. После записи клиент на DB_PIN_SECONDS закрепляется за primary,
+    чтобы видеть собственные изменения несмотря на отставание реплик:
+    браузер - через cookie, API-клиент с токеном - через отметку в кэше по заголовку Authorization.
+    Под ASGI работает асинхронно, иначе Django выполнял бы всю цепочку после нее в отдельном потоке на каждый запрос
+    '''
+    cookie_name = 'db_pin'
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        replica_token = _replica_reads.set(request.method in SAFE_METHODS and not self.is_pinned(request))
+        wrote_token = _wrote.set(False)
+        try:
+            response = self.get_response(request)
+            if _wrote.get() or request.method not in SAFE_METHODS:
+                self.pin(request, response)
+        finally:
+            _replica_reads.reset(replica_token)
+            _wrote.reset(wrote_token)
+        return response
+
+    async def __acall__(self, request):
+        # Контекстные переменные наследуются задачами и потоками sync_to_async запроса, а запись в потоке
+        # возвращается в контекст запроса (asgiref), поэтому роутер видит те же значения
+        replica_token = _replica_reads.set(request.method in SAFE_METHODS and not await self.ais_pinned(request))
+        wrote_token = _wrote.set(False)
+        try:
+            response = await self.get_response(request)
+            if _wrote.get() or request.method not in SAFE_METHODS:
+                await self.apin(request, response)
+        finally:
+            _replica_reads.reset(replica_token)
+            _wrote.reset(wrote_token)
+        return response
+
+    def pin_cache_key(self, request):
+        authorization = request.headers.get('Authorization')
+        if not authorization:
+            return None
+        return 'db_pin:' + hashlib.sha256(authorization.encode()).hexdigest()
+
+    def is_pinned(self, request):
+        if self.cookie_name in request.COOKIES:
+            return True
+        key = self.pin_cache_key(request)
+        return key is not None and cache.get(key) is not None
+
+    async def ais_pinned(self, request):
+        if self.cookie_name in request.COOKIES:
+            return True
+        key = self.pin_cache_key(request)
+        return key is not None and await cache.aget(key) is not None
+
+    def pin(self, request, response):
+        if not settings.DATABASE_REPLICAS:
+            return
+        response.set_cookie(self.cookie_name, '1', max_age=settings.DB_PIN_SECONDS, httponly=True, samesite='Lax')
+        key = self.pin_cache_key(request)
+        if key is not None:
+            cache.set(key, 1, settings.DB_PIN_SECONDS)
+
+    async def apin(self, request, response):
+        if not settings.DATABASE_REPLICAS:
+            return
+        response.set_cookie(self.cookie_name, '1', max_age=settings.DB_PIN_SECONDS, httponly=True, samesite='Lax')
+        key = self.pin_cache_key(request)
+        if key is not None:
+            await cache.aset(key, 1, settings.DB_PIN_SECONDS)
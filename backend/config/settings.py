@@ -40,6 +40,7 @@ if DEBUG:
 INSTALLED_APPS.append('django_cleanup.apps.CleanupConfig')
 
 MIDDLEWARE = [
+    'config.db_router.ReplicaRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -63,7 +64,8 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
-                'django.template.context_processors.media'
+                'django.template.context_processors.media',
+                'main.context_processors.fragment_cache',
             ],
         },
     },
@@ -71,6 +73,11 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'config.wsgi.application'
 
+# Профиль сервера (gunicorn.conf.py): wsgi - синхронные воркеры с потоками, asgi - воркеры uvicorn с event loop,
+# страницы и API чтения обслуживают асинхронные версии представлений (main.urls, api.urls)
+SERVER_PROFILE = os.getenv('SERVER_PROFILE', 'wsgi')
+ASYNC_VIEWS = SERVER_PROFILE == 'asgi'
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.postgresql',
@@ -82,6 +89,43 @@ DATABASES = {
     }
 }
 
+# Соединения с БД. DB_POOL=True - пул psycopg в каждом процессе (имеет смысл при нескольких потоках в воркере),
+# иначе постоянное соединение на поток живет DB_CONN_MAX_AGE секунд (0 - новое соединение на каждый запрос).
+# Перед использованием соединение проверяется, максимальное время жизни ограничено в обоих режимах.
+# В профиле asgi пул включен по умолчанию: запросы выполняются в разных потоках, постоянные соединения там не переиспользуются
+DB_POOL = os.getenv('DB_POOL', str(ASYNC_VIEWS)) == 'True'
+if DB_POOL:
+    # Проверку соединения при выдаче из пула (check_connection) Django включает сам
+    DATABASES['default']['OPTIONS'] = {
+        'pool': {
+            'min_size': int(os.getenv('DB_POOL_MIN_SIZE', 2)),
+            'max_size': int(os.getenv('DB_POOL_MAX_SIZE', 10)),
+            'max_lifetime': int(os.getenv('DB_CONN_MAX_LIFETIME', 1800)),
+            'max_idle': int(os.getenv('DB_POOL_MAX_IDLE', 600)),
+            'timeout': int(os.getenv('DB_POOL_TIMEOUT', 10)),
+        },
+    }
+else:
+    DATABASES['default']['CONN_MAX_AGE'] = int(os.getenv('DB_CONN_MAX_AGE', 60))
+    DATABASES['default']['CONN_HEALTH_CHECKS'] = True
+
+# Реплики только для чтения: DB_REPLICA_HOSTS='host1 host2:5433', остальные параметры как у default
+DATABASE_REPLICAS = []
+for number, replica_host in enumerate(os.getenv('DB_REPLICA_HOSTS', '').split(), start=1):
+    host, _, port = replica_host.rpartition(':') if ':' in replica_host else (replica_host, '', '')
+    DATABASES[f'replica{number}'] = {
+        **DATABASES['default'],
+        'HOST': host,
+        'PORT': port or DATABASES['default']['PORT'],
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append(f'replica{number}')
+
+DATABASE_ROUTERS = ['config.db_router.ReplicaRouter']
+
+# Сколько секунд после записи клиент читает с primary (read-your-writes)
+DB_PIN_SECONDS = int(os.getenv('DB_PIN_SECONDS', 5))
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -111,8 +155,73 @@ STATIC_ROOT = 'collectedstatic/'
 MEDIA_ROOT = BASE_DIR / 'media'
 MEDIA_URL = '/media/'
 
+# Загрузки хранятся по хэшу содержимого (main.storage): одинаковые файлы - один раз на диске.
+# Статика после collectstatic - с хэшем содержимого в именах и сжатыми копиями .gz/.br рядом
+STORAGES = {
+    'default': {
+        'BACKEND': 'main.storage.ContentAddressedStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'main.storage.CompressedManifestStaticFilesStorage',
+    },
+}
+# Сколько секунд повторно загруженный файл не удаляется, даже если ссылок на него нет:
+# ссылка из загрузки может быть еще не сохранена. Такие файлы потом удаляет команда dedupe_media
+MEDIA_REUSE_GRACE_SECONDS = int(os.getenv('MEDIA_REUSE_GRACE_SECONDS', 600))
+
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Общий для всех воркеров кэш (Redis): CACHE_URL='redis://host:6379/0'. Без него - локальный кэш процесса,
+# в котором кэш страниц и лимиты запросов у каждого воркера свои
+CACHE_URL = os.getenv('CACHE_URL')
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': CACHE_URL,
+    } if CACHE_URL else {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Фрагменты шаблонов (тег cache) - в памяти процесса: ключ содержит версию объекта,
+    # поэтому закэшированный фрагмент никогда не устаревает и общий кэш не нужен
+    'template_fragments': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'template_fragments',
+        'OPTIONS': {'MAX_ENTRIES': int(os.getenv('FRAGMENT_CACHE_ENTRIES', 10_000))},
+    },
+}
+FRAGMENT_CACHE_SECONDS = int(os.getenv('FRAGMENT_CACHE_SECONDS', 3600))
+
+# Версия приложения (например, хэш коммита) входит в ETag страниц: после деплоя клиенты получат новую разметку
+RELEASE = os.getenv('RELEASE', '')
+
+# Кэш токенов API: сколько секунд токен с пользователем хранится в общем кэше (0 - каждый запрос читает БД)
+# и в памяти процесса. Локальная запись не сбрасывается из других процессов, поэтому ее время жизни короткое
+TOKEN_CACHE_SECONDS = int(os.getenv('TOKEN_CACHE_SECONDS', 300))
+TOKEN_CACHE_LOCAL_SECONDS = float(os.getenv('TOKEN_CACHE_LOCAL_SECONDS', 5))
+TOKEN_CACHE_LOCAL_ENTRIES = int(os.getenv('TOKEN_CACHE_LOCAL_ENTRIES', 10_000))
+
+# Фоновая обработка изображений (команда process_images): размер пула процессов, через сколько секунд
+# незаконченное задание считается брошенным, число попыток и задержка первого повтора (дальше - вдвое больше)
+IMAGE_WORKER_PROCESSES = int(os.getenv('IMAGE_WORKER_PROCESSES', 2))
+IMAGE_JOB_TIMEOUT = int(os.getenv('IMAGE_JOB_TIMEOUT', 300))
+IMAGE_JOB_MAX_ATTEMPTS = int(os.getenv('IMAGE_JOB_MAX_ATTEMPTS', 5))
+IMAGE_JOB_RETRY_DELAY = int(os.getenv('IMAGE_JOB_RETRY_DELAY', 10))
+
+# Защита кэша от одновременного пересчета (main.stampede): сколько секунд после истечения хранится устаревшее значение,
+# сколько живет блокировка пересчета, множитель вероятности досрочного пересчета и шаг ожидания чужого пересчета
+STAMPEDE_STALE_SECONDS = int(os.getenv('STAMPEDE_STALE_SECONDS', 300))
+STAMPEDE_LOCK_SECONDS = int(os.getenv('STAMPEDE_LOCK_SECONDS', 10))
+STAMPEDE_BETA = float(os.getenv('STAMPEDE_BETA', 1.0))
+STAMPEDE_WAIT_INTERVAL = float(os.getenv('STAMPEDE_WAIT_INTERVAL', 0.05))
+
+# Сколько секунд хранится страница, закэшированная для анонимов (сбрасывается и раньше - при изменении данных), 0 - не кэшировать
+PAGE_CACHE_SECONDS = int(os.getenv('PAGE_CACHE_SECONDS', 300))
+
+# С какого размера таблицы число записей в пагинации оценивается, а не считается COUNT(*),
+# и сколько секунд кэшируется COUNT(*) для выборок с фильтрами
+APPROX_COUNT_THRESHOLD = int(os.getenv('APPROX_COUNT_THRESHOLD', 100_000))
+APPROX_COUNT_CACHE_SECONDS = int(os.getenv('APPROX_COUNT_CACHE_SECONDS', 60))
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -153,17 +262,40 @@ EMAIL_USE_SSL = True
 DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
 SERVER_EMAIL = EMAIL_HOST_USER
 EMAIL_ADMIN = EMAIL_HOST_USER
+# Письма отправляет обработчик очереди (команда send_emails), SMTP-сервер не должен подвешивать его надолго
+EMAIL_TIMEOUT = int(os.getenv('EMAIL_TIMEOUT', 30))
+# Получатель сообщений формы обратной связи и адрес сайта для ссылок в письмах
+CONTACT_EMAIL = os.getenv('FROM_EMAIL', EMAIL_ADMIN)
+SITE_URL = os.getenv('SITE_URL', '')
+
+# Очередь писем (main.outbox): через сколько секунд неотправленное письмо считается брошенным, число попыток,
+# задержка первого повтора (дальше - вдвое больше) и сколько секунд уведомления о комментариях копятся,
+# чтобы уйти получателю одним письмом
+OUTBOX_TIMEOUT = int(os.getenv('OUTBOX_TIMEOUT', 300))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 8))
+OUTBOX_RETRY_DELAY = int(os.getenv('OUTBOX_RETRY_DELAY', 30))
+OUTBOX_DIGEST_DELAY = int(os.getenv('OUTBOX_DIGEST_DELAY', 600))
+
+# Сколько обратных прокси (nginx) стоит перед приложением: IP клиента для лимитов берется из X-Forwarded-For
+NUM_PROXIES = int(os.getenv('NUM_PROXIES', 0)) or None
+
+# Лимиты отправки HTML-форм (main.rate_limit) в формате DRF, на пользователя или IP
+RATE_LIMITS = {
+    'comment': os.getenv('COMMENT_RATE_LIMIT', '10/minute'),
+    'signup': os.getenv('SIGNUP_RATE_LIMIT', '5/hour'),
+    'contact': os.getenv('CONTACT_RATE_LIMIT', '5/hour'),
+}
 
 REST_FRAMEWORK = {
     'DEFAULT_RENDERER_CLASSES': [
         'rest_framework.renderers.JSONRenderer',
     ],
 
-    'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.LimitOffsetPagination',
+    'DEFAULT_PAGINATION_CLASS': 'api.pagination.ApproximateCountPagination',
     'PAGE_SIZE': 10,
 
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'api.authentication.CachedTokenAuthentication',
         ],
 
     'DEFAULT_PERMISSION_CLASSES': [
@@ -171,10 +303,12 @@ REST_FRAMEWORK = {
     ],
 
     'DEFAULT_THROTTLE_CLASSES': [
-        'rest_framework.throttling.AnonRateThrottle',
-        'rest_framework.throttling.UserRateThrottle'
+        'api.throttling.AnonRateThrottle',
+        'api.throttling.UserRateThrottle'
     ],
 
+    'NUM_PROXIES': NUM_PROXIES,
+
     'DEFAULT_THROTTLE_RATES': {
         'anon': '10/minute',
         'user': '30/minute'
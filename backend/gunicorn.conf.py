@@ -0,0 +1,15 @@
+import os
+
+# Профиль сервера (SERVER_PROFILE, его же читают настройки Django):
+# wsgi - синхронные воркеры с потоками, asgi - воркеры uvicorn, где медленный клиент или долгий запрос
+# не занимает поток, и асинхронные представления чтения
+if os.getenv('SERVER_PROFILE', 'wsgi') == 'asgi':
+    wsgi_app = 'config.asgi:application'
+    worker_class = 'uvicorn_worker.UvicornWorker'
+else:
+    wsgi_app = 'config.wsgi:application'
+    # Несколько потоков на воркер: соединения с БД (постоянные или пул) переиспользуются между запросами
+    threads = int(os.getenv('GUNICORN_THREADS', 4))
+
+workers = int(os.getenv('GUNICORN_WORKERS', 2))
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 0))
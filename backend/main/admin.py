@@ -1,6 +1,8 @@
 from django.contrib import admin
+from django.utils import timezone
 
-from .models import Blog, Blogger, Comment
+from .models import Blog, Blogger, Comment, ImageJob, OutboxEmail
+from .pagination import ApproximateCountPaginator
 
 
 class CommentInline(admin.TabularInline):
@@ -10,8 +12,39 @@ class CommentInline(admin.TabularInline):
 
 class BlogAdmin(admin.ModelAdmin):
     inlines = [CommentInline, ]
+    list_display = ['title', 'author', 'created', 'comments_count']
+    readonly_fields = ['comments_count', ]
+    # Без COUNT(*) по всей таблице на каждой странице списка
+    paginator = ApproximateCountPaginator
+    show_full_result_count = False
+
+class CommentAdmin(admin.ModelAdmin):
+    paginator = ApproximateCountPaginator
+    show_full_result_count = False
+
+class ImageJobAdmin(admin.ModelAdmin):
+    list_display = ['kind', 'object_id', 'name', 'status', 'attempts', 'run_after', 'created']
+    list_filter = ['status', 'kind']
+    readonly_fields = ['kind', 'object_id', 'name', 'started', 'last_error', 'created']
+    actions = ['retry']
+
+    @admin.action(description='Retry selected jobs')
+    def retry(self, request, queryset):
+        queryset.update(status=ImageJob.Status.PENDING, attempts=0, run_after=timezone.now())
+
+class OutboxEmailAdmin(admin.ModelAdmin):
+    list_display = ['kind', 'recipient', 'subject', 'status', 'attempts', 'run_after', 'created']
+    list_filter = ['status', 'kind']
+    readonly_fields = ['kind', 'recipient', 'subject', 'body', 'started', 'sent', 'last_error', 'created']
+    actions = ['retry']
+
+    @admin.action(description='Retry selected emails')
+    def retry(self, request, queryset):
+        queryset.update(status=OutboxEmail.Status.PENDING, attempts=0, run_after=timezone.now())
 
 
 admin.site.register(Blogger)
 admin.site.register(Blog, BlogAdmin)
-admin.site.register(Comment)
+admin.site.register(Comment, CommentAdmin)
+admin.site.register(ImageJob, ImageJobAdmin)
+admin.site.register(OutboxEmail, OutboxEmailAdmin)
@@ -1,19 +1,142 @@
+from datetime import datetime, timedelta
+from http import HTTPStatus
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.db.models import Case, Count, F, When
+from django.db import transaction
+from django.db.models import Case, F, QuerySet, When
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse, reverse_lazy
+from django.utils import timezone
 from django.views.generic import CreateView, DeleteView, DetailView, FormView, ListView, View, UpdateView
 from django.views.generic.base import TemplateView
 
-from .constants import BLOGS_PER_PAGE
-from .forms import BioForm, BloggerForm, CommentForm
-from .models import Blog, Blogger, Comment
+from .constants import (
+    BLOGGERS_DELTA_OVERLAP_SECONDS, BLOGS_KEYSET_ORDERING, BLOGS_PER_PAGE, COMMENTS_KEYSET_ORDERING, COMMENTS_PER_PAGE, SEARCH_KEYSET_ORDERING)
+from .forms import BioForm, BlogForm, BloggerForm, CommentForm
+from .live_comments import broadcaster, comments_stream, missed_comment_events
+from .models import Blog, Blogger, BloggerStats, Comment
+from .page_cache import AnonymousPageCacheMixin, ConditionalGetMixin
+from .pagination import ApproximateCountPaginator, InvalidCursor, KeysetPaginator
+from .rate_limit import RedirectRateLimitMixin
+from .search import search_blogs
 
 
 User = get_user_model()
 
 
+def comments_queryset(blog_id, user):
+    return Comment.objects.filter(to_blog=blog_id).annotate(
+        author_username=F('author__username'),
+        author_iid=F('author__id'),
+        comment_author_flag=Case(
+            When(author=user if user.is_authenticated else None, then=True),
+            default=False))
+
+
+class KeysetPaginationMixin:
+    ''' Keyset-пагинация для ListView: страница задается параметром cursor, а не номером.
+    Общее число записей для больших таблиц оценивается, точное - с параметром count=exact
+    '''
+    keyset_ordering = None
+    paginator_class = ApproximateCountPaginator
+
+    def keyset_enabled(self):
+        return True
+
+    @property
+    def exact_count(self):
+        return self.request.GET.get('count') == 'exact'
+
+    def get_paginator(self, queryset, per_page, **kwargs):
+        return super().get_paginator(queryset, per_page, exact_count=self.exact_count, **kwargs)
+
+    def paginate_queryset(self, queryset, page_size):
+        if not self.keyset_enabled():
+            return super().paginate_queryset(queryset, page_size)
+
+        paginator = KeysetPaginator(queryset, page_size, self.keyset_ordering)
+        try:
+            page = paginator.get_page(**self.get_keyset_page_kwargs())
+        except InvalidCursor:
+            raise Http404('Invalid cursor')
+        return paginator, page, page.object_list, page.has_other_pages()
+
+    async def apaginate_queryset(self, queryset, page_size):
+        if not self.keyset_enabled():
+            # Число записей для номеров страниц считается в потоке (approximate_count), строки страницы - асинхронно
+            paginator, page, object_list, is_paginated = await sync_to_async(super().paginate_queryset)(queryset, page_size)
+            page.object_list = [obj async for obj in object_list]
+            return paginator, page, page.object_list, is_paginated
+
+        paginator = KeysetPaginator(queryset, page_size, self.keyset_ordering)
+        try:
+            page = await paginator.aget_page(**self.get_keyset_page_kwargs())
+        except InvalidCursor:
+            raise Http404('Invalid cursor')
+        return paginator, page, page.object_list, page.has_other_pages()
+
+    def get_keyset_page_kwargs(self) -> dict:
+        # Число записей в режиме курсора - только по явному запросу
+        return {'cursor': self.request.GET.get('cursor'), 'with_count': 'count' in self.request.GET,
+                'exact_count': self.exact_count}
+
+
+async def evaluate_querysets(context: dict) -> dict:
+    ''' Ленивые QuerySet в контексте выполняются асинхронно заранее, шаблон получает списки '''
+    for key, value in context.items():
+        if isinstance(value, QuerySet):
+            context[key] = [obj async for obj in value]
+    return context
+
+
+class AsyncListMixin:
+    ''' Асинхронный GET для ListView (профиль ASGI): пользователь, страница и все выборки контекста
+    получаются асинхронным API ORM до сборки контекста, затем работает обычный get_context_data
+    '''
+
+    async def get(self, request, *args, **kwargs):
+        request.user = await request.auser()
+        self.object_list = self.get_queryset()
+        page_size = self.get_paginate_by(self.object_list)
+        if page_size:
+            self.async_page = await self.apaginate_queryset(self.object_list, page_size)
+        else:
+            self.object_list = [obj async for obj in self.object_list]
+        context = await self.aget_context_data()
+        return self.render_to_response(context)
+
+    def paginate_queryset(self, queryset, page_size):
+        # Страница уже выбрана в get (apaginate_queryset у KeysetPaginationMixin)
+        return self.async_page
+
+    async def aget_context_data(self, **kwargs):
+        return await evaluate_querysets(self.get_context_data(**kwargs))
+
+
+class AsyncDetailMixin:
+    ''' Асинхронный GET для DetailView (профиль ASGI), см. AsyncListMixin '''
+
+    async def get(self, request, *args, **kwargs):
+        request.user = await request.auser()
+        self.object = await self.aget_object()
+        context = await self.aget_context_data(object=self.object)
+        return self.render_to_response(context)
+
+    async def aget_object(self):
+        queryset = self.get_queryset()
+        try:
+            return await queryset.aget(pk=self.kwargs[self.pk_url_kwarg])
+        except queryset.model.DoesNotExist:
+            raise Http404(f'No {queryset.model._meta.verbose_name} found matching the query')
+
+    async def aget_context_data(self, **kwargs):
+        return await evaluate_querysets(self.get_context_data(**kwargs))
+
+
 class IndexView(TemplateView):
     http_method_names = ['get', 'head']
     template_name = 'index.html'
@@ -22,41 +145,119 @@ class IndexView(TemplateView):
         return render(request, '405.html')
 
 
-class BloggersList(ListView):
+class BloggersList(ConditionalGetMixin, AnonymousPageCacheMixin, ListView):
+    ''' Список блогеров. Кнопка "Update list" (HTMX) присылает токен since из прошлого ответа и получает
+    только строки, изменившиеся после него, - out-of-band по id строки, либо пустой 204, если изменений нет.
+    Строки обновляются на месте, новые блогеры добавляются в конец, а с ними заменяется и число блогеров в заголовке:
+    порядок и удаленные блогеры обновляются при перезагрузке страницы
+    '''
     http_method_names = ['get', 'head']
     template_name = 'bloggers_list.html'
-    model = User
+    model = BloggerStats
     context_object_name = 'bloggers'
 
+    def get_page_cache_namespaces(self):
+        return ['bloggers']
+
+    def conditional_get_enabled(self, request):
+        # Ответ с изменениями зависит от токена клиента, кэшировать и сверять его не с чем
+        return 'since' not in request.GET and super().conditional_get_enabled(request)
+
+    def page_cacheable(self, request):
+        return 'since' not in request.GET and super().page_cacheable(request)
+
+    def is_htmx(self) -> bool:
+        return self.request.path == reverse('htmx_bloggers_list')
+
+    def get_delta_since(self) -> datetime | None:
+        # Без токена или с битым токеном отдается весь список
+        if not self.is_htmx():
+            return None
+        try:
+            since = datetime.fromisoformat(self.request.GET.get('since', ''))
+        except ValueError:
+            return None
+        if timezone.is_naive(since):
+            return None
+        return since - timedelta(seconds=BLOGGERS_DELTA_OVERLAP_SECONDS)
+
     def get_queryset(self):
-        queryset = super().get_queryset()
-        queryset = queryset.annotate(
-            nr_blogs=Count('blogs'),
-            avatar=F('blogger__avatar')).order_by('-nr_blogs')
-        return queryset
+        # Токен следующего обновления - время до выборки: изменения во время нее придут в следующий раз
+        self.version = timezone.now()
+        self.since = self.get_delta_since()
+        queryset = super().get_queryset().select_related('user')
+        fields = ['blogs_count', 'avatar', 'avatar_variants', 'user__username']
+        if self.since is not None:
+            # Только изменившиеся строки - диапазон по индексу bloggerstats_updated_idx, а не вся таблица.
+            # Строки заменяются по id, так что порядок важен только для новых: в порядке появления
+            return queryset.filter(updated__gt=self.since).only(*fields, 'user__date_joined').order_by('updated')
+        # Статистика предрасчитана, порядок берется прямо из индекса bloggerstats_top_idx
+        return queryset.only(*fields).order_by('-blogs_count', 'user')
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['since'] = self.version.isoformat()
+        context['delta_since'] = self.since
+        context['htmx'] = self.is_htmx()
+        if self.since is None:
+            context['bloggers_count'] = len(context['bloggers'])
+        elif self.has_new_bloggers(context['bloggers']):
+            # Новые блогеры добавляются в конец списка - заголовок с их числом заменяется вместе с ними
+            context['bloggers_count'] = self.count_bloggers()
+        return context
+
+    def has_new_bloggers(self, bloggers) -> bool:
+        return any(blogger.user.date_joined > self.since for blogger in bloggers)
+
+    def count_bloggers(self) -> int:
+        return BloggerStats.objects.count()
 
     def get_template_names(self):
         # В случае HTMX те же данные нужно отправить в другой шаблон
-        if self.request.path == '/bloggers/htmx/':
+        if self.since is not None:
+            return 'includes/htmx_bloggers_delta.html'
+        if self.is_htmx():
             return 'includes/htmx_bloggers_list.html'
         return super().get_template_names()
 
+    def render_to_response(self, context, **response_kwargs):
+        if self.since is None:
+            return super().render_to_response(context, **response_kwargs)
+        if not context['bloggers']:
+            return HttpResponse(status=HTTPStatus.NO_CONTENT)
+        response = super().render_to_response(context, **response_kwargs)
+        # Основной ответ пустой: все строки и новый токен заменяются out-of-band
+        response['HX-Reswap'] = 'none'
+        return response
 
-class BloggerDetailView(DetailView):
+
+class BloggerDetailView(ConditionalGetMixin, AnonymousPageCacheMixin, DetailView):
     http_method_names = ['get', 'head']
     template_name = 'blogger.html'
-    queryset = User.objects.annotate(avatar=F('blogger__avatar'))
+    # Профиль и статистика приходят одним запросом вместе с пользователем
+    queryset = User.objects.select_related('blogger', 'stats')
     context_object_name = 'blogger'
     pk_url_kwarg = 'author_id'
 
+    def get_page_cache_namespaces(self):
+        return [f'blogger:{self.kwargs["author_id"]}']
+
+    def get_object(self, queryset=None):
+        blogger = super().get_object(queryset)
+        if not hasattr(blogger, 'stats'):
+            # Пользователь создан в обход сигналов: статистика считается один раз, а не выводится пустой
+            BloggerStats.objects.ensure(blogger.pk)
+            blogger = super().get_object(queryset)
+        return blogger
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['blogs'] = Blog.objects.filter(author=self.object.id).annotate(nr_comments=Count('comments')).order_by('-created')
+        context['blogs'] = Blog.objects.filter(author=self.object.id).only(
+            'title', 'created', 'comments_count').order_by('-created')
         context['bio'] = ''
         context['author_id'] = self.object.id
         try:
-            blogger_entry = Blogger.objects.get(user=self.object.id)
-            context['bio'] = blogger_entry.bio
+            context['bio'] = self.object.blogger.bio
         except Blogger.DoesNotExist:
             context['bio'] = 'The user didn\'t provide any bio' 
         context['update_bio_flag'] = self.request.user.id == self.object.id
@@ -110,52 +311,196 @@ class BloggerProfileView(LoginRequiredMixin, FormView):
         return redirect('index')
 
 
-class BlogsList(ListView):
+class BlogsList(ConditionalGetMixin, AnonymousPageCacheMixin, KeysetPaginationMixin, ListView):
     http_method_names = ['get', 'head']
     template_name = 'blogs_list.html'
     model = Blog
     ordering = ['-created', ]
     paginate_by = BLOGS_PER_PAGE
+    keyset_ordering = BLOGS_KEYSET_ORDERING
+    page_url_name = 'blogs_list'
+    htmx_url_name = 'htmx_blogs_list'
+
+    def get_page_cache_namespaces(self):
+        return ['blogs']
 
     def get_queryset(self):
         # "Retrieve everything at once if you know you will need it" (c)
         # Оптимизация числа запросов к БД
         queryset = super().get_queryset()
         from django.db.models import F
-        queryset = queryset.annotate(
-            nr_comments=Count('comments'),
+        # Текст записи (до 20000 символов) в списке не нужен
+        queryset = queryset.only('title', 'created', 'updated', 'comments_count').annotate(
             author_username=F('author__username'),
             author_iid=F('author__id'),)
         return queryset
 
+    @property
+    def cursor_mode(self):
+        # Keyset-пагинация включается параметром cursor (пустой - первая страница) и всегда для HTMX
+        return 'cursor' in self.request.GET or self.request.resolver_match.url_name == self.htmx_url_name
+
+    def keyset_enabled(self):
+        return self.cursor_mode
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['cursor_mode'] = self.cursor_mode
+        context['page_url_name'] = self.page_url_name
+        context['htmx_url_name'] = self.htmx_url_name
+        return context
+
+    def get_template_names(self):
+        # HTMX подгружает только строки следующей страницы
+        if self.request.resolver_match.url_name == self.htmx_url_name:
+            return 'includes/htmx_blogs_list.html'
+        return super().get_template_names()
+
+
+class BlogsSearch(BlogsList):
+    ''' Полнотекстовый поиск по записям, результаты по убыванию релевантности '''
+    keyset_ordering = SEARCH_KEYSET_ORDERING
+    page_url_name = 'blogs_search'
+    htmx_url_name = 'htmx_blogs_search'
 
-class BlogDetailView(DetailView):
+    @property
+    def search_query(self):
+        return self.request.GET.get('q', '').strip()
+
+    @property
+    def cursor_mode(self):
+        # OFFSET по результатам поиска не поддерживаем
+        return True
+
+    def get_queryset(self):
+        queryset = search_blogs(super().get_queryset(), self.search_query)
+        # none() сохраняет аннотацию rank, по которой строится курсор
+        return queryset if self.search_query else queryset.none()
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['search_query'] = self.search_query
+        return context
+
+
+class BlogDetailView(ConditionalGetMixin, AnonymousPageCacheMixin, DetailView):
     http_method_names = ['get', 'head']
     model = Blog
     pk_url_kwarg = 'blog_id'
     context_object_name = 'blog'
     template_name = 'blog_details.html'
 
+    def get_page_cache_namespaces(self):
+        return [f'blog:{self.kwargs["blog_id"]}']
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        context['comments'] = Comment.objects.filter(to_blog=self.object).annotate(
-            author_username=F('author__username'),
-            author_iid=F('author__id'),
-            comment_author_flag=Case(
-                When(author=self.request.user if self.request.user.is_authenticated else None, then=True),
-                default=False))
+        context['comments'] = self.get_comments()
         # Думал избавиться от лишнего запроса к БД, но DetailView записывает в контекст объект модели, а QuerySet
         # И мой любимый прием с annotate к объекту модели не прикрутишь ((
-        context['author_flag'] = self.object.author == self.request.user
+        # Сравнение по id: автор записи для этого не загружается
+        context['author_flag'] = self.object.author_id == self.request.user.id
         context['comment_form'] = CommentForm()
+        # Новые комментарии приходят по SSE (CommentsStream), поток держит только асинхронный воркер
+        context['live_comments'] = settings.ASYNC_VIEWS
+
+        return context
+
+    def get_comments_paginator(self) -> KeysetPaginator:
+        # Только первая страница комментариев, остальные подгружаются через HTMX (CommentsList)
+        comments = comments_queryset(self.object.id, self.request.user)
+        return KeysetPaginator(comments, COMMENTS_PER_PAGE, COMMENTS_KEYSET_ORDERING)
+
+    def get_comments(self):
+        return self.get_comments_paginator().get_page()
+
+
+class CommentsList(AnonymousPageCacheMixin, KeysetPaginationMixin, ListView):
+    ''' HTMX-подгрузка следующей страницы комментариев к записи '''
+    http_method_names = ['get', 'head']
+    template_name = 'includes/htmx_comments.html'
+    context_object_name = 'comments'
+    paginate_by = COMMENTS_PER_PAGE
+    keyset_ordering = COMMENTS_KEYSET_ORDERING
+
+    def get_page_cache_namespaces(self):
+        return [f'blog:{self.kwargs["blog_id"]}']
+
+    def get_queryset(self):
+        return comments_queryset(self.kwargs['blog_id'], self.request.user)
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['comments'] = context['page_obj']
+        context['blog_id'] = self.kwargs['blog_id']
         return context
 
 
+class CommentsStream(View):
+    ''' SSE-поток новых комментариев к записи (только профиль ASGI, см. main.live_comments).
+    Ответ - фрагменты includes/comment_item.html, которые расширение HTMX sse добавляет в конец списка
+    '''
+    http_method_names = ['get']
+
+    async def get(self, request, *args, **kwargs):
+        blog_id = self.kwargs['blog_id']
+        if not await Blog.objects.filter(pk=blog_id).aexists():
+            raise Http404('No blog found matching the query')
+        # Сначала подписка, потом пропущенное: комментарий между ними придет дважды, но не потеряется
+        queue = await broadcaster.subscribe(blog_id)
+        missed = await sync_to_async(missed_comment_events)(blog_id, request.headers.get('Last-Event-ID'))
+        response = StreamingHttpResponse(comments_stream(blog_id, queue, missed), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # nginx не буферизует поток
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+
+# Асинхронные версии страниц чтения для профиля ASGI (SERVER_PROFILE=asgi, main.urls): медленный клиент
+# или долгий запрос к БД не занимает воркер целиком. Кэш страниц и ETag - те же (main.page_cache)
+
+class AsyncBlogsList(AsyncListMixin, BlogsList):
+    pass
+
+
+class AsyncBloggersList(AsyncListMixin, BloggersList):
+
+    async def aget_context_data(self, **kwargs):
+        if self.since is not None and self.has_new_bloggers(self.object_list):
+            self.bloggers_count = await BloggerStats.objects.acount()
+        return await super().aget_context_data(**kwargs)
+
+    def count_bloggers(self) -> int:
+        # Посчитано заранее в aget_context_data
+        return self.bloggers_count
+
+
+class AsyncBlogDetailView(AsyncDetailMixin, BlogDetailView):
+    # Автор нужен шаблону, загружается вместе с записью
+    queryset = Blog.objects.select_related('author')
+
+    async def aget_context_data(self, **kwargs):
+        self.comments = await self.get_comments_paginator().aget_page()
+        return await super().aget_context_data(**kwargs)
+
+    def get_comments(self):
+        return self.comments
+
+
+class AsyncBloggerDetailView(AsyncDetailMixin, BloggerDetailView):
+
+    async def aget_object(self):
+        blogger = await super().aget_object()
+        if not hasattr(blogger, 'stats'):
+            await sync_to_async(BloggerStats.objects.ensure)(blogger.pk)
+            blogger = await super().aget_object()
+        return blogger
+
+
 class BlogCreateView(LoginRequiredMixin, CreateView):
     model = Blog
-    fields = ['title', 'content', 'image']
+    form_class = BlogForm
     template_name = 'form.html'
     extra_context = {'title': 'Create new blog entry'}
 
@@ -166,7 +511,7 @@ class BlogCreateView(LoginRequiredMixin, CreateView):
 
 class BlogUpdateView(UpdateView):
     model = Blog
-    fields = ['title', 'content', 'image']
+    form_class = BlogForm
     template_name = 'form.html'
     extra_context = {'title': 'Update the blog entry'}
     pk_url_kwarg = 'blog_id'
@@ -200,15 +545,18 @@ class BlogDeleteView(DeleteView):
         return context
 
 
-class CommentCreateView(LoginRequiredMixin, CreateView):
+class CommentCreateView(LoginRequiredMixin, RedirectRateLimitMixin, CreateView):
     http_method_names = ['post', ]
+    rate_limit_scope = 'comment'
     model = Comment
     form_class = CommentForm
 
     def form_valid(self, form):
         form.instance.to_blog = get_object_or_404(Blog, id=self.kwargs['blog_id'])
         form.instance.author = self.request.user
-        return super().form_valid(form)
+        # Комментарий, счетчики и письмо автору записи (сигналы) - одной транзакцией
+        with transaction.atomic():
+            return super().form_valid(form)
 
     def get_success_url(self):
         return reverse('blog_details', kwargs=self.kwargs)
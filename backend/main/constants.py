@@ -1,2 +1,34 @@
 BLOGS_PER_PAGE = 10
-DEFAULT_AVATAR_FILE_NAME = 'default_avatar.jpg'
\ No newline at end of file
+BLOGS_KEYSET_ORDERING = ('-created', 'id')
+COMMENTS_PER_PAGE = 20
+COMMENTS_KEYSET_ORDERING = ('created', 'id')
+SEARCH_CONFIG = 'english'
+SEARCH_KEYSET_ORDERING = ('-rank', 'id')
+DEFAULT_AVATAR_FILE_NAME = 'default_avatar.jpg'
+# Производные изображений (main.images): ширины, современные форматы (если их умеет Pillow)
+# и форматы для остальных браузеров - формат оригинала, если он в списке, иначе первый
+AVATAR_WIDTHS = (32, 64, 128)
+IMAGE_WIDTHS = (480, 960, 1600)
+IMAGE_VARIANT_FORMATS = ('avif', 'webp')
+IMAGE_FALLBACK_FORMATS = ('jpeg', 'png')
+IMAGE_QUALITY = {'avif': 60, 'webp': 80, 'jpeg': 85, 'png': None}
+# Хранилище загрузок по содержимому (main.storage): каталог файлов и поля, которые на них ссылаются
+MEDIA_BLOBS_DIR = 'blobs'
+MEDIA_REFERENCES = (('main.Blog', 'image'), ('main.Blogger', 'avatar'))
+# Сжатые копии .gz/.br для nginx (статика и картинки по умолчанию): форматы, которые уже сжаты, пропускаются,
+# как и файлы меньше COMPRESS_MIN_SIZE байт
+COMPRESS_SKIP_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.avif', '.woff', '.woff2', '.gz', '.br', '.zip')
+COMPRESS_MIN_SIZE = 256
+# Картинки по умолчанию, опубликованные с хэшем в имени (команда publish_default_media): имя -> копия
+DEFAULT_MEDIA_MANIFEST = 'defaults.json'
+# и описания их производных для поля *_variants: картинка по умолчанию общая, в очередь обработки она не ставится
+DEFAULT_VARIANTS_MANIFEST = 'default_variants.json'
+# Живые комментарии (main.live_comments): канал NOTIFY, интервал keepalive потока SSE, очередь подписчика
+# (не успевающий читать клиент отключается и догоняет пропущенное по Last-Event-ID) и сколько комментариев он догоняет
+LIVE_COMMENTS_CHANNEL = 'blog_comments'
+LIVE_COMMENTS_KEEPALIVE_SECONDS = 15
+LIVE_COMMENTS_QUEUE_SIZE = 100
+LIVE_COMMENTS_RECONNECT_SECONDS = 5
+# HTMX-обновление списка блогеров (BloggersList): строки, измененные позже токена since минус запас,
+# покрывающий транзакции, которые закоммитились позже отметки времени, и расхождение часов серверов
+BLOGGERS_DELTA_OVERLAP_SECONDS = 5
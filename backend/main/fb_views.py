@@ -4,9 +4,10 @@ from django.db.models import Case, Count, When
 from django.http import HttpRequest
 from django.shortcuts import get_object_or_404, redirect, render
 
-from .constants import BLOGS_PER_PAGE
+from .constants import BLOGS_PER_PAGE, COMMENTS_KEYSET_ORDERING, COMMENTS_PER_PAGE
 from .forms import BlogForm, CommentForm
 from .models import Blog, Comment
+from .pagination import KeysetPaginator
 
 User = get_user_model()
 
@@ -34,6 +35,7 @@ def blog_details(request: HttpRequest, blog_id: int, *args, **kwargs):
         comment_author_flag=Case(
             When(author=request.user if request.user.is_authenticated else None, then=True),
             default=False))
+    comments = KeysetPaginator(comments, COMMENTS_PER_PAGE, COMMENTS_KEYSET_ORDERING).get_page()
     author_flag = blog.author == request.user 
 
     comment_form = CommentForm()
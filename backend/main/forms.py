@@ -1,6 +1,14 @@
-from django.forms import CharField, FileInput, Form, ImageField, ModelForm
+from django.core.validators import validate_image_file_extension
+from django.forms import CharField, FileField, FileInput, Form, ModelForm
 
-from .models import Comment
+from .models import Blog, Comment
+
+
+class UploadedImageField(FileField):
+    ''' Поле изображения без декодирования в запросе: проверяется только расширение.
+    Файл проверяет и обрабатывает фоновый обработчик (main.jobs), не изображение заменяется картинкой по умолчанию
+    '''
+    default_validators = [validate_image_file_extension]
 
 
 class CommentForm(ModelForm):
@@ -10,9 +18,17 @@ class CommentForm(ModelForm):
         fields = ['text', ]
 
 
+class BlogForm(ModelForm):
+
+    class Meta:
+        model = Blog
+        fields = ['title', 'content', 'image']
+        field_classes = {'image': UploadedImageField}
+
+
 class BloggerForm(Form):
     bio = CharField(max_length=2000, required=False)
-    avatar = ImageField(required=False, widget=FileInput)
+    avatar = UploadedImageField(required=False, widget=FileInput)
 
 
 class BioForm(Form):
@@ -0,0 +1,196 @@
+import logging
+import posixpath
+import re
+from io import BytesIO
+
+from django.apps import apps
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+from .constants import IMAGE_FALLBACK_FORMATS, IMAGE_QUALITY, IMAGE_VARIANT_FORMATS, MEDIA_REFERENCES
+
+logger = logging.getLogger(__name__)
+
+Image.init()
+
+# Производные лежат рядом с оригиналом: images/photo.jpg -> images/photo.jpg.480w.webp.
+# Расширение оригинала остается в имени, иначе у photo.jpg и photo.png были бы общие производные
+DERIVATIVE_SUFFIX = r'\.\d+w\.[a-z]+'
+DERIVATIVE_RE = rf'^{{filename}}{DERIVATIVE_SUFFIX}$'
+
+# Состояния обработки в поле *_variants
+PROCESSING = 'processing'
+READY = 'ready'
+FAILED = 'failed'
+
+CONTENT_TYPES = {'avif': 'image/avif', 'webp': 'image/webp', 'jpeg': 'image/jpeg', 'png': 'image/png'}
+EXTENSIONS = {'avif': 'avif', 'webp': 'webp', 'jpeg': 'jpg', 'png': 'png'}
+
+
+def supported_formats() -> list[str]:
+    ''' Современные форматы, которые умеет записывать установленный Pillow (AVIF - с Pillow 11.2 или плагином) '''
+    return [fmt for fmt in IMAGE_VARIANT_FORMATS if fmt.upper() in Image.SAVE]
+
+
+def derivative_name(name: str, width: int, fmt: str) -> str:
+    return f'{name}.{width}w.{EXTENSIONS[fmt]}'
+
+
+def fallback_format(image: Image.Image) -> str:
+    # Формат для браузеров без WebP/AVIF: прозрачность сохраняется только в PNG
+    source = (image.format or '').lower()
+    return source if source in IMAGE_FALLBACK_FORMATS else IMAGE_FALLBACK_FORMATS[0]
+
+
+def target_widths(width: int, widths: tuple[int, ...]) -> list[int]:
+    # Картинки не увеличиваются: маленький оригинал получает одну производную своего размера
+    return [w for w in widths if w < width] or [width]
+
+
+class InvalidImage(Exception):
+    ''' Файл не открывается как изображение или слишком велик - повторная обработка не поможет '''
+
+
+def open_image(name: str, storage=default_storage) -> Image.Image:
+    ''' Полное декодирование файла: проверка, что это изображение, и защита от "бомб" (MAX_IMAGE_PIXELS).
+    FileNotFoundError и ошибки хранилища пробрасываются как есть
+    '''
+    with storage.open(name) as file:
+        try:
+            image = Image.open(file)
+            image.load()
+        except (OSError, Image.DecompressionBombError, SyntaxError, ValueError) as error:
+            raise InvalidImage(f'{name}: {error}') from error
+    return image
+
+
+def has_alpha(image: Image.Image) -> bool:
+    return image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+
+
+def strip_metadata(name: str, image: Image.Image, storage=default_storage) -> tuple[str, Image.Image]:
+    ''' Копия оригинала с EXIF (геометка, модель камеры) без метаданных, с поворотом по EXIF.
+    Копия сохраняется под новым именем (в хранилище по содержимому у нее другой хэш), оригинал
+    удаляет вызывающий после замены ссылки. Файл без метаданных не перекодируется, чтобы не терять качество.
+    Форматы, которых нет в IMAGE_QUALITY (TIFF и другие, что пропускает проверка расширения при загрузке),
+    перекодируются в PNG, если есть прозрачность, иначе в JPEG
+    '''
+    if not image.info.get('exif') and not image.getexif():
+        return name, image
+    fmt = (image.format or '').lower()
+    if fmt not in IMAGE_QUALITY:
+        fmt = 'png' if has_alpha(image) else 'jpeg'
+        name = f'{posixpath.splitext(name)[0]}.{EXTENSIONS[fmt]}'
+    stripped = ImageOps.exif_transpose(image)
+    stripped.info.pop('exif', None)
+    stripped_name = storage.save(name, ContentFile(encode(stripped, fmt)))
+    stripped.format = fmt.upper()
+    return stripped_name, stripped
+
+
+def make_derivatives(name: str, widths: tuple[int, ...], storage=default_storage, image: Image.Image | None = None) -> dict:
+    ''' Уменьшенные копии изображения name шириной widths в современных форматах и в формате оригинала.
+    Уже существующие файлы не пересоздаются (например, для общей картинки по умолчанию).
+    Возвращает описание для поля *_variants: исходный файл, его размеры и список производных
+    '''
+    if image is None:
+        image = open_image(name, storage)
+
+    # Поворот по EXIF возвращает копию без format, формат берется до него
+    formats = [*supported_formats(), fallback_format(image)]
+    image = ImageOps.exif_transpose(image)
+    variants = []
+    for width in target_widths(image.width, widths):
+        height = max(1, round(image.height * width / image.width))
+        resized = None
+        for fmt in formats:
+            path = derivative_name(name, width, fmt)
+            if not storage.exists(path):
+                if resized is None:
+                    resized = image.resize((width, height), Image.Resampling.LANCZOS)
+                storage.save(path, ContentFile(encode(resized, fmt)))
+            variants.append({'name': path, 'width': width, 'height': height, 'format': fmt})
+
+    return {'source': name, 'status': READY, 'width': image.width, 'height': image.height, 'variants': variants}
+
+
+def process_image(name: str, widths: tuple[int, ...], storage=default_storage) -> dict:
+    ''' Полная обработка загруженного файла: проверка, удаление метаданных, производные.
+    Отсутствующий файл (например, картинка по умолчанию не загружена на сервер) - просто без производных.
+    source в результате отличается от name, если оригинал заменен копией без метаданных
+    '''
+    try:
+        image = open_image(name, storage)
+    except FileNotFoundError:
+        logger.warning('Image %s is missing, no derivatives', name)
+        return {'source': name, 'status': READY, 'variants': []}
+    name, image = strip_metadata(name, image, storage)
+    return make_derivatives(name, widths, storage, image)
+
+
+def encode(image: Image.Image, fmt: str) -> bytes:
+    if fmt == 'jpeg' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    buffer = BytesIO()
+    image.save(buffer, format=fmt.upper(), quality=IMAGE_QUALITY[fmt], optimize=fmt != 'avif')
+    return buffer.getvalue()
+
+
+def delete_derivatives(name: str, storage=default_storage):
+    ''' Удаление всех производных изображения name, в том числе размеров, которых уже нет в настройках '''
+    directory, filename = posixpath.split(name)
+    pattern = re.compile(DERIVATIVE_RE.format(filename=re.escape(filename)))
+    try:
+        _, files = storage.listdir(directory)
+    except FileNotFoundError:
+        return
+    for file in files:
+        if pattern.match(file):
+            storage.delete(posixpath.join(directory, file))
+
+
+def is_default(name: str) -> bool:
+    ''' Картинка по умолчанию поля из MEDIA_REFERENCES - общий файл всех объектов без загрузки '''
+    return any(str(name) == apps.get_model(model_name)._meta.get_field(field).default
+               for model_name, field in MEDIA_REFERENCES)
+
+
+def delete_image(name: str, storage=default_storage):
+    ''' Удаление оригинала с производными. Хранилище по содержимому не удаляет файл, на который
+    еще есть ссылки, - тогда остаются и производные. Картинка по умолчанию не удаляется никогда
+    '''
+    if is_default(name):
+        return
+    storage.delete(name)
+    if not storage.exists(name):
+        delete_derivatives(name, storage)
+
+
+def current_variants(variants: dict, name: str) -> list[dict]:
+    # Описание от прежнего файла (картинку заменили, производные еще не готовы) не используется
+    if not variants or variants.get('source') != str(name):
+        return []
+    return variants.get('variants', [])
+
+
+def image_status(variants: dict, name: str) -> str:
+    ''' processing - файл загружен, но фоновая обработка (main.jobs) еще не закончилась,
+    failed - производных не будет, ready - готово (или файл загружен до появления производных)
+    '''
+    if variants and variants.get('source') == str(name):
+        return variants.get('status', READY)
+    return READY
+
+
+def srcset(variants: dict, name: str, fmt: str, url=None) -> str:
+    ''' Значение srcset для формата fmt: "url 480w, url 960w" '''
+    url = url or default_storage.url
+    return ', '.join(f'{url(variant["name"])} {variant["width"]}w'
+                     for variant in current_variants(variants, name) if variant['format'] == fmt)
+
+
+def srcsets(variants: dict, name: str, url=None) -> dict[str, str]:
+    ''' srcset для всех форматов производных: {'avif': ..., 'webp': ..., 'jpeg': ...} '''
+    formats = dict.fromkeys(variant['format'] for variant in current_variants(variants, name))
+    return {fmt: srcset(variants, name, fmt, url) for fmt in formats}
@@ -0,0 +1,145 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .constants import AVATAR_WIDTHS, IMAGE_WIDTHS
+from .images import FAILED, PROCESSING, InvalidImage, delete_image, process_image
+from .models import Blog, Blogger, BloggerStats, ImageJob
+from .page_cache import invalidate_pages
+
+logger = logging.getLogger(__name__)
+
+# Что обрабатывает задание каждого вида: модель, поле id, поле файла и ширины производных
+IMAGE_TARGETS = {
+    ImageJob.Kind.BLOG_IMAGE: (Blog, 'pk', 'image', IMAGE_WIDTHS),
+    ImageJob.Kind.BLOGGER_AVATAR: (Blogger, 'user', 'avatar', AVATAR_WIDTHS),
+}
+
+
+def default_name(kind: str) -> str:
+    model, _, field, _ = IMAGE_TARGETS[kind]
+    return model._meta.get_field(field).default
+
+
+def default_variants(kind: str) -> dict:
+    ''' Готовое описание производных картинки по умолчанию (команда publish_default_media).
+    Пока она не опубликована - пустое: показывается сам файл без srcset
+    '''
+    return getattr(default_storage, 'published_variants', {}).get(default_name(kind), {})
+
+
+def enqueue_image(kind: str, instance):
+    ''' Постановка файла в очередь из post_save: описание производных переходит в состояние processing,
+    шаблоны и API показывают заглушку, пока обработчик не закончит
+    '''
+    model, key, field, _ = IMAGE_TARGETS[kind]
+    name = getattr(instance, field).name
+    object_id = getattr(instance, 'user_id' if key == 'user' else 'pk')
+    variants = {'source': name, 'status': PROCESSING}
+    setattr(instance, f'{field}_variants', variants)
+    save_variants(kind, object_id, name, variants)
+    ImageJob.objects.create(kind=kind, object_id=object_id, name=name)
+
+
+def save_variants(kind: str, object_id, name: str, variants: dict, new_name: str | None = None) -> bool:
+    ''' Запись описания, только если у объекта все еще этот файл. new_name - замена самого файла '''
+    model, key, field, _ = IMAGE_TARGETS[kind]
+    values = {f'{field}_variants': variants}
+    if new_name is not None:
+        values[field] = new_name
+    if not model.objects.filter(**{key: object_id, field: name}).update(**values):
+        return False
+
+    if kind == ImageJob.Kind.BLOGGER_AVATAR:
+        BloggerStats.objects.filter(user=object_id).update(
+            avatar=new_name or name, avatar_variants=variants, updated=timezone.now())
+        invalidate_pages('bloggers', f'blogger:{object_id}')
+    else:
+        # Изображение и его состояние есть и в списке записей API, и на странице автора
+        author_id = Blog.objects.filter(pk=object_id).values_list('author_id', flat=True).first()
+        invalidate_pages('blogs', f'blog:{object_id}', f'blogger:{author_id}')
+    return True
+
+
+def is_current(job: ImageJob) -> bool:
+    # Файл успели заменить или объект удалить - задание устарело
+    model, key, field, _ = IMAGE_TARGETS[job.kind]
+    return model.objects.filter(**{key: job.object_id, field: job.name}).exists()
+
+
+def process_job(job: ImageJob):
+    _, _, _, widths = IMAGE_TARGETS[job.kind]
+    variants = process_image(job.name, widths)
+    if variants['source'] == job.name:
+        save_variants(job.kind, job.object_id, job.name, variants)
+    elif save_variants(job.kind, job.object_id, job.name, variants, new_name=variants['source']):
+        # Оригинал заменен копией без метаданных
+        delete_image(job.name)
+    else:
+        delete_image(variants['source'])
+
+
+def reject_job(job: ImageJob):
+    ''' Файл не изображение: объект возвращается к картинке по умолчанию, загруженный файл удаляется '''
+    if save_variants(job.kind, job.object_id, job.name, default_variants(job.kind), new_name=default_name(job.kind)):
+        delete_image(job.name)
+
+
+def claim_jobs(limit: int) -> list[int]:
+    ''' Атомарный захват до limit готовых заданий. SKIP LOCKED позволяет нескольким обработчикам
+    разбирать очередь параллельно, не блокируя друг друга. Задание, которое обработчик не закончил
+    за IMAGE_JOB_TIMEOUT секунд (процесс упал), захватывается заново
+    '''
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.IMAGE_JOB_TIMEOUT)
+    with transaction.atomic():
+        ids = list(ImageJob.objects.select_for_update(skip_locked=True).filter(
+            Q(status=ImageJob.Status.PENDING, run_after__lte=now) | Q(status=ImageJob.Status.RUNNING, started__lt=stale),
+        ).order_by('run_after').values_list('id', flat=True)[:limit])
+        ImageJob.objects.filter(id__in=ids).update(
+            status=ImageJob.Status.RUNNING, started=now, attempts=F('attempts') + 1)
+    return ids
+
+
+def run_job(job_id: int) -> str:
+    ''' Выполнение захваченного задания. Ошибки хранилища и БД повторяются с экспоненциальной задержкой
+    до IMAGE_JOB_MAX_ATTEMPTS попыток, не изображение - сразу отклоняется
+    '''
+    job = ImageJob.objects.get(pk=job_id)
+    try:
+        if is_current(job):
+            process_job(job)
+    except InvalidImage as error:
+        logger.warning('Image job %s rejected: %s', job.id, error)
+        reject_job(job)
+        job.status, job.last_error = ImageJob.Status.FAILED, str(error)
+    except Exception as error:
+        logger.exception('Image job %s failed', job.id)
+        job.last_error = repr(error)
+        if job.attempts >= settings.IMAGE_JOB_MAX_ATTEMPTS:
+            # Производных так и не будет, показывается оригинал
+            save_variants(job.kind, job.object_id, job.name, {'source': job.name, 'status': FAILED})
+            job.status = ImageJob.Status.FAILED
+        else:
+            job.status = ImageJob.Status.PENDING
+            job.run_after = timezone.now() + timedelta(
+                seconds=settings.IMAGE_JOB_RETRY_DELAY * 2 ** (job.attempts - 1))
+    else:
+        job.status, job.last_error = ImageJob.Status.DONE, ''
+    job.save(update_fields=['status', 'run_after', 'last_error'])
+    return job.status
+
+
+def run_pending_jobs(batch: int = 100) -> int:
+    ''' Обработка очереди в текущем процессе до опустошения (тесты, --processes 0) '''
+    total = 0
+    while ids := claim_jobs(batch):
+        for job_id in ids:
+            run_job(job_id)
+        total += len(ids)
+    return total
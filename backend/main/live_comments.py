@@ -0,0 +1,177 @@
+import asyncio
+import contextvars
+import json
+import logging
+from contextlib import suppress
+
+import psycopg
+from asgiref.sync import sync_to_async
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import F
+from django.template.loader import render_to_string
+
+from .constants import (
+    COMMENTS_PER_PAGE, LIVE_COMMENTS_CHANNEL, LIVE_COMMENTS_KEEPALIVE_SECONDS, LIVE_COMMENTS_QUEUE_SIZE,
+    LIVE_COMMENTS_RECONNECT_SECONDS)
+from .models import Comment
+
+logger = logging.getLogger(__name__)
+
+# Новые комментарии в реальном времени (SSE, профиль ASGI). Сохранение комментария отправляет NOTIFY
+# в той же транзакции - он доставляется только после коммита. Каждый процесс держит одно соединение LISTEN
+# и раздает готовый фрагмент всем подпискам через очереди asyncio: ожидающий клиент не тратит ни CPU,
+# ни запросов к БД, а фрагмент рендерится один раз на процесс, а не на клиента
+
+
+def publish_comment(comment: Comment):
+    ''' Уведомление о новом комментарии, вызывается из post_save '''
+    payload = json.dumps({'blog': comment.to_blog_id, 'comment': comment.id})
+    with connections[DEFAULT_DB_ALIAS].cursor() as cursor:
+        cursor.execute('SELECT pg_notify(%s, %s)', [LIVE_COMMENTS_CHANNEL, payload])
+
+
+def sse_event(event: str, data: str, event_id=None) -> str:
+    lines = [f'id: {event_id}'] if event_id is not None else []
+    lines.append(f'event: {event}')
+    lines += [f'data: {line}' for line in data.splitlines()]
+    return '\n'.join(lines) + '\n\n'
+
+
+def comment_events(blog_id, **filters) -> list[tuple[int, str]]:
+    ''' События SSE с фрагментами комментариев к записи: [(id комментария, событие)].
+    Поля те же, что у comments_queryset (cb_views), но без ссылки на удаление - фрагмент общий для всех клиентов
+    '''
+    comments = Comment.objects.filter(to_blog=blog_id, **filters).annotate(
+        author_username=F('author__username'),
+        author_iid=F('author__id')).order_by('id')[:COMMENTS_PER_PAGE]
+    return [(comment.id, sse_event('comment', render_to_string(
+                'includes/comment_item.html', {'comment': comment, 'blog_id': blog_id}), comment.id))
+            for comment in comments]
+
+
+def missed_comment_events(blog_id, last_event_id: str | None) -> list[tuple[int, str]]:
+    ''' Переподключившийся EventSource присылает Last-Event-ID: отдаем то, что он пропустил '''
+    if not last_event_id or not last_event_id.isdigit():
+        return []
+    return comment_events(blog_id, id__gt=int(last_event_id))
+
+
+class CommentBroadcaster:
+    ''' Раздача новых комментариев подпискам SSE внутри процесса: одно соединение LISTEN на цикл событий,
+    подписка - очередь asyncio для записи (blog_id)
+    '''
+
+    def __init__(self):
+        self.subscribers: dict[int, set[asyncio.Queue]] = {}
+        self.listener: asyncio.Task | None = None
+        self.ready: asyncio.Event | None = None
+
+    async def subscribe(self, blog_id: int, timeout: float = LIVE_COMMENTS_RECONNECT_SECONDS) -> asyncio.Queue:
+        self.ensure_listener()
+        queue = asyncio.Queue(LIVE_COMMENTS_QUEUE_SIZE)
+        self.subscribers.setdefault(blog_id, set()).add(queue)
+        # Комментарий, сохраненный после подписки, не должен потеряться: ждем, пока слушатель выполнит LISTEN.
+        # БД недоступна - поток все равно открывается, комментарии пойдут после переподключения слушателя
+        try:
+            async with asyncio.timeout(timeout):
+                await self.ready.wait()
+        except TimeoutError:
+            pass
+        return queue
+
+    def unsubscribe(self, blog_id: int, queue: asyncio.Queue):
+        queues = self.subscribers.get(blog_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self.subscribers[blog_id]
+
+    def subscribers_count(self) -> int:
+        return sum(len(queues) for queues in self.subscribers.values())
+
+    def ensure_listener(self):
+        loop = asyncio.get_running_loop()
+        if self.listener is not None and not self.listener.done() and self.listener.get_loop() is loop:
+            return
+        # Новый цикл событий (тесты, перезапуск): подписки старого цикла уже не обслужить
+        if self.listener is None or self.listener.get_loop() is not loop:
+            self.subscribers = {}
+        self.ready = asyncio.Event()
+        # Слушатель переживает запрос, который его запустил: контекст (поток sync_to_async, роутер БД) - свой
+        self.listener = loop.create_task(self.listen(), context=contextvars.Context())
+
+    async def stop(self):
+        ''' Остановка слушателя вместе с его соединением (тесты: у каждого теста свой цикл событий) '''
+        if self.listener is not None:
+            self.listener.cancel()
+            with suppress(asyncio.CancelledError):
+                await self.listener
+        self.listener = None
+        self.subscribers = {}
+
+    async def listen(self):
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(**listener_params(), autocommit=True) as conn:
+                    await conn.execute(f'LISTEN {LIVE_COMMENTS_CHANNEL}')
+                    self.ready.set()
+                    async for notify in conn.notifies():
+                        await self.dispatch(json.loads(notify.payload))
+            except Exception:
+                logger.exception('Соединение LISTEN %s потеряно', LIVE_COMMENTS_CHANNEL)
+            self.ready.clear()
+            await asyncio.sleep(LIVE_COMMENTS_RECONNECT_SECONDS)
+
+    async def dispatch(self, message: dict):
+        queues = self.subscribers.get(message['blog'])
+        if not queues:
+            return
+        events = await sync_to_async(comment_events)(message['blog'], id=message['comment'])
+        # Комментарий успели удалить
+        if not events:
+            return
+        for queue in list(queues):
+            try:
+                queue.put_nowait(events[0])
+            except asyncio.QueueFull:
+                # Клиент не успевает читать: поток закрывается, EventSource переподключится с Last-Event-ID
+                self.unsubscribe(message['blog'], queue)
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+
+def listener_params() -> dict:
+    # Параметры основного соединения Django (в тестах - тестовой БД), но соединение асинхронное и вне пула
+    params = connections[DEFAULT_DB_ALIAS].get_connection_params()
+    params.pop('cursor_factory', None)
+    return params
+
+
+broadcaster = CommentBroadcaster()
+
+
+async def comments_stream(blog_id: int, queue: asyncio.Queue, missed: list[tuple[int, str]]):
+    ''' Тело ответа SSE: пропущенные комментарии, затем новые по мере появления и keepalive в паузах,
+    чтобы прокси не закрыл соединение. Django прерывает генератор при отключении клиента
+    '''
+    try:
+        sent = set()
+        for comment_id, event in missed:
+            sent.add(comment_id)
+            yield event
+        while True:
+            try:
+                async with asyncio.timeout(LIVE_COMMENTS_KEEPALIVE_SECONDS):
+                    message = await queue.get()
+            except TimeoutError:
+                yield ': keepalive\n\n'
+                continue
+            if message is None:
+                break
+            comment_id, event = message
+            # Комментарий мог попасть и в пропущенные, и в очередь
+            if comment_id not in sent:
+                yield event
+    finally:
+        broadcaster.unsubscribe(blog_id, queue)
@@ -0,0 +1,148 @@
+import asyncio
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+from urllib.error import URLError
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Профили сервера из gunicorn.conf.py: синхронные воркеры с потоками и воркеры uvicorn с асинхронными представлениями
+PROFILES = ('wsgi', 'asgi')
+
+
+class Command(BaseCommand):
+    help = ('Пропускная способность и задержки профилей wsgi и asgi, пока сервер держит соединения медленных клиентов '
+            '(заголовки запроса приходят по строке в несколько секунд)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='/blogs/')
+        parser.add_argument('--slow-clients', type=int, default=1_000)
+        parser.add_argument('--slow-interval', type=float, default=2, help='Пауза между строками заголовков, секунд')
+        parser.add_argument('--concurrency', type=int, default=20, help='Обычные клиенты, запрос за запросом')
+        parser.add_argument('--duration', type=float, default=10, help='Время замера, секунд')
+        parser.add_argument('--workers', type=int, default=2)
+        parser.add_argument('--threads', type=int, default=4)
+        parser.add_argument('--port', type=int, default=8766)
+
+    def handle(self, *args, **options):
+        # Каждому медленному клиенту нужен сокет, серверу - еще столько же
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        needed = options['slow_clients'] * 2 + options['concurrency'] + 100
+        if soft < needed:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (min(needed, hard), hard))
+
+        self.stdout.write(
+            f'{options["url"]}: {options["slow_clients"]} slow clients, {options["concurrency"]} regular clients '
+            f'for {options["duration"]:.0f}s, {options["workers"]} workers (wsgi: x {options["threads"]} threads)')
+        for profile in PROFILES:
+            server = self.start_server(profile, options)
+            try:
+                self.wait_ready(f'http://127.0.0.1:{options["port"]}{options["url"]}')
+                result = asyncio.run(self.measure(options))
+            finally:
+                server.terminate()
+                server.wait()
+            self.stdout.write(
+                f'{profile}: {result["rps"]:8.1f} req/s, p50 {result["p50"]:7.1f} ms, p99 {result["p99"]:7.1f} ms, '
+                f'completed {result["completed"]}, failed {result["failed"]}, '
+                f'unanswered at the end {result["unfinished"]}, '
+                f'slow clients connected {result["slow_connected"]}')
+
+    def start_server(self, profile, options):
+        # Приложение и класс воркеров выбирает gunicorn.conf.py по SERVER_PROFILE
+        command = [
+            sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{options["port"]}',
+            '--workers', str(options['workers']), '--log-level', 'warning',
+            # Медленный клиент не должен успеть до конца замера упереться в таймауты сервера
+            '--timeout', str(int(options['duration'] * 3) + 30), '--backlog', str(max(options['slow_clients'] * 2, 2048))]
+        # Кэш страниц отключен: сравнивается работа с БД на горячем пути, а не чтение готовой страницы
+        env = {**os.environ, 'SERVER_PROFILE': profile, 'GUNICORN_THREADS': str(options['threads']),
+               'PAGE_CACHE_SECONDS': '0'}
+        return subprocess.Popen(command, cwd=settings.BASE_DIR, env=env)
+
+    def wait_ready(self, url, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                urllib.request.urlopen(url).read()
+                return
+            except (URLError, ConnectionError):
+                time.sleep(0.2)
+        raise CommandError(f'Сервер не ответил на {url}')
+
+    async def measure(self, options) -> dict:
+        loop = asyncio.get_running_loop()
+        stop = loop.time() + options['duration'] + 1
+        slow = [asyncio.create_task(self.slow_client(options, stop)) for _ in range(options['slow_clients'])]
+        # Медленные клиенты подключаются и занимают воркеры до начала замера
+        await asyncio.sleep(1)
+
+        latencies, failures = [], []
+        start = loop.time()
+        unfinished = sum(await asyncio.gather(*(self.regular_client(options, stop, latencies, failures)
+                                                for _ in range(options['concurrency']))))
+        elapsed = loop.time() - start
+        slow_connected = sum(await asyncio.gather(*slow))
+
+        latencies.sort()
+        return {
+            'rps': len(latencies) / elapsed,
+            'p50': statistics.median(latencies) * 1000 if latencies else float('nan'),
+            'p99': latencies[int(len(latencies) * 0.99)] * 1000 if latencies else float('nan'),
+            'completed': len(latencies),
+            'failed': len(failures),
+            'unfinished': unfinished,
+            'slow_connected': slow_connected,
+        }
+
+    async def slow_client(self, options, stop) -> bool:
+        ''' Запрос, заголовки которого приходят по строке раз в slow_interval секунд до конца замера '''
+        loop = asyncio.get_running_loop()
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', options['port'])
+        except OSError:
+            return False
+        try:
+            writer.write(f'GET {options["url"]} HTTP/1.1\r\nHost: 127.0.0.1\r\n'.encode())
+            await writer.drain()
+            number = 0
+            while loop.time() < stop:
+                await asyncio.sleep(min(options['slow_interval'], max(stop - loop.time(), 0)))
+                writer.write(f'X-Slow-{number}: 1\r\n'.encode())
+                await writer.drain()
+                number += 1
+        except OSError:
+            pass
+        finally:
+            writer.close()
+        return True
+
+    async def regular_client(self, options, stop, latencies, failures) -> bool:
+        ''' Запросы один за другим до конца замера. True - последний запрос так и остался без ответа '''
+        loop = asyncio.get_running_loop()
+        request = f'GET {options["url"]} HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n'.encode()
+        while loop.time() < stop:
+            started = loop.time()
+            try:
+                async with asyncio.timeout(stop - started):
+                    reader, writer = await asyncio.open_connection('127.0.0.1', options['port'])
+                    writer.write(request)
+                    await writer.drain()
+                    status_line = await reader.readline()
+                    await reader.read()
+                    writer.close()
+            except TimeoutError:
+                return True
+            except OSError as error:
+                failures.append(error)
+                continue
+            if status_line.split()[1:2] == [b'200']:
+                latencies.append(loop.time() - started)
+            else:
+                failures.append(status_line)
+        return False
@@ -0,0 +1,75 @@
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from urllib.error import URLError
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+MODES = {
+    'new connection per request': {'DB_POOL': 'False', 'DB_CONN_MAX_AGE': '0'},
+    'persistent connections': {'DB_POOL': 'False', 'DB_CONN_MAX_AGE': '60'},
+    'connection pool': {'DB_POOL': 'True'},
+}
+
+
+class Command(BaseCommand):
+    help = 'Запросов в секунду через gunicorn без постоянных соединений, с постоянными соединениями и с пулом'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='/blogs/')
+        parser.add_argument('--requests', type=int, default=2_000)
+        parser.add_argument('--concurrency', type=int, default=8)
+        parser.add_argument('--workers', type=int, default=2)
+        parser.add_argument('--threads', type=int, default=4)
+        parser.add_argument('--port', type=int, default=8765)
+
+    def handle(self, *args, **options):
+        url = f'http://127.0.0.1:{options["port"]}{options["url"]}'
+        self.stdout.write(
+            f'{options["requests"]} requests to {options["url"]}, concurrency {options["concurrency"]}, '
+            f'{options["workers"]} workers x {options["threads"]} threads')
+
+        for mode, env in MODES.items():
+            server = self.start_server(env, options)
+            try:
+                self.wait_ready(url)
+                self.run_requests(url, options['concurrency'] * 10, options['concurrency'])
+                elapsed = self.run_requests(url, options['requests'], options['concurrency'])
+            finally:
+                server.terminate()
+                server.wait()
+            self.stdout.write(f'{mode:<28}: {options["requests"] / elapsed:8.0f} req/s')
+
+    def start_server(self, env, options):
+        command = [
+            sys.executable, '-m', 'gunicorn', 'config.wsgi', '--bind', f'127.0.0.1:{options["port"]}',
+            '--workers', str(options['workers']), '--threads', str(options['threads']), '--log-level', 'warning']
+        # Замер синхронных воркеров: профиль asgi из окружения не должен переопределить класс воркеров.
+        # Кэш страниц отключен, иначе после прогрева замеряются чтения из кэша, а не соединения с БД
+        env = {**os.environ, 'SERVER_PROFILE': 'wsgi', 'PAGE_CACHE_SECONDS': '0', **env}
+        return subprocess.Popen(command, cwd=settings.BASE_DIR, env=env)
+
+    def wait_ready(self, url, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                urllib.request.urlopen(url).read()
+                return
+            except (URLError, ConnectionError):
+                time.sleep(0.2)
+        raise CommandError(f'Сервер не ответил на {url}')
+
+    def run_requests(self, url, amount, concurrency):
+        def fetch(_):
+            with urllib.request.urlopen(url) as response:
+                response.read()
+
+        start = perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            list(executor.map(fetch, range(amount)))
+        return perf_counter() - start
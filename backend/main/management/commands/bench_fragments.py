@@ -0,0 +1,71 @@
+from statistics import median
+from time import perf_counter
+
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.template.loader import render_to_string
+from django.test import RequestFactory
+
+from main.cb_views import BlogsList
+from main.constants import BLOGS_KEYSET_ORDERING
+from main.models import Blog
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Время рендера страницы списка записей без кэша фрагментов, из кэша и с частью измененных строк'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100)
+        parser.add_argument('--changed', type=int, default=10)
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        fragments = caches['template_fragments']
+        with transaction.atomic():
+            author = User.objects.create_user(username='bench_fragments_user')
+            Blog.objects.bulk_create(
+                Blog(title=f'Bench {i}', content='Bench content', author=author) for i in range(options['rows']))
+
+            request = RequestFactory().get('/blogs/')
+            request.user = author
+            view = BlogsList()
+            view.setup(request)
+            # Строки выбираются заранее, замеряется только рендер
+            rows = list(view.get_queryset().order_by(*BLOGS_KEYSET_ORDERING)[:options['rows']])
+            changed = rows[:options['changed']]
+
+            def render():
+                return render_to_string('blogs_list.html', {'page_obj': rows, 'cursor_mode': True}, request)
+
+            def render_cold():
+                fragments.clear()
+                render()
+
+            def render_changed():
+                # Новая версия части строк, как после их редактирования
+                for blog in changed:
+                    blog.updated = blog.updated.replace(microsecond=(blog.updated.microsecond + 1) % 1_000_000)
+                render()
+
+            render()
+            self.stdout.write(f'{options["rows"]} rows, median of {options["repeat"]} renders')
+            for label, fetch in [
+                ('no cached rows', render_cold),
+                ('all rows cached', render),
+                (f'{options["changed"]} rows changed', render_changed),
+            ]:
+                self.stdout.write(f'{label:<18}: {self.measure(fetch, options["repeat"]) * 1000:8.2f} ms')
+
+            transaction.set_rollback(True)
+
+    def measure(self, fetch, repeat):
+        timings = []
+        for _ in range(repeat):
+            start = perf_counter()
+            fetch()
+            timings.append(perf_counter() - start)
+        return median(timings)
@@ -0,0 +1,81 @@
+from statistics import median
+from time import perf_counter
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.core.paginator import Paginator
+from django.db import connection, transaction
+from django.test import RequestFactory
+
+from main.cb_views import BlogsList
+from main.constants import BLOGS_KEYSET_ORDERING, BLOGS_PER_PAGE
+from main.models import Blog
+from main.pagination import KeysetPaginator
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Сравнение OFFSET- и keyset-пагинации списка записей. Данные создаются в транзакции и откатываются'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page', type=int, default=10_000)
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--batch', type=int, default=5_000)
+
+    def handle(self, *args, **options):
+        deep_page = options['page']
+        rows = (deep_page + 10) * BLOGS_PER_PAGE
+
+        with transaction.atomic():
+            self.populate(rows, options['batch'])
+
+            view = BlogsList()
+            view.setup(RequestFactory().get('/blogs/'))
+            queryset = view.get_queryset()
+
+            offset_paginator = Paginator(queryset.order_by(*BLOGS_KEYSET_ORDERING), BLOGS_PER_PAGE)
+            keyset_paginator = KeysetPaginator(queryset, BLOGS_PER_PAGE, BLOGS_KEYSET_ORDERING)
+
+            # Курсор глубокой страницы - последняя строка предыдущей страницы, в замер не входит
+            previous_row = queryset.order_by(*BLOGS_KEYSET_ORDERING)[(deep_page - 1) * BLOGS_PER_PAGE - 1]
+            deep_cursor = keyset_paginator.encode_cursor(previous_row, reverse=False)
+
+            results = [
+                ('offset + count', 1, lambda: self.offset_page(offset_paginator, 1)),
+                ('offset + count', deep_page, lambda: self.offset_page(offset_paginator, deep_page)),
+                ('keyset', 1, lambda: keyset_paginator.get_page(None)),
+                ('keyset', deep_page, lambda: keyset_paginator.get_page(deep_cursor)),
+            ]
+            self.stdout.write(f'{rows} rows, {BLOGS_PER_PAGE} per page, median of {options["repeat"]} runs')
+            for mode, page, fetch in results:
+                elapsed = self.measure(fetch, options['repeat'])
+                self.stdout.write(f'{mode:<16} page {page:>6}: {elapsed * 1000:8.2f} ms')
+
+            transaction.set_rollback(True)
+
+    def populate(self, rows, batch):
+        author = User.objects.create_user(username='bench_pagination_user')
+        Blog.objects.bulk_create(
+            (Blog(title=f'Bench {i}', content='Bench content', author=author) for i in range(rows)),
+            batch_size=batch)
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                # auto_now_add выставляет всем записям одинаковое время, разносим его
+                cursor.execute(
+                    "UPDATE main_blog SET created = now() - id * interval '1 second' WHERE author_id = %s",
+                    [author.id])
+                cursor.execute('ANALYZE main_blog')
+
+    def offset_page(self, paginator, number):
+        # Paginator кэширует count, а view считает его на каждый запрос
+        paginator.__dict__.pop('count', None)
+        return list(paginator.page(number))
+
+    def measure(self, fetch, repeat):
+        timings = []
+        for _ in range(repeat):
+            start = perf_counter()
+            fetch()
+            timings.append(perf_counter() - start)
+        return median(timings)
@@ -0,0 +1,92 @@
+import random
+from statistics import median
+from time import perf_counter
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from main.constants import BLOGS_PER_PAGE, SEARCH_KEYSET_ORDERING
+from main.models import Blog
+from main.pagination import KeysetPaginator
+from main.search import search_blogs
+
+User = get_user_model()
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ter', 'van', 'sol', 'bri', 'dun', 'pex', 'qua', 'ros', 'tiv', 'mor', 'zel', 'gan']
+
+
+class Command(BaseCommand):
+    help = 'Латентность полнотекстового поиска на сгенерированных записях (PostgreSQL). Данные откатываются'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1_000_000)
+        parser.add_argument('--words', type=int, default=40, help='Слов в тексте записи')
+        parser.add_argument('--vocabulary', type=int, default=20_000)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('Полнотекстовый поиск работает только на PostgreSQL')
+
+        rnd = random.Random(0)
+        vocabulary = sorted({''.join(rnd.choices(SYLLABLES, k=rnd.randint(2, 4))) for _ in range(options['vocabulary'])})
+
+        with transaction.atomic():
+            started = perf_counter()
+            self.populate(options['rows'], options['words'], vocabulary)
+            self.stdout.write(f'{options["rows"]} rows generated in {perf_counter() - started:.0f} s')
+
+            # Частота слова падает с номером в словаре (распределение в populate), берем слова разной частоты
+            queries = {
+                'frequent word': vocabulary[0],
+                'medium word': vocabulary[len(vocabulary) // 20],
+                'rare word': vocabulary[-1],
+                'two words': f'{vocabulary[len(vocabulary) // 50]} {vocabulary[len(vocabulary) // 10]}',
+                'phrase': f'"{vocabulary[1]} {vocabulary[2]}"',
+                'no matches': 'nonexistentword',
+            }
+            self.stdout.write(f'{BLOGS_PER_PAGE} per page, median of {options["repeat"]} runs')
+            for label, text in queries.items():
+                queryset = search_blogs(Blog.objects.only('title', 'created'), text)
+                paginator = KeysetPaginator(queryset, BLOGS_PER_PAGE, SEARCH_KEYSET_ORDERING)
+                first_page = self.measure(lambda: paginator.get_page(), options['repeat'])
+                next_cursor = paginator.get_page().next_cursor
+                next_page = self.measure(lambda: paginator.get_page(next_cursor), options['repeat']) if next_cursor else 0
+                matches = queryset.count()
+                self.stdout.write(
+                    f'{label:<14} {text!r:<26} matches {matches:>8}: '
+                    f'page 1 {first_page * 1000:8.2f} ms, page 2 {next_page * 1000:8.2f} ms')
+
+            transaction.set_rollback(True)
+
+    def populate(self, rows, words, vocabulary):
+        author = User.objects.create_user(username='bench_search_user')
+        with connection.cursor() as cursor:
+            # Генерация на стороне БД в разы быстрее bulk_create; random()^3 дает перекос частот слов как в живом тексте
+            cursor.execute(
+                '''
+                INSERT INTO main_blog (title, content, created, updated, author_id, image, image_variants, comments_count)
+                SELECT left(t.text, 50), c.text, now() - i * interval '1 second', now() - i * interval '1 second',
+                       %(author)s, 'default_image.jpg', '{}'::jsonb, 0
+                FROM (SELECT %(vocabulary)s::text[] AS words) AS v
+                CROSS JOIN generate_series(1, %(rows)s) AS i
+                CROSS JOIN LATERAL (
+                    SELECT string_agg(word, ' ') AS text FROM (
+                        SELECT v.words[1 + floor(%(size)s * random() ^ 3)::int] AS word
+                        FROM generate_series(1, 4) WHERE i > 0) AS w) AS t
+                CROSS JOIN LATERAL (
+                    SELECT string_agg(word, ' ') AS text FROM (
+                        SELECT v.words[1 + floor(%(size)s * random() ^ 3)::int] AS word
+                        FROM generate_series(1, %(words)s) WHERE i > 0) AS w) AS c
+                ''',
+                {'size': len(vocabulary), 'words': words, 'author': author.id, 'rows': rows, 'vocabulary': vocabulary})
+            cursor.execute('ANALYZE main_blog')
+
+    def measure(self, fetch, repeat):
+        timings = []
+        for _ in range(repeat):
+            start = perf_counter()
+            fetch()
+            timings.append(perf_counter() - start)
+        return median(timings)
@@ -0,0 +1,106 @@
+from contextlib import contextmanager
+from io import StringIO
+from secrets import token_hex
+from statistics import median
+from time import perf_counter
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from rest_framework.test import APIRequestFactory
+
+from api.cbviews import BlogCRUD, BloggersListRetrieve
+from main.constants import COMMENTS_PER_PAGE
+from main.models import Blog, Blogger, Comment
+
+User = get_user_model()
+
+PAGE_SIZE = 100
+
+
+class Command(BaseCommand):
+    help = ('Размер ответа и время запросов к БД для страницы из 100 записей и блогеров API: все поля '
+            'и только запрошенные (fields, expand). Данные создаются в транзакции и откатываются')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--content-length', type=int, default=20_000, help='Длина текста записи')
+        parser.add_argument('--blogs-per-blogger', type=int, default=10)
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            offset = self.populate(options)
+            # Поля изображений - абсолютные адреса, хост запроса должен быть разрешен
+            factory = APIRequestFactory(SERVER_NAME=settings.ALLOWED_HOSTS[0].lstrip('.'))
+            # Без троттлинга: он ограничил бы число запросов в замере
+            blogs = BlogCRUD.as_view({'get': 'list'}, throttle_classes=[])
+            bloggers = BloggersListRetrieve.as_view({'get': 'list'}, throttle_classes=[])
+
+            self.stdout.write(
+                f'Page of {PAGE_SIZE}, content {options["content_length"]} chars, {COMMENTS_PER_PAGE} comments per blog, '
+                f'{options["blogs_per_blogger"]} blogs per blogger, median of {options["repeat"]} requests')
+            for view, params in [
+                (blogs, {}),
+                (blogs, {'fields': 'id,title,created'}),
+                (blogs, {'fields': 'id,title,created', 'expand': 'author'}),
+                (blogs, {'fields': 'id,title,created,comments_count,comments'}),
+                (bloggers, {'offset': offset}),
+                (bloggers, {'offset': offset, 'fields': 'id,username'}),
+                (bloggers, {'offset': offset, 'fields': 'id,username', 'expand': 'stats'}),
+            ]:
+                params = {'limit': PAGE_SIZE, **params}
+                size, queries, db_time, total_time = self.measure(
+                    lambda: view(factory.get('/', params)), options['repeat'])
+                label = ('blogs' if view is blogs else 'bloggers') + ' ' + '&'.join(
+                    f'{name}={value}' for name, value in params.items() if name in ('fields', 'expand'))
+                self.stdout.write(f'{label:<62}: {size / 1024:9.1f} KiB, {queries} queries, '
+                                  f'DB {db_time * 1000:7.2f} ms, total {total_time * 1000:7.2f} ms')
+
+            transaction.set_rollback(True)
+
+    def populate(self, options) -> int:
+        ''' 100 блогеров с записями и комментариями. Возвращает offset, с которого в списке блогеров идут они '''
+        offset = User.objects.count()
+        users = User.objects.bulk_create(User(username=f'bench_sparse_user_{i}') for i in range(PAGE_SIZE))
+        Blogger.objects.bulk_create(Blogger(user=user, bio='Bench bio') for user in users)
+        blogs = Blog.objects.bulk_create(
+            # Случайный текст: повторяющийся PostgreSQL сжал бы (TOAST), и чтение текста ничего бы не стоило
+            Blog(title=f'Bench {i}', content=token_hex(options['content_length'] // 2), author=user,
+                 comments_count=COMMENTS_PER_PAGE)
+            for user in users for i in range(options['blogs_per_blogger']))
+        Comment.objects.bulk_create(
+            Comment(to_blog=blog, author=blog.author, text='Bench comment ' * 10)
+            for blog in blogs for _ in range(COMMENTS_PER_PAGE))
+        # bulk_create обходит сигналы, статистику блогеров (expand=stats) пересчитываем
+        call_command('rebuild_blogger_stats', stdout=StringIO())
+        return offset
+
+    @contextmanager
+    def db_timer(self, stats):
+        def execute(execute, sql, params, many, context):
+            start = perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                stats['time'] += perf_counter() - start
+                stats['queries'] += 1
+
+        with connection.execute_wrapper(execute):
+            yield
+
+    def measure(self, request, repeat):
+        sizes, db_timings, timings, queries = [], [], [], 0
+        for _ in range(repeat):
+            stats = {'time': 0, 'queries': 0}
+            with self.db_timer(stats):
+                start = perf_counter()
+                response = request()
+                response.render()
+                timings.append(perf_counter() - start)
+            assert response.status_code == 200, response.status_code
+            sizes.append(len(response.content))
+            db_timings.append(stats['time'])
+            queries = stats['queries']
+        return median(sizes), queries, median(db_timings), median(timings)
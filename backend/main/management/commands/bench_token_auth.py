@@ -0,0 +1,69 @@
+from statistics import median
+from time import perf_counter
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIRequestFactory
+
+from api.authentication import CachedTokenAuthentication, local_tokens, token_cache_key
+from api.cbviews import BloggersListRetrieve
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Запросы к БД и время запроса к API (304 по ETag) с TokenAuthentication и с кэшем токенов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=200)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            user = User.objects.create_user(username='bench_token_user')
+            token = Token.objects.create(user=user)
+            factory = APIRequestFactory()
+
+            def view_for(authentication_class):
+                # Без троттлинга: он ограничил бы число запросов в замере
+                view = BloggersListRetrieve.as_view(
+                    {'get': 'retrieve'}, authentication_classes=[authentication_class], throttle_classes=[])
+                etag = view(factory.get('/', HTTP_AUTHORIZATION=f'Token {token.key}'), id=user.id)['ETag']
+                return lambda: view(
+                    factory.get('/', HTTP_AUTHORIZATION=f'Token {token.key}', HTTP_IF_NONE_MATCH=etag), id=user.id)
+
+            def evict_all():
+                cache.delete(token_cache_key(token.key))
+                local_tokens.clear()
+
+            plain = view_for(TokenAuthentication)
+            cached = view_for(CachedTokenAuthentication)
+            self.stdout.write(f'GET with If-None-Match (304), median of {options["repeat"]} requests')
+            for label, request, before in [
+                ('TokenAuthentication', plain, None),
+                ('cache miss', cached, evict_all),
+                ('shared cache hit', cached, local_tokens.clear),
+                ('local cache hit', cached, None),
+            ]:
+                queries, seconds = self.measure(request, before, options['repeat'])
+                self.stdout.write(f'{label:<20}: {queries} queries/request, {seconds * 1_000_000:8.1f} us')
+
+            transaction.set_rollback(True)
+
+    def measure(self, request, before, repeat):
+        timings = []
+        queries = 0
+        for _ in range(repeat):
+            if before is not None:
+                before()
+            with CaptureQueriesContext(connection) as context:
+                start = perf_counter()
+                response = request()
+                timings.append(perf_counter() - start)
+            assert response.status_code == 304, response.status_code
+            queries += len(context.captured_queries)
+        return queries / repeat, median(timings)
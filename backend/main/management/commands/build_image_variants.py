@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from main.jobs import default_name, enqueue_image
+from main.models import Blog, Blogger, ImageJob
+
+
+class Command(BaseCommand):
+    help = ('Ставит в очередь обработки изображения записей и аватары без производных (загруженные до их появления). '
+            'Производные картинок по умолчанию готовит publish_default_media')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Обработать заново и уже обработанные')
+
+    def handle(self, *args, **options):
+        total = 0
+        with transaction.atomic():
+            blogs = Blog.objects.exclude(image=default_name(ImageJob.Kind.BLOG_IMAGE))
+            for blog in blogs.only('image', 'image_variants').iterator():
+                if options['all'] or blog.image_variants.get('source') != blog.image.name:
+                    enqueue_image(ImageJob.Kind.BLOG_IMAGE, blog)
+                    total += 1
+            bloggers = Blogger.objects.exclude(avatar=default_name(ImageJob.Kind.BLOGGER_AVATAR))
+            for blogger in bloggers.only('user', 'avatar', 'avatar_variants').iterator():
+                if options['all'] or blogger.avatar_variants.get('source') != blogger.avatar.name:
+                    enqueue_image(ImageJob.Kind.BLOGGER_AVATAR, blogger)
+                    total += 1
+        self.stdout.write(f'Queued images: {total}')
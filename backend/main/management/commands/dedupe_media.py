@@ -0,0 +1,63 @@
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from main.constants import MEDIA_BLOBS_DIR, MEDIA_REFERENCES
+from main.images import delete_image
+from main.storage import ContentAddressedStorage, is_blob, references, reused_key
+
+
+class Command(BaseCommand):
+    help = 'Переносит загруженные ранее файлы в хранилище по содержимому и удаляет файлы, на которые нет ссылок'
+
+    def handle(self, *args, **options):
+        if not isinstance(default_storage, ContentAddressedStorage):
+            raise CommandError('Default storage is not main.storage.ContentAddressedStorage')
+        moved = self.move_legacy()
+        removed = self.remove_orphans()
+        self.stdout.write(f'Moved files: {moved}, removed orphans: {removed}')
+
+    def move_legacy(self) -> int:
+        ''' Файлы со старыми именами (images/photo.jpg) копируются в хранилище, ссылки меняются сохранением объектов:
+        django_cleanup удалит старый файл с производными, сигнал поставит новый в очередь обработки
+        '''
+        moved = 0
+        for model_name, field in MEDIA_REFERENCES:
+            model = apps.get_model(model_name)
+            default = model._meta.get_field(field).default
+            names = (model._base_manager.exclude(**{field: default}).exclude(**{f'{field}__startswith': f'{MEDIA_BLOBS_DIR}/'})
+                     .values_list(field, flat=True).distinct())
+            for name in list(names):
+                if not name or not default_storage.exists(name):
+                    continue
+                with default_storage.open(name) as file:
+                    new_name = default_storage.save(name, file)
+                with transaction.atomic():
+                    for instance in model._base_manager.filter(**{field: name}):
+                        setattr(instance, field, new_name)
+                        instance.save(update_fields=[field])
+                moved += 1
+        return moved
+
+    def remove_orphans(self) -> int:
+        ''' Файлы без ссылок, которые не удалились сразу (их повторно загружали в пределах MEDIA_REUSE_GRACE_SECONDS),
+        и временные файлы прерванных загрузок. Свежие файлы не трогаются: ссылка на них может быть еще не сохранена
+        '''
+        removed = 0
+        deadline = time.time() - settings.MEDIA_REUSE_GRACE_SECONDS
+        for name in list(default_storage.blobs()):
+            if default_storage.get_modified_time(name).timestamp() > deadline:
+                continue
+            if is_blob(name):
+                if references(name) or cache.get(reused_key(name)):
+                    continue
+                delete_image(name)
+            else:
+                default_storage.delete(name)
+            removed += 1
+        return removed
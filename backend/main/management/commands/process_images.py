@@ -0,0 +1,66 @@
+import multiprocessing
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+# Процессы пула (spawn) импортируют этот модуль до django.setup(), поэтому main.jobs с моделями
+# импортируется внутри функций, а не здесь
+
+
+def init_worker():
+    ''' Инициализация процесса пула: новый интерпретатор, Django настраивается заново '''
+    import django
+    django.setup()
+
+
+def run_job(job_id: int) -> str:
+    from main.jobs import run_job
+    return run_job(job_id)
+
+
+class Command(BaseCommand):
+    help = 'Фоновая обработка загруженных изображений из очереди ImageJob пулом процессов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=settings.IMAGE_WORKER_PROCESSES,
+                            help='Размер пула, 0 - обрабатывать в этом процессе')
+        parser.add_argument('--batch', type=int, default=20, help='Сколько заданий захватывать за раз')
+        parser.add_argument('--poll', type=float, default=2, help='Пауза при пустой очереди, секунд')
+        parser.add_argument('--once', action='store_true', help='Обработать очередь и выйти')
+
+    def handle(self, *args, **options):
+        if options['processes'] == 0:
+            self.run_inline(options)
+        else:
+            self.run_pool(options)
+
+    def run_inline(self, options):
+        from main.jobs import run_pending_jobs
+
+        while True:
+            total = run_pending_jobs(options['batch'])
+            if total:
+                self.stdout.write(f'Processed jobs: {total}')
+            if options['once']:
+                return
+            time.sleep(options['poll'])
+
+    def run_pool(self, options):
+        from main.jobs import claim_jobs
+
+        # spawn: дочерние процессы не наследуют открытые соединения с БД родителя
+        connections.close_all()
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(options['processes'], initializer=init_worker) as pool:
+            while True:
+                ids = claim_jobs(options['batch'])
+                if ids:
+                    statuses = pool.map(run_job, ids)
+                    self.stdout.write(f'Processed jobs: {len(ids)}, failed or retried: '
+                                      f'{sum(status != "done" for status in statuses)}')
+                    continue
+                if options['once']:
+                    return
+                time.sleep(options['poll'])
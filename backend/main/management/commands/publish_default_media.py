@@ -0,0 +1,63 @@
+import hashlib
+import json
+import os
+import posixpath
+import tempfile
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.core.management.base import BaseCommand
+
+from main.constants import DEFAULT_MEDIA_MANIFEST, DEFAULT_VARIANTS_MANIFEST
+from main.images import make_derivatives
+from main.jobs import IMAGE_TARGETS
+from main.models import BloggerStats
+from main.storage import compress
+
+
+class Command(BaseCommand):
+    help = ('Публикует картинки по умолчанию из MEDIA_ROOT под именами с хэшем содержимого, с производными '
+            'и сжатыми копиями, - для вечного кэширования в nginx, и записывает описание производных объектам '
+            'с картинкой по умолчанию. Запускать при развертывании и после замены картинок, работающие процессы '
+            'подхватывают новые манифесты без перезапуска')
+
+    def handle(self, *args, **options):
+        # Обычное хранилище в том же каталоге: файлы пишутся под точными именами, без хранилища по содержимому
+        storage = FileSystemStorage(location=settings.MEDIA_ROOT)
+        published, published_variants = {}, {}
+        for model, _, field, widths in IMAGE_TARGETS.values():
+            name = model._meta.get_field(field).default
+            if not storage.exists(name):
+                self.stderr.write(f'Default file is missing: {name}')
+                continue
+            with storage.open(name) as file:
+                content = file.read()
+            # Схема имен как у ManifestStaticFilesStorage: default_image.3f2a1b9c0d4e.jpg
+            root, extension = posixpath.splitext(name)
+            hashed = f'{root}.{hashlib.md5(content, usedforsecurity=False).hexdigest()[:12]}{extension}'
+            if not storage.exists(hashed):
+                storage.save(hashed, ContentFile(content))
+            variants = make_derivatives(hashed, widths, storage)
+            compress(storage, hashed, overwrite=False)
+            published[name] = hashed
+            # В описании исходные имена: ссылки на них ведут на опубликованные копии (published_name хранилища)
+            variants['source'] = name
+            for variant in variants['variants']:
+                variant['name'] = name + variant['name'].removeprefix(hashed)
+            published_variants[name] = variants
+            model._base_manager.filter(**{field: name}).update(**{f'{field}_variants': variants})
+            if field == 'avatar':
+                BloggerStats.objects.filter(avatar=name).update(avatar_variants=variants)
+
+        for manifest, content in ((DEFAULT_MEDIA_MANIFEST, published), (DEFAULT_VARIANTS_MANIFEST, published_variants)):
+            # Манифест читают работающие процессы (ContentAddressedStorage.read_manifest): файл заменяется целиком
+            file, temp = tempfile.mkstemp(dir=storage.location, prefix=f'.{manifest}.')
+            with os.fdopen(file, 'w') as file:
+                json.dump(content, file, indent=2)
+            os.chmod(temp, 0o644)
+            os.replace(temp, storage.path(manifest))
+        if hasattr(default_storage, 'reload_published'):
+            default_storage.reload_published()
+        for name, hashed in published.items():
+            self.stdout.write(f'{name} -> {hashed}')
@@ -0,0 +1,29 @@
+from itertools import islice
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from main.models import BloggerStats
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает таблицу статистики блогеров с нуля (первичное заполнение и исправление расхождений)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        stats = BloggerStats.objects.computed(User.objects.all(), options['batch'])
+
+        total = 0
+        with transaction.atomic():
+            BloggerStats.objects.all().delete()
+            # bulk_create материализует весь список, поэтому кормим его порциями
+            while batch := list(islice(stats, options['batch'])):
+                BloggerStats.objects.bulk_create(batch)
+                total += len(batch)
+
+        self.stdout.write(f'Rebuilt stats: {total}')
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from main.models import Blog, Comment
+
+
+def actual_comments_count():
+    comments = (Comment.objects.filter(to_blog=OuterRef('pk'))
+                .order_by().values('to_blog').annotate(total=Count('id')).values('total'))
+    return Coalesce(Subquery(comments), Value(0))
+
+
+class Command(BaseCommand):
+    help = 'Сверяет Blog.comments_count с фактическим числом комментариев и исправляет расхождения'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Только показать число расхождений')
+
+    def handle(self, *args, **options):
+        drifted = Blog.objects.exclude(comments_count=actual_comments_count())
+        if options['dry_run']:
+            self.stdout.write(f'Drifted blogs: {drifted.count()}')
+            return
+        fixed = drifted.update(comments_count=actual_comments_count(), updated=timezone.now())
+        self.stdout.write(f'Fixed blogs: {fixed}')
@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from main.models import OutboxEmail
+from main.outbox import send_pending_emails
+
+
+class Command(BaseCommand):
+    help = ('Отправка писем из очереди OutboxEmail: пачками через одно SMTP-соединение, с повторами '
+            'и дайджестами уведомлений получателю')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=100, help='Сколько писем захватывать за раз')
+        parser.add_argument('--poll', type=float, default=5, help='Пауза при пустой очереди, секунд')
+        parser.add_argument('--once', action='store_true', help='Отправить очередь и выйти')
+
+    def handle(self, *args, **options):
+        # Несколько обработчиков могут работать параллельно: письма захватываются с SKIP LOCKED
+        while True:
+            statuses = send_pending_emails(options['batch'])
+            if statuses:
+                sent = statuses.count(OutboxEmail.Status.SENT)
+                self.stdout.write(f'Sent emails: {sent}, failed or retried: {len(statuses) - sent}')
+            if options['once']:
+                return
+            time.sleep(options['poll'])
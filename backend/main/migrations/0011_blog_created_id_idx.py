@@ -0,0 +1,19 @@
+# Generated by Django 5.1.4 on 2026-10-18 19:12
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0010_alter_blog_image'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='blog',
+            index=models.Index(fields=['-created', 'id'], name='blog_created_id_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.1.4 on 2026-10-18 19:31
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def fill_comments_count(apps, schema_editor):
+    Blog = apps.get_model('main', 'Blog')
+    Comment = apps.get_model('main', 'Comment')
+    comments = (Comment.objects.filter(to_blog=OuterRef('pk'))
+                .order_by().values('to_blog').annotate(total=Count('id')).values('total'))
+    Blog.objects.update(comments_count=Coalesce(Subquery(comments), Value(0)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0011_blog_created_id_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blog',
+            name='comments_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_comments_count, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 5.1.4 on 2026-10-18 19:17
+
+from itertools import islice
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import CharField, Count, F, Max, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def fill_blogger_stats(apps, schema_editor):
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    Comment = apps.get_model('main', 'Comment')
+    BloggerStats = apps.get_model('main', 'BloggerStats')
+    comments_received = (Comment.objects.filter(to_blog__author=OuterRef('pk'))
+                         .order_by().values('to_blog__author').annotate(total=Count('id')).values('total'))
+    users = User.objects.order_by().annotate(
+        nr_blogs=Count('blogs'),
+        nr_comments=Coalesce(Subquery(comments_received), Value(0)),
+        last_post=Max('blogs__created'),
+        avatar_path=Coalesce(F('blogger__avatar'), Value('default_avatar.png'), output_field=CharField()),
+    ).values_list('id', 'nr_blogs', 'nr_comments', 'last_post', 'avatar_path')
+    stats = (BloggerStats(user_id=user_id, blogs_count=nr_blogs, comments_received=nr_comments,
+                          last_post=last_post, avatar=avatar)
+             for user_id, nr_blogs, nr_comments, last_post, avatar in users.iterator(chunk_size=1000))
+    while batch := list(islice(stats, 1000)):
+        BloggerStats.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('main', '0012_blog_comments_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BloggerStats',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('blogs_count', models.PositiveIntegerField(default=0)),
+                ('comments_received', models.PositiveIntegerField(default=0)),
+                ('last_post', models.DateTimeField(blank=True, null=True)),
+                ('avatar', models.CharField(default='default_avatar.png', max_length=100)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['-blogs_count', 'user'], name='bloggerstats_top_idx')],
+            },
+        ),
+        migrations.RunPython(fill_blogger_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.1.4 on 2026-10-18 19:24
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0013_bloggerstats'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        # Сначала составные индексы, потом удаление индексов FK - чтобы не остаться без индекса
+        migrations.AddIndex(
+            model_name='blog',
+            index=models.Index(fields=['author', '-created'], include=('id', 'title', 'comments_count'), name='blog_author_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['to_blog', 'created', 'id'], name='comment_blog_created_idx'),
+        ),
+        migrations.AlterField(
+            model_name='blog',
+            name='author',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='blogs', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='comment',
+            name='to_blog',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='comments', to='main.blog'),
+        ),
+    ]
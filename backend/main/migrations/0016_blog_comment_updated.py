@@ -0,0 +1,31 @@
+# Generated by Django 5.1.4 on 2026-10-18 19:59
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def fill_updated(apps, schema_editor):
+    # Существующие записи и комментарии с момента создания не менялись (изменения не отслеживались)
+    for model_name in ('Blog', 'Comment'):
+        apps.get_model('main', model_name).objects.update(updated=F('created'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0015_blog_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blog',
+            name='updated',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='updated',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.RunPython(fill_updated, migrations.RunPython.noop),
+    ]
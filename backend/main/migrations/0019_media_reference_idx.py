@@ -0,0 +1,23 @@
+# Generated by Django 5.1.4 on 2026-10-18 20:36
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0018_imagejob'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='blog',
+            index=models.Index(fields=['image'], name='blog_image_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='blogger',
+            index=models.Index(fields=['avatar'], name='blogger_avatar_idx'),
+        ),
+    ]
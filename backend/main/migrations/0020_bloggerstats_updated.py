@@ -0,0 +1,24 @@
+# Generated by Django 5.1.4 on 2026-10-18 21:20
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0019_media_reference_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bloggerstats',
+            name='updated',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='bloggerstats',
+            index=models.Index(fields=['updated'], name='bloggerstats_updated_idx'),
+        ),
+    ]
@@ -1,12 +1,27 @@
 from django.contrib.auth.models import User
-from django.db.models import DateTimeField, CASCADE, CharField, ForeignKey, ImageField, Model, OneToOneField, TextField
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
+from django.db.models import DateTimeField, CASCADE, CharField, EmailField, ForeignKey, GeneratedField, ImageField, Index, JSONField, Manager, Model, OneToOneField, PositiveBigIntegerField, PositiveIntegerField, Q, TextField, TextChoices
+from django.db.models import Count, F, Max, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
 from django.urls import reverse
+from django.utils import timezone
+
+from .constants import SEARCH_CONFIG
 
 
 class Blogger(Model):
     user = OneToOneField(User, unique=True, on_delete=CASCADE, related_name='blogger')
     bio = TextField(max_length=1000, null=True, blank=True)
     avatar = ImageField(upload_to='avatars/', null=False, blank=False, default='default_avatar.png')
+    # Уменьшенные копии аватара и их размеры (main.images), заполняется сигналом после сохранения
+    avatar_variants = JSONField(default=dict, blank=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # Подсчет ссылок на файл в хранилище по содержимому (main.storage)
+            Index(fields=['avatar'], name='blogger_avatar_idx'),
+        ]
 
     def __str__(self):
         return f'Блогер: {self.user.username}'
@@ -15,15 +30,45 @@ class Blogger(Model):
         return reverse('blogger_page', kwargs={'author_id': self.user.pk})
 
 
+class BlogManager(Manager):
+
+    def get_queryset(self):
+        # Поисковый вектор нужен только в условиях поиска, читать его с каждой записью незачем
+        return super().get_queryset().defer('search_vector')
+
+
 class Blog(Model):
     title = CharField(max_length=50)
     content = TextField(max_length=20000)
     created = DateTimeField(auto_now_add=True)
-    author = ForeignKey(to=User, on_delete=CASCADE, related_name='blogs')
+    # Версия записи для кэша фрагментов шаблонов, меняется и при изменении числа комментариев
+    updated = DateTimeField(auto_now=True)
+    # Отдельный индекс по FK не нужен, его заменяет составной blog_author_created_idx
+    author = ForeignKey(to=User, on_delete=CASCADE, related_name='blogs', db_index=False)
     image = ImageField(upload_to='images/', null=False, blank=False, default='default_image.jpg')
+    # Уменьшенные копии изображения в разных форматах и их размеры (main.images), заполняется сигналом
+    image_variants = JSONField(default=dict, blank=True, editable=False)
+    # Денормализованный счетчик, поддерживается сигналами Comment (см. signals.py)
+    comments_count = PositiveIntegerField(default=0, editable=False)
+    # Полнотекстовый поиск: вектор считает сама БД при вставке и изменении записи
+    search_vector = GeneratedField(
+        expression=SearchVector('title', weight='A', config=SEARCH_CONFIG) + SearchVector('content', weight='B', config=SEARCH_CONFIG),
+        output_field=SearchVectorField(),
+        db_persist=True)
+
+    objects = BlogManager()
 
     class Meta:
         ordering = ['-created', ]
+        indexes = [
+            # Keyset-пагинация списка записей
+            Index(fields=['-created', 'id'], name='blog_created_id_idx'),
+            # Записи блогера: фильтр по автору + сортировка, колонки списка покрываются индексом
+            Index(fields=['author', '-created'], name='blog_author_created_idx', include=['id', 'title', 'comments_count']),
+            GinIndex(fields=['search_vector'], name='blog_search_vector_idx'),
+            # Подсчет ссылок на файл в хранилище по содержимому (main.storage)
+            Index(fields=['image'], name='blog_image_idx'),
+        ]
 
     def __str__(self):
         return f'Запись: {self.title[:10]}'
@@ -33,13 +78,146 @@ class Blog(Model):
 
 
 class Comment(Model):
-    to_blog = ForeignKey(to=Blog, on_delete=CASCADE, related_name='comments')
+    # Отдельный индекс по FK не нужен, его заменяет составной comment_blog_created_idx
+    to_blog = ForeignKey(to=Blog, on_delete=CASCADE, related_name='comments', db_index=False)
     text = TextField(max_length=1000)
     author = ForeignKey(to=User, on_delete=CASCADE, related_name='comments_by_author')
     created = DateTimeField(auto_now_add=True)
+    updated = DateTimeField(auto_now=True)
 
     class Meta:
         ordering = ['created', ]
+        indexes = [
+            # Комментарии к записи постранично в порядке (created, id)
+            Index(fields=['to_blog', 'created', 'id'], name='comment_blog_created_idx'),
+        ]
+
+    def __str__(self):
+        return f'Комментарий: {self.text[:10]}'
+
+class BloggerStatsManager(Manager):
+
+    def computed(self, users, chunk_size: int = 1000):
+        ''' Статистика пользователей users (QuerySet User), посчитанная заново по записям и комментариям, без сохранения '''
+        comments_received = (Comment.objects.filter(to_blog__author=OuterRef('pk'))
+                             .order_by().values('to_blog__author').annotate(total=Count('id')).values('total'))
+        rows = users.order_by().annotate(
+            nr_blogs=Count('blogs'),
+            nr_comments=Coalesce(Subquery(comments_received), Value(0)),
+            last_post=Max('blogs__created'),
+            avatar_path=Coalesce(F('blogger__avatar'), Value('default_avatar.png'), output_field=CharField()),
+        ).values_list('id', 'nr_blogs', 'nr_comments', 'last_post', 'avatar_path', 'blogger__avatar_variants')
+        return (self.model(user_id=user_id, blogs_count=nr_blogs, comments_received=nr_comments,
+                           last_post=last_post, avatar=avatar, avatar_variants=avatar_variants or {})
+                for user_id, nr_blogs, nr_comments, last_post, avatar, avatar_variants
+                in rows.iterator(chunk_size=chunk_size))
+
+    def ensure(self, user_id):
+        ''' Запись статистики пользователя, созданного в обход post_save (bulk_create, фикстуры, SQL) '''
+        self.bulk_create(self.computed(User.objects.filter(pk=user_id)), ignore_conflicts=True)
+
+
+class BloggerStats(Model):
+    ''' Предрасчитанная статистика блогера, поддерживается сигналами (см. signals.py) '''
+    user = OneToOneField(User, primary_key=True, on_delete=CASCADE, related_name='stats')
+    blogs_count = PositiveIntegerField(default=0)
+    comments_received = PositiveIntegerField(default=0)
+    last_post = DateTimeField(null=True, blank=True)
+    avatar = CharField(max_length=100, default='default_avatar.png')
+    avatar_variants = JSONField(default=dict, blank=True)
+    # Последнее изменение того, что видно в списке блогеров (число записей, аватар): по нему HTMX-обновление
+    # списка выбирает только изменившиеся строки. Сигналы обновляют статистику через update(), поэтому
+    # выставляют его сами; comments_received в списке не виден и его не меняет
+    updated = DateTimeField(auto_now=True)
+
+    objects = BloggerStatsManager()
+
+    class Meta:
+        indexes = [
+            # Топ блогеров читается прямо из индекса, без агрегации и сортировки
+            Index(fields=['-blogs_count', 'user'], name='bloggerstats_top_idx'),
+            Index(fields=['updated'], name='bloggerstats_updated_idx'),
+        ]
+
+    def __str__(self):
+        return f'Статистика: {self.user_id}'
+
+
+class ImageJob(Model):
+    ''' Очередь фоновой обработки загруженных изображений в БД (см. main.jobs и команду process_images).
+    Задание создается в той же транзакции, что и запись с новым файлом, поэтому не теряется
+    '''
+
+    class Kind(TextChoices):
+        BLOG_IMAGE = 'blog_image'
+        BLOGGER_AVATAR = 'blogger_avatar'
+
+    class Status(TextChoices):
+        PENDING = 'pending'
+        RUNNING = 'running'
+        DONE = 'done'
+        FAILED = 'failed'
+
+    kind = CharField(max_length=20, choices=Kind)
+    # id записи или пользователя (Blogger.user_id) и имя файла, который нужно обработать
+    object_id = PositiveBigIntegerField()
+    name = CharField(max_length=100)
+    status = CharField(max_length=10, choices=Status, default=Status.PENDING)
+    attempts = PositiveIntegerField(default=0)
+    # Не раньше какого времени брать задание: повтор после ошибки откладывается
+    run_after = DateTimeField(default=timezone.now)
+    # Когда задание взял обработчик - зависшее задание возвращается в очередь
+    started = DateTimeField(null=True, blank=True)
+    last_error = TextField(blank=True)
+    created = DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Выборка очереди читает только незавершенные задания
+            Index(fields=['run_after'], name='imagejob_queue_idx', condition=Q(status__in=['pending', 'running'])),
+        ]
+
+    def __str__(self):
+        return f'Обработка {self.kind} {self.object_id}: {self.status}'
+
+
+class OutboxEmail(Model):
+    ''' Исходящие письма (transactional outbox, см. main.outbox и команду send_emails). Письмо записывается
+    в той же транзакции, что и действие, которое его вызвало, а отправляет его обработчик очереди:
+    запрос не ждет SMTP, а откат действия отменяет и письмо
+    '''
+
+    class Kind(TextChoices):
+        CONTACT = 'contact'
+        COMMENT = 'comment'
+
+    class Status(TextChoices):
+        PENDING = 'pending'
+        SENDING = 'sending'
+        SENT = 'sent'
+        FAILED = 'failed'
+
+    kind = CharField(max_length=20, choices=Kind)
+    recipient = EmailField()
+    subject = CharField(max_length=200)
+    body = TextField()
+    status = CharField(max_length=10, choices=Status, default=Status.PENDING)
+    attempts = PositiveIntegerField(default=0)
+    # Не раньше какого времени отправлять: повтор после ошибки и накопление дайджеста откладывают письмо
+    run_after = DateTimeField(default=timezone.now)
+    # Когда письмо взял обработчик - зависшее письмо возвращается в очередь
+    started = DateTimeField(null=True, blank=True)
+    sent = DateTimeField(null=True, blank=True)
+    last_error = TextField(blank=True)
+    created = DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Выборка очереди читает только неотправленные письма
+            Index(fields=['run_after'], name='outbox_queue_idx', condition=Q(status__in=['pending', 'sending'])),
+            # Ожидающие уведомления получателя, которые добавляются в его дайджест
+            Index(fields=['recipient', 'kind'], name='outbox_digest_idx', condition=Q(status='pending')),
+        ]
 
     def __str__(self):
-        return f'Комментарий: {self.text[:10]}'
\ No newline at end of file
+        return f'Письмо {self.kind} для {self.recipient}: {self.status}'
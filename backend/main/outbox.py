@@ -0,0 +1,133 @@
+import logging
+from datetime import timedelta
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import Blog, Comment, OutboxEmail
+
+logger = logging.getLogger(__name__)
+
+# Виды писем, которые копятся OUTBOX_DIGEST_DELAY секунд и уходят получателю одним письмом
+DIGEST_KINDS = (OutboxEmail.Kind.COMMENT, )
+DIGEST_SUBJECTS = {OutboxEmail.Kind.COMMENT: '{count} new comments on your blog'}
+
+
+def enqueue_email(kind: str, recipient: str, subject: str, body: str) -> OutboxEmail:
+    ''' Письмо в очередь. Вызывается в транзакции действия, откат которого должен отменить и письмо '''
+    delay = settings.OUTBOX_DIGEST_DELAY if kind in DIGEST_KINDS else 0
+    return OutboxEmail.objects.create(kind=kind, recipient=recipient, subject=subject, body=body,
+                                      run_after=timezone.now() + timedelta(seconds=delay))
+
+
+def notify_blog_author(comment: Comment):
+    ''' Уведомление автору записи о новом комментарии, вызывается из post_save.
+    Свои комментарии не уведомляются, без email у автора уведомлять некого
+    '''
+    blog = Blog.objects.select_related('author').only('title', 'author__email').get(pk=comment.to_blog_id)
+    if not blog.author.email or blog.author_id == comment.author_id:
+        return
+    enqueue_email(
+        OutboxEmail.Kind.COMMENT, blog.author.email,
+        subject=f'New comment on "{blog.title}"',
+        body=f'{comment.author.username} commented on "{blog.title}":\n\n{comment.text}\n\n'
+             f'{settings.SITE_URL}{blog.get_absolute_url()}')
+
+
+def claim_emails(limit: int) -> list[list[int]]:
+    ''' Атомарный захват до limit готовых писем (SKIP LOCKED, как у заданий main.jobs), сгруппированных
+    по отправляемым письмам. Уведомления одному получателю - один дайджест, в него попадают и его
+    еще не созревшие уведомления. Письмо, которое обработчик не отправил за OUTBOX_TIMEOUT секунд
+    (процесс упал), захватывается заново
+    '''
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.OUTBOX_TIMEOUT)
+    with transaction.atomic():
+        due = list(OutboxEmail.objects.select_for_update(skip_locked=True).filter(
+            Q(status=OutboxEmail.Status.PENDING, run_after__lte=now) |
+            Q(status=OutboxEmail.Status.SENDING, started__lt=stale),
+        ).order_by('run_after').values_list('id', 'kind', 'recipient')[:limit])
+
+        singles, digests = [], {}
+        for email_id, kind, recipient in due:
+            if kind in DIGEST_KINDS:
+                digests.setdefault((kind, recipient), []).append(email_id)
+            else:
+                singles.append([email_id])
+        if digests:
+            waiting = OutboxEmail.objects.select_for_update(skip_locked=True).filter(
+                reduce(or_, (Q(kind=kind, recipient=recipient) for kind, recipient in digests)),
+                status=OutboxEmail.Status.PENDING,
+            ).exclude(id__in=[email_id for email_id, _, _ in due]).values_list('id', 'kind', 'recipient')
+            for email_id, kind, recipient in waiting:
+                digests[kind, recipient].append(email_id)
+
+        groups = singles + list(digests.values())
+        OutboxEmail.objects.filter(id__in=[email_id for group in groups for email_id in group]).update(
+            status=OutboxEmail.Status.SENDING, started=now, attempts=F('attempts') + 1)
+    return groups
+
+
+def build_message(emails: list[OutboxEmail], connection) -> EmailMessage:
+    first = emails[0]
+    if len(emails) == 1:
+        subject, body = first.subject, first.body
+    else:
+        subject = DIGEST_SUBJECTS[first.kind].format(count=len(emails))
+        body = '\n\n---\n\n'.join(email.body for email in emails)
+    return EmailMessage(subject, body, to=[first.recipient], connection=connection)
+
+
+def fail_emails(emails: list[OutboxEmail], error: Exception) -> str:
+    ''' Повтор с экспоненциальной задержкой до OUTBOX_MAX_ATTEMPTS попыток, затем письмо остается в failed '''
+    now = timezone.now()
+    for email in emails:
+        email.last_error = repr(error)
+        if email.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+            email.status = OutboxEmail.Status.FAILED
+        else:
+            email.status = OutboxEmail.Status.PENDING
+            email.run_after = now + timedelta(seconds=settings.OUTBOX_RETRY_DELAY * 2 ** (email.attempts - 1))
+    OutboxEmail.objects.bulk_update(emails, ['status', 'run_after', 'last_error'])
+    return emails[0].status
+
+
+def send_group(ids: list[int], connection) -> str:
+    ''' Отправка одного письма (или дайджеста) из захваченных. Доставка - как минимум однократная:
+    если письмо ушло, а отметка об этом не записалась, оно уйдет повторно
+    '''
+    emails = list(OutboxEmail.objects.filter(id__in=ids).order_by('created', 'id'))
+    try:
+        build_message(emails, connection).send()
+    except Exception as error:
+        logger.exception('Email %s to %s failed', ids, emails[0].recipient)
+        return fail_emails(emails, error)
+    OutboxEmail.objects.filter(id__in=ids).update(status=OutboxEmail.Status.SENT, sent=timezone.now(), last_error='')
+    return OutboxEmail.Status.SENT
+
+
+def send_groups(groups: list[list[int]]) -> list[str]:
+    ''' Отправка захваченной пачки через одно SMTP-соединение. Сервер недоступен - вся пачка уходит на повтор '''
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception as error:
+        logger.exception('SMTP connection failed')
+        return [fail_emails(list(OutboxEmail.objects.filter(id__in=ids)), error) for ids in groups]
+    try:
+        return [send_group(ids, connection) for ids in groups]
+    finally:
+        connection.close()
+
+
+def send_pending_emails(batch: int = 100) -> list[str]:
+    ''' Отправка очереди до опустошения, статусы отправленных писем '''
+    statuses = []
+    while groups := claim_emails(batch):
+        statuses += send_groups(groups)
+    return statuses
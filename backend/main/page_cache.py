@@ -0,0 +1,216 @@
+import hashlib
+import time
+from http import HTTPStatus
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse
+from django.template.response import SimpleTemplateResponse
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+
+from .stampede import aget_versioned, get_versioned
+
+
+def generation_key(namespace: str) -> str:
+    return f'pagegen:{namespace}'
+
+
+def get_generations(namespaces: list[str]) -> list[int]:
+    keys = [generation_key(namespace) for namespace in namespaces]
+    generations = cache.get_many(keys)
+    for key in keys:
+        if key not in generations:
+            # Начальное поколение - текущее время: после вытеснения ключа старые страницы не оживут
+            cache.add(key, time.time_ns(), None)
+            generations[key] = cache.get(key)
+    return [generations[key] for key in keys]
+
+
+async def aget_generations(namespaces: list[str]) -> list[int]:
+    keys = [generation_key(namespace) for namespace in namespaces]
+    generations = await cache.aget_many(keys)
+    for key in keys:
+        if key not in generations:
+            await cache.aadd(key, time.time_ns(), None)
+            generations[key] = await cache.aget(key)
+    return [generations[key] for key in keys]
+
+
+def invalidate_pages(*namespaces: str):
+    ''' Новое поколение пространств имен - все закэшированные страницы, которые от них зависят, перестают читаться.
+    Выполняется после коммита, иначе параллельный запрос успеет закэшировать старые данные под новым поколением
+    '''
+    def bump():
+        for namespace in namespaces:
+            try:
+                cache.incr(generation_key(namespace))
+            except ValueError:
+                cache.set(generation_key(namespace), time.time_ns(), None)
+
+    transaction.on_commit(bump)
+
+
+def page_cache_key(request) -> str:
+    url = hashlib.md5(request.get_full_path().encode()).hexdigest()
+    return f'page:{url}'
+
+
+def page_etag(request, namespaces: list[str], user_id=None) -> str:
+    ''' Слабый ETag: одинаковые URL, пользователь, версия приложения и поколения данных - одинаковая страница '''
+    return etag_for_generations(request, get_generations(namespaces), user_id)
+
+
+async def apage_etag(request, namespaces: list[str], user_id=None) -> str:
+    return etag_for_generations(request, await aget_generations(namespaces), user_id)
+
+
+def etag_for_generations(request, generations: list[int], user_id=None) -> str:
+    generations = ':'.join(str(generation) for generation in generations)
+    source = f'{settings.RELEASE}:{request.get_full_path()}:{user_id}:{generations}'
+    return f'W/"{hashlib.md5(source.encode()).hexdigest()}"'
+
+
+class ConditionalGetMixin:
+    ''' ETag страницы по поколениям ее данных (get_page_cache_namespaces): запрос с совпадающим If-None-Match
+    получает 304 без рендера и без запросов к данным. У авторизованного пользователя страница персональная,
+    его id берется из сессии без загрузки пользователя, а в поколения добавляется его профиль (шапка страницы).
+    У асинхронного представления (view_is_async) сессия и поколения читаются без блокировки event loop
+    '''
+
+    def get_page_cache_namespaces(self) -> list[str]:
+        return []
+
+    def conditional_get_enabled(self, request) -> bool:
+        return request.method in ('GET', 'HEAD') and 'messages' not in request.COOKIES
+
+    def get_etag_namespaces(self, user_id) -> list[str]:
+        namespaces = self.get_page_cache_namespaces()
+        if user_id is not None:
+            namespaces = [*namespaces, f'blogger:{user_id}']
+        return namespaces
+
+    def dispatch(self, request, *args, **kwargs):
+        if self.view_is_async:
+            return self.conditional_adispatch(request, *args, **kwargs)
+        if not self.conditional_get_enabled(request):
+            return super().dispatch(request, *args, **kwargs)
+
+        user_id = request.session.get(SESSION_KEY)
+        etag = page_etag(request, self.get_etag_namespaces(user_id), user_id)
+
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = super().dispatch(request, *args, **kwargs)
+            etag = self.served_etag(request, response, etag, user_id)
+        return self.patch_conditional_response(response, etag, user_id)
+
+    async def conditional_adispatch(self, request, *args, **kwargs):
+        if not self.conditional_get_enabled(request):
+            return await super().dispatch(request, *args, **kwargs)
+
+        user_id = await request.session.aget(SESSION_KEY)
+        etag = await apage_etag(request, self.get_etag_namespaces(user_id), user_id)
+
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = await super().dispatch(request, *args, **kwargs)
+            etag = self.served_etag(request, response, etag, user_id)
+        return self.patch_conditional_response(response, etag, user_id)
+
+    def served_etag(self, request, response, etag: str, user_id) -> str:
+        # Кэш страниц отдал устаревшую страницу, пока ее пересчитывает другой процесс (AnonymousPageCacheMixin):
+        # ETag по ее поколениям, иначе браузер сохранит ее под свежим ETag и будет получать 304 до следующего изменения
+        generations = getattr(response, 'page_cache_generations', None)
+        if generations is None:
+            return etag
+        return etag_for_generations(request, generations, user_id)
+
+    def patch_conditional_response(self, response, etag: str, user_id):
+        if response.status_code in (HTTPStatus.OK, HTTPStatus.NOT_MODIFIED):
+            response.headers['ETag'] = etag
+            # Браузер (и HTMX-запросы) хранит страницу, но каждый раз сверяет ETag
+            patch_cache_control(response, no_cache=True, private=user_id is not None)
+        patch_vary_headers(response, ['Cookie'])
+        return response
+
+
+class AnonymousPageCacheMixin:
+    ''' Кэш страницы целиком для анонимных GET-запросов, ключ - URL с параметрами, версия - поколения
+    пространств имен страницы (get_page_cache_namespaces). Сигналы меняют поколения при изменении записей,
+    комментариев и блогеров, и страница считается устаревшей. Пересчитывает ее один запрос, остальные
+    в это время получают устаревшую (main.stampede), так что воркеры не рендерят одну страницу одновременно.
+    Авторизованные пользователи получают персональную страницу (ссылки автора, удаление своих комментариев).
+    У асинхронного представления пользователь загружается через auser(): ленивый request.user
+    в асинхронном коде к БД обращаться не может
+    '''
+
+    def get_page_cache_namespaces(self) -> list[str]:
+        return []
+
+    def page_cacheable(self, request) -> bool:
+        # Непоказанные сообщения (messages) должны попасть на страницу этого пользователя
+        return (settings.PAGE_CACHE_SECONDS > 0 and request.method in ('GET', 'HEAD')
+                and not request.user.is_authenticated and 'messages' not in request.COOKIES)
+
+    def dispatch(self, request, *args, **kwargs):
+        if self.view_is_async:
+            return self.page_cache_adispatch(request, *args, **kwargs)
+        if not self.page_cacheable(request):
+            return super().dispatch(request, *args, **kwargs)
+
+        parent_dispatch = super().dispatch
+        rendered = []
+
+        def render():
+            response = parent_dispatch(request, *args, **kwargs)
+            if isinstance(response, SimpleTemplateResponse):
+                response.render()
+            rendered.append(response)
+            return self.page_cache_entry(response)
+
+        generations = get_generations(self.get_page_cache_namespaces())
+        cached, served = get_versioned(
+            page_cache_key(request), render, settings.PAGE_CACHE_SECONDS, version=generations)
+        if rendered:
+            return rendered[0]
+        return self.cached_response(cached, served, generations)
+
+    async def page_cache_adispatch(self, request, *args, **kwargs):
+        request.user = await request.auser()
+        if not self.page_cacheable(request):
+            return await super().dispatch(request, *args, **kwargs)
+
+        parent_dispatch = super().dispatch
+        rendered = []
+
+        async def render():
+            response = await parent_dispatch(request, *args, **kwargs)
+            if isinstance(response, SimpleTemplateResponse):
+                # Рендер в потоке, как у самого Django для TemplateResponse под ASGI
+                await sync_to_async(response.render)()
+            rendered.append(response)
+            return self.page_cache_entry(response)
+
+        generations = await aget_generations(self.get_page_cache_namespaces())
+        cached, served = await aget_versioned(
+            page_cache_key(request), render, settings.PAGE_CACHE_SECONDS, version=generations)
+        if rendered:
+            return rendered[0]
+        return self.cached_response(cached, served, generations)
+
+    def cached_response(self, cached: tuple[bytes, str], served: list[int], generations: list[int]) -> HttpResponse:
+        content, content_type = cached
+        response = HttpResponse(content, content_type=content_type)
+        if served != generations:
+            # Устаревшая страница: ConditionalGetMixin строит ETag по ее поколениям
+            response.page_cache_generations = served
+        return response
+
+    def page_cache_entry(self, response) -> tuple[bytes, str] | None:
+        # Ответ с cookie (например, удаление прочитанных сообщений) - персональный
+        if response.status_code == HTTPStatus.OK and not response.cookies:
+            return response.content, response['Content-Type']
+        return None
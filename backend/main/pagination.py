@@ -0,0 +1,219 @@
+import base64
+import binascii
+import hashlib
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Field, Q, QuerySet
+from django.utils.functional import cached_property
+
+from .stampede import get_or_compute
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def table_estimate(queryset: QuerySet) -> int | None:
+    ''' Оценка числа строк таблицы по статистике планировщика PostgreSQL (pg_class.reltuples).
+    Статистика обновляется только автоанализом, поэтому тоже кэшируется
+    '''
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    table = queryset.model._meta.db_table
+    key = f'reltuples:{connection.alias}:{table}'
+    estimate = cache.get(key)
+    if estimate is None:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [table])
+            row = cursor.fetchone()
+        estimate = row[0] if row else -1
+        cache.set(key, estimate, settings.APPROX_COUNT_CACHE_SECONDS)
+    # -1 - таблица еще ни разу не анализировалась
+    return estimate if estimate >= 0 else None
+
+
+def approximate_count(queryset: QuerySet) -> tuple[int, bool]:
+    ''' Число записей и признак того, что это оценка.
+    Пока таблица меньше APPROX_COUNT_THRESHOLD, COUNT(*) дешевый и считается точно. Для большой таблицы
+    без фильтров берется reltuples, с фильтрами - точный COUNT(*), закэшированный на APPROX_COUNT_CACHE_SECONDS (main.stampede)
+    '''
+    if not isinstance(queryset, QuerySet):
+        return len(queryset), False
+    if queryset.query.is_empty():
+        return 0, False
+
+    estimate = table_estimate(queryset)
+    if estimate is None or estimate < settings.APPROX_COUNT_THRESHOLD:
+        return queryset.count(), False
+
+    query = queryset.query
+    if not query.where and not query.distinct and not query.is_sliced and not query.combinator:
+        return estimate, True
+
+    # Дорогой COUNT(*) после истечения считает один процесс, остальные получают прежнее число
+    key = 'count:' + hashlib.md5(str(query).encode()).hexdigest()
+    return get_or_compute(key, queryset.count, settings.APPROX_COUNT_CACHE_SECONDS), True
+
+
+class ApproximateCountPaginator(Paginator):
+    ''' Paginator, который для больших таблиц не выполняет COUNT(*) на каждой странице (см. approximate_count).
+    Точное число - с exact_count=True
+    '''
+
+    def __init__(self, *args, exact_count: bool = False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.exact_count = exact_count
+        self._count_is_estimate = False
+
+    @cached_property
+    def count(self):
+        if self.exact_count:
+            return super().count
+        count, self._count_is_estimate = approximate_count(self.object_list)
+        return count
+
+    @property
+    def count_is_estimate(self):
+        self.count
+        return self._count_is_estimate
+
+
+class KeysetPage:
+    ''' Страница keyset-пагинации. Вместо номера страницы - непрозрачные курсоры соседних страниц '''
+
+    def __init__(self, object_list: list, next_cursor: str | None, prev_cursor: str | None, count: int | None = None,
+                 count_is_estimate: bool = False):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.count = count
+        self.count_is_estimate = count_is_estimate
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.prev_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class KeysetPaginator:
+    ''' Пагинация по ключу сортировки (keyset / cursor).
+    OFFSET заставляет БД прочитать и выбросить все предыдущие строки, а COUNT(*) - всю таблицу.
+    Здесь страница выбирается условием "после последней строки предыдущей страницы",
+    поэтому при наличии индекса по полям сортировки глубина страницы на время ответа не влияет.
+    Последнее поле сортировки должно быть уникальным (обычно id).
+    '''
+
+    def __init__(self, queryset: QuerySet, per_page: int, ordering: tuple[str, ...]):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.ordering = ordering
+        self.fields = [self.resolve_field(queryset, name.lstrip('-')) for name in ordering]
+
+    @staticmethod
+    def resolve_field(queryset: QuerySet, name: str) -> tuple[str, Field]:
+        # Сортировать можно как по полю модели, так и по аннотации (например, релевантности поиска)
+        if name in queryset.query.annotations:
+            return name, queryset.query.annotations[name].output_field
+        field = queryset.model._meta.get_field(name)
+        return field.attname, field
+
+    def get_page(self, cursor: str | None = None, with_count: bool = False, exact_count: bool = False) -> KeysetPage:
+        values, reverse = self.decode_cursor(cursor) if cursor else (None, False)
+        rows = list(self.page_queryset(values, reverse))
+
+        count, count_is_estimate = None, False
+        if exact_count:
+            count = self.queryset.count()
+        elif with_count:
+            count, count_is_estimate = approximate_count(self.queryset)
+        return self.make_page(rows, values, reverse, count, count_is_estimate)
+
+    async def aget_page(self, cursor: str | None = None, with_count: bool = False, exact_count: bool = False) -> KeysetPage:
+        values, reverse = self.decode_cursor(cursor) if cursor else (None, False)
+        rows = [obj async for obj in self.page_queryset(values, reverse)]
+
+        count, count_is_estimate = None, False
+        if exact_count:
+            count = await self.queryset.acount()
+        elif with_count:
+            # Оценка читает pg_class сырым SQL, у которого нет асинхронного API
+            count, count_is_estimate = await sync_to_async(approximate_count)(self.queryset)
+        return self.make_page(rows, values, reverse, count, count_is_estimate)
+
+    def make_page(self, rows: list, values: list | None, reverse: bool, count: int | None,
+                  count_is_estimate: bool) -> KeysetPage:
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if reverse:
+            rows.reverse()
+
+        next_cursor = prev_cursor = None
+        if rows:
+            # Если пришли по курсору, то с противоположной стороны страницы данные точно есть
+            if has_more or reverse:
+                next_cursor = self.encode_cursor(rows[-1], reverse=False)
+            if (has_more and reverse) or (values is not None and not reverse):
+                prev_cursor = self.encode_cursor(rows[0], reverse=True)
+        return KeysetPage(rows, next_cursor, prev_cursor, count, count_is_estimate)
+
+    def page_queryset(self, values: list | None, reverse: bool) -> QuerySet:
+        # Одна лишняя строка показывает, есть ли следующая страница
+        queryset = self.queryset.order_by(*(self.reversed_ordering() if reverse else self.ordering))
+        if values is not None:
+            queryset = queryset.filter(self.keyset_filter(values, reverse))
+        return queryset[:self.per_page + 1]
+
+    def reversed_ordering(self) -> list[str]:
+        return [name[1:] if name.startswith('-') else '-' + name for name in self.ordering]
+
+    def keyset_filter(self, values: list, reverse: bool) -> Q:
+        # (a DESC, b ASC) после (x, y) => a <= x AND (a < x OR (a = x AND b > y))
+        # Первое условие не обязательно логически, но именно оно позволяет начать сканирование индекса с нужного места
+        lookups = []
+        for name in self.ordering:
+            descending = name.startswith('-')
+            lookups.append('lt' if descending != reverse else 'gt')
+
+        names = [name for name, _ in self.fields]
+        condition = Q()
+        for i, name in enumerate(names):
+            equal = {names[j]: values[j] for j in range(i)}
+            condition |= Q(**equal, **{f'{name}__{lookups[i]}': values[i]})
+
+        return Q(**{f'{names[0]}__{lookups[0]}e': values[0]}) & condition
+
+    def encode_cursor(self, obj, reverse: bool) -> str:
+        values = [getattr(obj, name) for name, _ in self.fields]
+        payload = {'r': int(reverse), 'v': [value.isoformat() if hasattr(value, 'isoformat') else value for value in values]}
+        return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+    def decode_cursor(self, cursor: str) -> tuple[list, bool]:
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            raw_values = payload['v']
+            if len(raw_values) != len(self.fields):
+                raise InvalidCursor(cursor)
+            values = [field.to_python(value) for (_, field), value in zip(self.fields, raw_values)]
+            return values, bool(payload['r'])
+        except (binascii.Error, ValueError, TypeError, KeyError, ValidationError):
+            raise InvalidCursor(cursor)
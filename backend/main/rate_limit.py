@@ -0,0 +1,140 @@
+import re
+import time
+from functools import cache as memoize
+from http import HTTPStatus
+from typing import NamedTuple
+
+import redis
+from django.conf import settings
+from django.contrib import messages
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache
+from django.core.cache.backends.redis import RedisCache
+from django.http import HttpResponse
+from django.shortcuts import redirect
+
+RATE_PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+class RateLimitResult(NamedTuple):
+    allowed: bool
+    # Взвешенное число запросов в скользящем окне и через сколько секунд пройдет следующий запрос
+    count: float
+    wait: float
+
+
+def parse_rate(rate: str) -> tuple[int, int]:
+    ''' Лимит в формате DRF: '10/minute', '5/h' -> (число запросов, секунд) '''
+    number, period = rate.split('/')
+    return int(number), RATE_PERIODS[period[0]]
+
+
+@memoize
+def connect_redis(url: str) -> redis.Redis:
+    return redis.Redis.from_url(url)
+
+
+def redis_client() -> redis.Redis:
+    ''' Клиент Redis кэша по умолчанию для операций, которых нет в API кэша Django (pipeline).
+    Строится по адресу из CACHES, а не берется у RedisCache: там он в закрытом атрибуте (_cache),
+    который может измениться в любом релизе Django. Первый из нескольких адресов - сервер для записи, как в RedisCache
+    '''
+    location = settings.CACHES[DEFAULT_CACHE_ALIAS]['LOCATION']
+    servers = re.split('[;,]', location) if isinstance(location, str) else location
+    return connect_redis(servers[0])
+
+
+def increment(key: str, window: int, period: int) -> tuple[int, int]:
+    ''' Атомарный инкремент счетчика текущего окна и число запросов в предыдущем.
+    В Redis - одна транзакция INCR + EXPIRE + GET, в других кэшах (локальная замена) - incr/add/get
+    '''
+    current_key, previous_key = f'ratelimit:{key}:{window}', f'ratelimit:{key}:{window - 1}'
+    if isinstance(cache, RedisCache):
+        current_key = cache.make_and_validate_key(current_key)
+        previous_key = cache.make_and_validate_key(previous_key)
+        with redis_client().pipeline() as pipeline:
+            current, _, previous = pipeline.incr(current_key).expire(current_key, period * 2).get(previous_key).execute()
+        return int(current), int(previous or 0)
+
+    try:
+        current = cache.incr(current_key)
+    except ValueError:
+        cache.add(current_key, 0, period * 2)
+        current = cache.incr(current_key)
+    return current, cache.get(previous_key, 0)
+
+
+def decrement(key: str, window: int):
+    try:
+        cache.decr(f'ratelimit:{key}:{window}')
+    except ValueError:
+        pass
+
+
+def hit(key: str, limit: int, period: int) -> RateLimitResult:
+    ''' Скользящее окно из двух счетчиков: текущего окна и предыдущего с весом оставшейся в окне доли.
+    Память и число операций с кэшем на проверку постоянны (в отличие от списка времен запросов в DRF),
+    счетчики общие для всех процессов, если кэш общий (CACHE_URL). Отклоненный запрос не засчитывается
+    '''
+    now = time.time()
+    window, elapsed = divmod(now, period)
+    current, previous = increment(key, int(window), period)
+    count = previous * (1 - elapsed / period) + current
+    if count <= limit:
+        return RateLimitResult(True, count, 0)
+
+    decrement(key, int(window))
+    current -= 1
+    # Следующий запрос пройдет, когда previous * (1 - t / period) + current + 1 <= limit
+    if current + 1 <= limit and previous:
+        wait = period * (1 - (limit - current - 1) / previous) - elapsed
+    else:
+        wait = period - elapsed + period * max(0, 1 - (limit - 1) / max(current, 1))
+    return RateLimitResult(False, count, max(wait, 0))
+
+
+def client_ip(request) -> str:
+    ''' IP клиента с учетом NUM_PROXIES обратных прокси (nginx) перед приложением, как в DRF '''
+    forwarded = request.META.get('HTTP_X_FORWARDED_FOR')
+    remote_addr = request.META.get('REMOTE_ADDR')
+    if settings.NUM_PROXIES and forwarded:
+        addresses = [address.strip() for address in forwarded.split(',')]
+        return addresses[-min(settings.NUM_PROXIES, len(addresses))]
+    return remote_addr
+
+
+class RateLimitMixin:
+    ''' Лимит отправок формы (POST) на пользователя, для анонима - на IP. Лимит берется из RATE_LIMITS по rate_limit_scope.
+    При превышении форма возвращается с ошибкой и статусом 429
+    '''
+    rate_limit_scope = None
+    rate_limit_message = 'Too many requests. Please try again in {wait} seconds.'
+
+    def post(self, request, *args, **kwargs):
+        rate = settings.RATE_LIMITS.get(self.rate_limit_scope)
+        if rate:
+            ident = f'user:{request.user.pk}' if request.user.is_authenticated else f'ip:{client_ip(request)}'
+            result = hit(f'{self.rate_limit_scope}:{ident}', *parse_rate(rate))
+            if not result.allowed:
+                response = self.rate_limited(result)
+                response['Retry-After'] = str(int(result.wait) + 1)
+                return response
+        return super().post(request, *args, **kwargs)
+
+    def get_rate_limit_message(self, result: RateLimitResult) -> str:
+        return self.rate_limit_message.format(wait=int(result.wait) + 1)
+
+    def rate_limited(self, result: RateLimitResult) -> HttpResponse:
+        self.object = None
+        form = self.get_form()
+        form.add_error(None, self.get_rate_limit_message(result))
+        response = self.form_invalid(form)
+        response.status_code = HTTPStatus.TOO_MANY_REQUESTS
+        return response
+
+
+class RedirectRateLimitMixin(RateLimitMixin):
+    ''' Для форм без собственной страницы (комментарий на странице записи): сообщение и возврат на success_url '''
+
+    def rate_limited(self, result: RateLimitResult) -> HttpResponse:
+        messages.error(self.request, self.get_rate_limit_message(result))
+        return redirect(self.get_success_url())
@@ -0,0 +1,15 @@
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db.models import F, FloatField, QuerySet
+from django.db.models.functions import Cast
+
+from .constants import SEARCH_CONFIG
+
+
+def search_blogs(queryset: QuerySet, text: str) -> QuerySet:
+    ''' Полнотекстовый поиск по заголовку и тексту записи.
+    Условие по search_vector идет через GIN-индекс, релевантность (rank) считается только для найденных записей
+    '''
+    query = SearchQuery(text, search_type='websearch', config=SEARCH_CONFIG)
+    # ts_rank возвращает real, а значение из курсора приходит как double precision и с real точно не совпадает
+    rank = Cast(SearchRank(F('search_vector'), query), FloatField())
+    return queryset.filter(search_vector=query).annotate(rank=rank)
@@ -0,0 +1,197 @@
+from django.contrib.auth import get_user_model
+from django.db.models import Count, F, Max, OuterRef, QuerySet, Subquery
+from django.db.models.functions import Greatest
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+from django_cleanup.signals import cleanup_post_delete
+
+from .images import delete_derivatives
+from .jobs import default_name, default_variants, enqueue_image
+from .live_comments import publish_comment
+from .outbox import notify_blog_author
+from .models import Blog, Blogger, BloggerStats, Comment, ImageJob
+from .page_cache import invalidate_pages
+
+User = get_user_model()
+
+# Сигналы срабатывают при любом способе создания/удаления через ORM: CBV, FBV, API, админка, каскад.
+# Массовые bulk_create/update их обходят - расхождения чинят команды reconcile_comments_count и rebuild_blogger_stats
+
+
+@receiver(post_save, sender=Comment)
+def increment_comments_count(sender, instance: Comment, created, **kwargs):
+    if created:
+        # update() не трогает auto_now, а число комментариев видно в закэшированных строках списков
+        Blog.objects.filter(pk=instance.to_blog_id).update(
+            comments_count=F('comments_count') + 1, updated=timezone.now())
+        BloggerStats.objects.filter(user__blogs=instance.to_blog_id).update(
+            comments_received=F('comments_received') + 1)
+
+
+def cascade_from(origin, *models) -> bool:
+    ''' Удаление начато с объекта (или QuerySet) одной из моделей, а не с самого комментария '''
+    model = origin.model if isinstance(origin, QuerySet) else type(origin)
+    return issubclass(model, models)
+
+
+@receiver(post_delete, sender=Comment)
+def decrement_comments_count(sender, instance: Comment, origin=None, **kwargs):
+    # Каскад от записи или пользователя: счетчики разом правят decrement_blogs_count и discount_user_comments,
+    # иначе удаление популярной записи стоило бы нескольких запросов на каждый комментарий
+    if cascade_from(origin, Blog, User):
+        return
+    Blog.objects.filter(pk=instance.to_blog_id, comments_count__gt=0).update(
+        comments_count=F('comments_count') - 1, updated=timezone.now())
+    BloggerStats.objects.filter(user__blogs=instance.to_blog_id, comments_received__gt=0).update(
+        comments_received=F('comments_received') - 1)
+
+
+@receiver(post_save, sender=Comment)
+def notify_comment_subscribers(sender, instance: Comment, created, **kwargs):
+    # NOTIFY уходит подписчикам SSE (main.live_comments) только после коммита транзакции
+    if created:
+        publish_comment(instance)
+
+
+@receiver(post_save, sender=Comment)
+def enqueue_comment_notification(sender, instance: Comment, created, **kwargs):
+    # Письмо автору записи ставится в очередь (main.outbox) в транзакции создания комментария
+    if created:
+        notify_blog_author(instance)
+
+
+@receiver(post_save, sender=User)
+def create_blogger_stats(sender, instance: User, created, **kwargs):
+    if created:
+        BloggerStats.objects.get_or_create(user=instance)
+
+
+@receiver(post_save, sender=Blogger)
+def update_blogger_stats_avatar(sender, instance: Blogger, **kwargs):
+    updated = BloggerStats.objects.filter(user=instance.user_id).update(
+        avatar=instance.avatar.name or '', avatar_variants=instance.avatar_variants, updated=timezone.now())
+    if not updated:
+        # Пользователь создан в обход create_blogger_stats - без записи статистики его нет в списке блогеров
+        BloggerStats.objects.ensure(instance.user_id)
+
+
+@receiver(post_save, sender=Blog)
+def increment_blogs_count(sender, instance: Blog, created, **kwargs):
+    if created:
+        BloggerStats.objects.filter(user=instance.author_id).update(
+            blogs_count=F('blogs_count') + 1,
+            last_post=instance.created,
+            updated=timezone.now())
+
+
+@receiver(post_delete, sender=Blog)
+def decrement_blogs_count(sender, instance: Blog, **kwargs):
+    last_post = Blog.objects.filter(author=instance.author_id).order_by().values('author').annotate(
+        last=Max('created')).values('last')
+    # Комментарии записи удалены каскадом без изменения счетчиков (decrement_comments_count)
+    BloggerStats.objects.filter(user=instance.author_id, blogs_count__gt=0).update(
+        blogs_count=F('blogs_count') - 1,
+        comments_received=Greatest(F('comments_received') - instance.comments_count, 0),
+        last_post=Subquery(last_post),
+        updated=timezone.now())
+
+
+@receiver(pre_delete, sender=User)
+def discount_user_comments(sender, instance: User, **kwargs):
+    ''' Комментарии удаляемого пользователя к чужим записям удаляются каскадом без изменения счетчиков:
+    уменьшаем счетчики этих записей и их авторов одним запросом на таблицу
+    '''
+    comments = Comment.objects.filter(author=instance).exclude(to_blog__author=instance).order_by()
+    blogs = list(Blog.objects.filter(pk__in=comments.values('to_blog')).values_list('id', 'author_id'))
+    if not blogs:
+        return
+    per_blog = comments.filter(to_blog=OuterRef('pk')).values('to_blog').annotate(total=Count('id')).values('total')
+    Blog.objects.filter(pk__in=[blog_id for blog_id, _ in blogs]).update(
+        comments_count=Greatest(F('comments_count') - Subquery(per_blog), 0), updated=timezone.now())
+    per_author = comments.filter(to_blog__author=OuterRef('user')).values('to_blog__author').annotate(
+        total=Count('id')).values('total')
+    authors = {author_id for _, author_id in blogs}
+    BloggerStats.objects.filter(user__in=authors).update(
+        comments_received=Greatest(F('comments_received') - Subquery(per_author), 0))
+    invalidate_pages('blogs', *(f'blog:{blog_id}' for blog_id, _ in blogs),
+                     *(f'blogger:{author_id}' for author_id in authors))
+
+
+# Кэш страниц для анонимов: сбрасываются только страницы, на которых видно изменение.
+# Смена имени пользователя кэш не сбрасывает - post_save пользователя срабатывает и на каждом входе (last_login)
+
+
+@receiver(post_save, sender=Blog)
+@receiver(post_delete, sender=Blog)
+def invalidate_blog_pages(sender, instance: Blog, **kwargs):
+    namespaces = ['blogs', f'blog:{instance.id}', f'blogger:{instance.author_id}']
+    # В списке блогеров видно только число записей
+    if kwargs.get('created', True):
+        namespaces.append('bloggers')
+    invalidate_pages(*namespaces)
+
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def invalidate_comment_pages(sender, instance: Comment, origin=None, **kwargs):
+    # Каскад от записи или пользователя: страницы сбрасывают invalidate_blog_pages и discount_user_comments
+    if cascade_from(origin, Blog, User):
+        return
+    # Число комментариев выводится в списке записей и на странице автора записи
+    author_id = Blog.objects.filter(pk=instance.to_blog_id).values_list('author_id', flat=True).first()
+    invalidate_pages('blogs', f'blog:{instance.to_blog_id}', f'blogger:{author_id}')
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_bloggers_list(sender, instance: User, **kwargs):
+    # Новый или удаленный пользователь появляется в списках блогеров, прочие изменения (вход) - нет
+    if kwargs.get('created', True):
+        invalidate_pages('bloggers')
+
+
+@receiver(post_save, sender=Blogger)
+@receiver(post_delete, sender=Blogger)
+def invalidate_blogger_pages(sender, instance: Blogger, **kwargs):
+    invalidate_pages('bloggers', f'blogger:{instance.user_id}')
+
+
+# Изображения обрабатываются в фоне (main.jobs): задание создается в той же транзакции, что и запись с файлом.
+# Картинка по умолчанию - один файл на все записи, в очередь она не ставится: описание ее производных
+# готовит publish_default_media, и оно записывается до сохранения вместе с остальными полями
+
+
+@receiver(pre_save, sender=Blog)
+def default_blog_image_variants(sender, instance: Blog, **kwargs):
+    if instance.image.name == default_name(ImageJob.Kind.BLOG_IMAGE):
+        instance.image_variants = default_variants(ImageJob.Kind.BLOG_IMAGE)
+
+
+@receiver(pre_save, sender=Blogger)
+def default_blogger_avatar_variants(sender, instance: Blogger, **kwargs):
+    if instance.avatar.name == default_name(ImageJob.Kind.BLOGGER_AVATAR):
+        instance.avatar_variants = default_variants(ImageJob.Kind.BLOGGER_AVATAR)
+
+
+@receiver(post_save, sender=Blog)
+def enqueue_blog_image(sender, instance: Blog, **kwargs):
+    # Файл очищен (поле пустое) - обрабатывать нечего
+    name = instance.image.name
+    if name and name != default_name(ImageJob.Kind.BLOG_IMAGE) and name != instance.image_variants.get('source'):
+        enqueue_image(ImageJob.Kind.BLOG_IMAGE, instance)
+
+
+@receiver(post_save, sender=Blogger)
+def enqueue_blogger_avatar(sender, instance: Blogger, **kwargs):
+    name = instance.avatar.name
+    if name and name != default_name(ImageJob.Kind.BLOGGER_AVATAR) and name != instance.avatar_variants.get('source'):
+        enqueue_image(ImageJob.Kind.BLOGGER_AVATAR, instance)
+
+
+@receiver(cleanup_post_delete)
+def delete_image_derivatives(sender, file_name, file, **kwargs):
+    # django_cleanup удалил оригинал (замена или удаление записи) - удаляем и его производные
+    # Хранилище по содержимому оставляет файл, на который есть другие ссылки, - и его производные тоже
+    if sender in (Blog, Blogger) and not file.storage.exists(file_name):
+        delete_derivatives(file_name, file.storage)
@@ -0,0 +1,198 @@
+import asyncio
+import math
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+
+# Счетчики процесса: hit - отдано свежее значение, miss - значение посчитано (его не было или оно устарело),
+# stale - отдано устаревшее, пока другой процесс его пересчитывает, early - досрочный пересчет свежего значения
+_counters = Counter()
+_counters_lock = threading.Lock()
+
+
+def count(name: str):
+    with _counters_lock:
+        _counters[name] += 1
+
+
+def stats() -> dict:
+    with _counters_lock:
+        return {name: _counters[name] for name in ('hit', 'miss', 'stale', 'early')}
+
+
+def reset_stats():
+    with _counters_lock:
+        _counters.clear()
+
+
+def lock_key(key: str) -> str:
+    return f'lock:{key}'
+
+
+def acquire(key: str) -> str | None:
+    ''' Блокировка через атомарный add в кэше: пересчитывает только получивший ее процесс.
+    Блокировка живет STAMPEDE_LOCK_SECONDS, поэтому упавший процесс не заблокирует ключ навсегда
+    '''
+    token = uuid.uuid4().hex
+    return token if cache.add(lock_key(key), token, settings.STAMPEDE_LOCK_SECONDS) else None
+
+
+def release(key: str, token: str):
+    # Проверка и удаление не атомарны, но чужую блокировку можно снять только после истечения своей
+    if cache.get(lock_key(key)) == token:
+        cache.delete(lock_key(key))
+
+
+def get_or_compute(key: str, compute, timeout: int, version=None, beta: float | None = None):
+    ''' Значение из кэша с защитой от одновременного пересчета (cache stampede).
+    - Устаревшее значение (истек timeout или изменилась version) хранится еще STAMPEDE_STALE_SECONDS:
+      один процесс пересчитывает его под блокировкой, остальные в это время получают устаревшее
+    - Свежее значение пересчитывается досрочно с вероятностью, растущей к концу timeout (XFetch):
+      чем дольше пересчет, тем раньше, beta - множитель (по умолчанию STAMPEDE_BETA)
+    - Если значения нет совсем, остальные ждут результата до STAMPEDE_LOCK_SECONDS, затем считают сами
+    compute без аргументов возвращает значение, None не кэшируется
+    '''
+    return get_versioned(key, compute, timeout, version, beta)[0]
+
+
+def get_versioned(key: str, compute, timeout: int, version=None, beta: float | None = None) -> tuple:
+    ''' get_or_compute, который возвращает и версию отданного значения: пока другой процесс пересчитывает
+    значение, она отличается от запрошенной version (отдано устаревшее)
+    '''
+    beta = settings.STAMPEDE_BETA if beta is None else beta
+    entry = cache.get(key)
+    if entry is not None:
+        value, entry_version, expires, delta = entry
+        now = time.time()
+        if entry_version == version and now < expires:
+            # 1 - random() лежит в (0, 1], логарифм определен
+            if now - delta * beta * math.log(1 - random.random()) < expires:
+                count('hit')
+                return value, entry_version
+            token = acquire(key)
+            if token is None:
+                count('hit')
+                return value, entry_version
+            count('early')
+        else:
+            token = acquire(key)
+            if token is None:
+                count('stale')
+                return value, entry_version
+            count('miss')
+    else:
+        count('miss')
+        token = acquire(key)
+        if token is None:
+            value = wait(key, version)
+            if value is not None:
+                return value, version
+            token = acquire(key)
+
+    try:
+        return store(key, compute, timeout, version), version
+    finally:
+        if token is not None:
+            release(key, token)
+
+
+def wait(key: str, version):
+    ''' Ожидание значения, которое пересчитывает другой процесс '''
+    deadline = time.monotonic() + settings.STAMPEDE_LOCK_SECONDS
+    while time.monotonic() < deadline:
+        time.sleep(settings.STAMPEDE_WAIT_INTERVAL)
+        entry = cache.get(key)
+        if entry is not None and entry[1] == version:
+            return entry[0]
+        if cache.get(lock_key(key)) is None:
+            break
+    return None
+
+
+def store(key: str, compute, timeout: int, version):
+    start = time.time()
+    value = compute()
+    if value is not None:
+        now = time.time()
+        cache.set(key, (value, version, now + timeout, now - start), timeout + settings.STAMPEDE_STALE_SECONDS)
+    return value
+
+
+# Асинхронные версии для представлений под ASGI (main.page_cache): та же логика, но ожидание чужого пересчета
+# и обращения к кэшу не блокируют event loop. compute - корутинная функция без аргументов
+
+async def aacquire(key: str) -> str | None:
+    token = uuid.uuid4().hex
+    return token if await cache.aadd(lock_key(key), token, settings.STAMPEDE_LOCK_SECONDS) else None
+
+
+async def arelease(key: str, token: str):
+    if await cache.aget(lock_key(key)) == token:
+        await cache.adelete(lock_key(key))
+
+
+async def aget_or_compute(key: str, compute, timeout: int, version=None, beta: float | None = None):
+    return (await aget_versioned(key, compute, timeout, version, beta))[0]
+
+
+async def aget_versioned(key: str, compute, timeout: int, version=None, beta: float | None = None) -> tuple:
+    beta = settings.STAMPEDE_BETA if beta is None else beta
+    entry = await cache.aget(key)
+    if entry is not None:
+        value, entry_version, expires, delta = entry
+        now = time.time()
+        if entry_version == version and now < expires:
+            if now - delta * beta * math.log(1 - random.random()) < expires:
+                count('hit')
+                return value, entry_version
+            token = await aacquire(key)
+            if token is None:
+                count('hit')
+                return value, entry_version
+            count('early')
+        else:
+            token = await aacquire(key)
+            if token is None:
+                count('stale')
+                return value, entry_version
+            count('miss')
+    else:
+        count('miss')
+        token = await aacquire(key)
+        if token is None:
+            value = await await_value(key, version)
+            if value is not None:
+                return value, version
+            token = await aacquire(key)
+
+    try:
+        return await astore(key, compute, timeout, version), version
+    finally:
+        if token is not None:
+            await arelease(key, token)
+
+
+async def await_value(key: str, version):
+    deadline = time.monotonic() + settings.STAMPEDE_LOCK_SECONDS
+    while time.monotonic() < deadline:
+        await asyncio.sleep(settings.STAMPEDE_WAIT_INTERVAL)
+        entry = await cache.aget(key)
+        if entry is not None and entry[1] == version:
+            return entry[0]
+        if await cache.aget(lock_key(key)) is None:
+            break
+    return None
+
+
+async def astore(key: str, compute, timeout: int, version):
+    start = time.time()
+    value = await compute()
+    if value is not None:
+        now = time.time()
+        await cache.aset(key, (value, version, now + timeout, now - start), timeout + settings.STAMPEDE_STALE_SECONDS)
+    return value
@@ -0,0 +1,274 @@
+import gzip
+import hashlib
+import json
+import os
+import posixpath
+import re
+import tempfile
+import time
+from contextlib import contextmanager
+from functools import cached_property
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+
+from .constants import (
+    COMPRESS_MIN_SIZE, COMPRESS_SKIP_EXTENSIONS, DEFAULT_MEDIA_MANIFEST, DEFAULT_VARIANTS_MANIFEST, MEDIA_BLOBS_DIR,
+    MEDIA_REFERENCES)
+from .images import DERIVATIVE_SUFFIX, is_default
+from .stampede import acquire, release
+
+try:
+    import brotli
+except ImportError:
+    # Без пакета brotli пишутся только .gz
+    brotli = None
+
+# blobs/3f/3f2a...c1.jpg: имя - SHA-256 содержимого, подкаталог из первых двух символов,
+# чтобы в одном каталоге не лежали все файлы. Производные (photo.jpg.480w.webp) под шаблон не подходят
+BLOB_RE = re.compile(rf'^{MEDIA_BLOBS_DIR}/([0-9a-f]{{2}})/\1[0-9a-f]{{62}}(\.[a-z0-9]+)?$')
+TEMP_PREFIX = '.upload-'
+DERIVATIVE_NAME_RE = re.compile(rf'{DERIVATIVE_SUFFIX}$')
+
+
+def blob_name(digest: str, extension: str) -> str:
+    return f'{MEDIA_BLOBS_DIR}/{digest[:2]}/{digest}{extension}'
+
+
+def is_blob(name: str) -> bool:
+    return bool(BLOB_RE.match(str(name)))
+
+
+def is_derivative(name: str) -> bool:
+    return bool(DERIVATIVE_NAME_RE.search(str(name)))
+
+
+def reused_key(name: str) -> str:
+    return f'media:reused:{name}'
+
+
+def blob_lock_key(name: str) -> str:
+    return f'media:blob:{name}'
+
+
+@contextmanager
+def blob_lock(name: str):
+    ''' Короткая блокировка файла (та же, что у main.stampede): повторная загрузка отмечает файл, а удаление
+    проверяет ссылки и удаляет его, не пересекаясь. Блокировку упавшего процесса ждем не дольше STAMPEDE_LOCK_SECONDS
+    '''
+    key = blob_lock_key(name)
+    deadline = time.monotonic() + settings.STAMPEDE_LOCK_SECONDS
+    while (token := acquire(key)) is None and time.monotonic() < deadline:
+        time.sleep(settings.STAMPEDE_WAIT_INTERVAL)
+    try:
+        yield
+    finally:
+        if token is not None:
+            release(key, token)
+
+
+def references(name: str) -> int:
+    ''' Число ссылок на файл из полей MEDIA_REFERENCES (картинки записей и аватары).
+    Счетчик не хранится отдельно, а считается по индексам этих полей, поэтому не расходится с данными
+    '''
+    total = 0
+    for model_name, field in MEDIA_REFERENCES:
+        model = apps.get_model(model_name)
+        total += model._base_manager.filter(**{field: name}).count()
+    return total
+
+
+def compressors():
+    # mtime=0: одинаковый файл дает одинаковый .gz
+    yield '.gz', lambda data: gzip.compress(data, compresslevel=9, mtime=0)
+    if brotli is not None:
+        yield '.br', lambda data: brotli.compress(data, quality=11)
+
+
+def compress(storage, name: str, overwrite: bool = True) -> list[str]:
+    ''' Сжатые копии name.gz и name.br для gzip_static и brotli_static в nginx: сжатие один раз при сборке,
+    а не на каждый запрос. Уже сжатые форматы, маленькие файлы и файлы, которые почти не сжимаются, пропускаются.
+    overwrite=False - существующие копии не пересоздаются (для имен с хэшем содержимого)
+    '''
+    if name.lower().endswith(COMPRESS_SKIP_EXTENSIONS):
+        return []
+    with storage.open(name) as file:
+        content = file.read()
+    if len(content) < COMPRESS_MIN_SIZE:
+        return []
+
+    written = []
+    for suffix, compressor in compressors():
+        path = name + suffix
+        if not overwrite and storage.exists(path):
+            written.append(path)
+            continue
+        data = compressor(content)
+        # Выигрыш меньше 5% не стоит отдельного файла
+        if len(data) >= len(content) * 0.95:
+            continue
+        storage.delete(path)
+        storage.save(path, ContentFile(data))
+        written.append(path)
+    return written
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    ''' Статика с хэшем содержимого в именах (base.3f2a1b9c0d4e.css) и сжатыми копиями .gz/.br рядом,
+    nginx отдает их с вечным кэшированием. Без collectstatic (разработка, тесты) манифеста нет -
+    ссылки ведут на исходные имена
+    '''
+
+    def post_process(self, paths, dry_run=False, **options):
+        hashed_names = {}
+        for name, hashed_name, processed in super().post_process(paths, dry_run, **options):
+            if not isinstance(hashed_name, Exception):
+                hashed_names[name] = hashed_name
+            yield name, hashed_name, processed
+        if dry_run:
+            return
+        # Шаблоны ссылаются только на имена с хэшем, исходные имена не сжимаются
+        for hashed_name in set(hashed_names.values()):
+            compress(self, hashed_name, overwrite=False)
+
+    def stored_name(self, name):
+        if not self.hashed_files:
+            return name
+        return super().stored_name(name)
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    ''' Хранилище загрузок по содержимому: файл при записи на диск хэшируется и сохраняется под своим
+    SHA-256 (каталог upload_to поля не используется). Одинаковые загрузки - в записях и в аватарах -
+    лежат на диске один раз, а содержимое файла под этим именем никогда не меняется, поэтому nginx отдает их
+    с вечным кэшированием. Удаление (django_cleanup, main.jobs) выполняется, только когда на файл
+    не осталось ссылок, картинки по умолчанию не удаляются. Файлы, загруженные до перехода, хранятся по-старому
+    до команды dedupe_media.
+    Ссылки на картинки по умолчанию ведут на их копии с хэшем в имени (команда publish_default_media)
+    '''
+
+    def get_available_name(self, name, max_length=None):
+        if is_derivative(name):
+            return super().get_available_name(name, max_length)
+        # Имя определяется содержимым в _save, занятое имя - это тот же файл
+        return name
+
+    def _save(self, name, content):
+        if is_derivative(name):
+            # Производные (main.images) лежат рядом с оригиналом под своими именами
+            return super()._save(name, content)
+        extension = os.path.splitext(name)[1].lower()
+        directory = self.path(MEDIA_BLOBS_DIR)
+        os.makedirs(directory, exist_ok=True)
+        # Файл пишется во временный рядом с хранилищем (тот же диск) и одновременно хэшируется
+        descriptor, temp_path = tempfile.mkstemp(dir=directory, prefix=TEMP_PREFIX)
+        try:
+            digest = hashlib.sha256()
+            with os.fdopen(descriptor, 'wb') as file:
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    file.write(chunk)
+            name = blob_name(digest.hexdigest(), extension)
+            path = self.path(name)
+            with blob_lock(name):
+                if os.path.exists(path):
+                    # Такой файл уже есть. Пока ссылка на него не сохранена в БД, его может удалить
+                    # освобождение другой ссылки - отметка защищает его MEDIA_REUSE_GRACE_SECONDS.
+                    # Под блокировкой: удаление либо уже прошло (файла нет), либо увидит отметку
+                    cache.set(reused_key(name), True, settings.MEDIA_REUSE_GRACE_SECONDS)
+                    os.remove(temp_path)
+                else:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    if self.file_permissions_mode is not None:
+                        os.chmod(temp_path, self.file_permissions_mode)
+                    # Атомарно: одновременная загрузка того же файла заменит его идентичным
+                    os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return name
+
+    def url(self, name):
+        return super().url(self.published_name(name))
+
+    @cached_property
+    def manifests(self) -> dict[str, tuple]:
+        # имя манифеста -> (mtime файла, содержимое)
+        return {}
+
+    def read_manifest(self, name: str) -> dict:
+        ''' Манифест перечитывается при изменении файла: publish_default_media на работающем сервере
+        подхватывается всеми процессами без перезапуска '''
+        try:
+            mtime = os.stat(self.path(name)).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        cached = self.manifests.get(name)
+        if cached is None or cached[0] != mtime:
+            content = {}
+            if mtime is not None:
+                with self.open(name) as file:
+                    content = json.load(file)
+            cached = self.manifests[name] = (mtime, content)
+        return cached[1]
+
+    @property
+    def published(self) -> dict[str, str]:
+        return self.read_manifest(DEFAULT_MEDIA_MANIFEST)
+
+    @property
+    def published_variants(self) -> dict[str, dict]:
+        ''' Описания производных картинок по умолчанию для поля *_variants: имя -> описание '''
+        return self.read_manifest(DEFAULT_VARIANTS_MANIFEST)
+
+    def published_name(self, name: str) -> str:
+        ''' Имя опубликованной копии картинки по умолчанию или ее производной: default_image.jpg.480w.webp ->
+        default_image.3f2a1b9c0d4e.jpg.480w.webp. Остальные имена не меняются
+        '''
+        published = self.published if name else None
+        if not published:
+            return name
+        match = DERIVATIVE_NAME_RE.search(name)
+        source = name[:match.start()] if match else name
+        hashed = published.get(source)
+        return hashed + name[len(source):] if hashed else name
+
+    def reload_published(self):
+        self.__dict__.pop('manifests', None)
+
+    def _clear_cached_properties(self, setting, **kwargs):
+        super()._clear_cached_properties(setting, **kwargs)
+        if setting == 'MEDIA_ROOT':
+            self.reload_published()
+
+    def delete(self, name):
+        # Картинка по умолчанию - общий файл объектов без загрузки, ссылки на нее не проверяются
+        if is_default(name):
+            return
+        if not is_blob(name):
+            return super().delete(name)
+        # Проверка и удаление - под блокировкой файла, иначе повторная загрузка между ними (ее ссылка
+        # сохраняется позже) останется без файла
+        with blob_lock(name):
+            if cache.get(reused_key(name)) or references(name):
+                return
+            super().delete(name)
+
+    def blobs(self):
+        ''' Имена всех файлов хранилища по содержимому и временных файлов незаконченных загрузок '''
+        try:
+            directories, files = self.listdir(MEDIA_BLOBS_DIR)
+        except FileNotFoundError:
+            return
+        for file in files:
+            yield posixpath.join(MEDIA_BLOBS_DIR, file)
+        for directory in directories:
+            for file in self.listdir(posixpath.join(MEDIA_BLOBS_DIR, directory))[1]:
+                name = posixpath.join(MEDIA_BLOBS_DIR, directory, file)
+                if is_blob(name):
+                    yield name
@@ -0,0 +1,39 @@
+from django import template
+from django.core.files.storage import default_storage
+from django.utils.html import format_html, format_html_join
+
+from main.images import CONTENT_TYPES, PROCESSING, current_variants, image_status, srcsets
+
+register = template.Library()
+
+# Серый прямоугольник 4:3 вместо картинки, которая еще обрабатывается
+PLACEHOLDER = ("data:image/svg+xml,%3Csvg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 4 3'%3E"
+               "%3Crect width='4' height='3' fill='%23dee2e6'/%3E%3C/svg%3E")
+
+
+@register.simple_tag
+def picture(name, variants, sizes='100vw', **attrs):
+    ''' <picture> с производными изображения: AVIF и WebP для браузеров, которые их понимают,
+    и srcset в формате оригинала для остальных. Пока файл обрабатывается - заглушка, без производных - оригинал.
+    {% picture blog.image blog.image_variants sizes="(max-width: 960px) 100vw, 960px" class="img-fluid" alt="Image" %}
+    '''
+    name = str(name)
+    if image_status(variants, name) == PROCESSING:
+        # Оригинал до обработки не показывается: он может быть огромным и содержать EXIF с геометкой
+        attrs = {**attrs, 'alt': 'Processing', 'title': 'The image is being processed'}
+        return format_html('<img src="{}"{}>', PLACEHOLDER, format_html_join('', ' {}="{}"', attrs.items()))
+
+    sets = srcsets(variants, name)
+    if not sets:
+        return format_html('<img src="{}"{}>', default_storage.url(name), format_html_join('', ' {}="{}"', attrs.items()))
+
+    # Собственные размеры оригинала резервируют место под картинку, если шаблон не задал свои
+    if 'width' not in attrs and 'height' not in attrs:
+        attrs = {'width': variants['width'], 'height': variants['height'], **attrs}
+    fallback_format = current_variants(variants, name)[-1]['format']
+    sources = format_html_join('', '<source type="{}" srcset="{}" sizes="{}">', (
+        (CONTENT_TYPES[fmt], srcset, sizes) for fmt, srcset in sets.items() if fmt != fallback_format))
+    return format_html(
+        '<picture>{}<img src="{}" srcset="{}" sizes="{}"{}></picture>',
+        sources, default_storage.url(name), sets[fallback_format], sizes,
+        format_html_join('', ' {}="{}"', attrs.items()))
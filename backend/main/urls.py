@@ -1,14 +1,23 @@
+from django.conf import settings
 from django.urls import path
 
-from .cb_views import BioUpdateView, BlogCreateView, BlogDeleteView, BlogDetailView, BlogUpdateView, BloggerDetailView, BloggerProfileView, BloggersList, BlogsList, CommentCreateView, CommentDeleteView, IndexView
+from .cb_views import AsyncBlogDetailView, AsyncBloggerDetailView, AsyncBloggersList, AsyncBlogsList, BioUpdateView, BlogCreateView, BlogDeleteView, BlogDetailView, BlogUpdateView, BloggerDetailView, BloggerProfileView, BloggersList, BlogsList, BlogsSearch, CommentCreateView, CommentDeleteView, CommentsList, CommentsStream, IndexView
 
+# Профиль ASGI: страницы чтения обслуживают асинхронные версии представлений
+if settings.ASYNC_VIEWS:
+    BlogsList, BlogDetailView, BloggersList, BloggerDetailView = (
+        AsyncBlogsList, AsyncBlogDetailView, AsyncBloggersList, AsyncBloggerDetailView)
 
 urlpatterns = [
+    path('blogs/htmx/', BlogsList.as_view(), name='htmx_blogs_list'),
+    path('blogs/search/htmx/', BlogsSearch.as_view(), name='htmx_blogs_search'),
+    path('blogs/search/', BlogsSearch.as_view(), name='blogs_search'),
     path('blogs/', BlogsList.as_view(), name='blogs_list'),
     path('blog/<int:blog_id>/', BlogDetailView.as_view(), name='blog_details'),
     path('blog/create/', BlogCreateView.as_view(), name='blog_create'),
     path('blog/<int:blog_id>/edit/', BlogUpdateView.as_view(), name='blog_edit'),
     path('blog/<int:blog_id>/delete/', BlogDeleteView.as_view(), name='blog_delete'),
+    path('blog/<int:blog_id>/comments/htmx/', CommentsList.as_view(), name='htmx_comments'),
     path('blog/<int:blog_id>/comment/create/', CommentCreateView.as_view(), name='comment_create'),
     path('blog/<int:blog_id>/comment/<int:comment_id>/delete/', CommentDeleteView.as_view(), name='comment_delete'),
     path('bloggers/htmx/', BloggersList.as_view(), name='htmx_bloggers_list'),
@@ -19,3 +28,7 @@ urlpatterns = [
     path('', IndexView.as_view(), name='index'),
 ] 
 
+
+# Поток SSE держит соединение открытым: синхронный воркер отдал бы под каждого подписчика поток
+if settings.ASYNC_VIEWS:
+    urlpatterns.append(path('blog/<int:blog_id>/comments/stream/', CommentsStream.as_view(), name='comments_stream'))